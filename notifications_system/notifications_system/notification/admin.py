@@ -1,6 +1,6 @@
 from django.contrib import admin
 from notification.models import (
-    Notification, UserNotification, NotificationSubscription, Tag
+    Notification, UserNotification, NotificationSubscription, Tag, NotificationOutbox, IdempotencyKey
 )
 
 
@@ -46,3 +46,26 @@ class TagAdmin(admin.ModelAdmin):
     tags within the Django admin panel.
     """
     pass
+
+
+@admin.register(NotificationOutbox)
+class NotificationOutboxAdmin(admin.ModelAdmin):
+    """
+    Admin interface for managing NotificationOutbox objects.
+
+    This class provides the admin interface for inspecting pending, failed and
+    completed fan-outs within the Django admin panel.
+    """
+    list_display = ('notification', 'status', 'attempts', 'last_user_id', 'available_at')
+    list_filter = ('status',)
+
+
+@admin.register(IdempotencyKey)
+class IdempotencyKeyAdmin(admin.ModelAdmin):
+    """
+    Admin interface for managing IdempotencyKey objects.
+
+    This class provides the admin interface for inspecting the stored responses
+    of the requests made with an Idempotency-Key header.
+    """
+    list_display = ('user', 'key', 'status_code', 'created_at')
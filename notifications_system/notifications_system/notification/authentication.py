@@ -0,0 +1,48 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from notification.services.websocket.authentication import trust_token_claims
+
+
+def token_user_key(token_id):
+    """
+    Returns the cache key that records that the user of a token is active.
+    """
+    return f'token_user_active_{token_id}'
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that fetches the user of a token from the database once.
+
+    Once the user of a token was found active, it is remembered in the cache by
+    token id (the `jti` claim) for NOTIFICATIONS_WS_TOKEN_CACHE_TTL seconds or until
+    the token expires, whichever comes first, and the following requests with the
+    same token get a `TokenUser` built from its claims. With
+    NOTIFICATIONS_WS_TRUST_TOKEN_CLAIMS the database is never queried. Used by the
+    endpoints that must be answered from the cache alone, like the inbox.
+    """
+
+    def get_user(self, validated_token):
+        if trust_token_claims():
+            return TokenUser(validated_token)
+
+        token_id = validated_token.get(api_settings.JTI_CLAIM)
+        if token_id and cache.get(token_user_key(token_id)):
+            return TokenUser(validated_token)
+
+        # Raises AuthenticationFailed if the user does not exist or is inactive.
+        user = super().get_user(validated_token)
+        if token_id:
+            ttl = min(
+                getattr(settings, 'NOTIFICATIONS_WS_TOKEN_CACHE_TTL', 300),
+                validated_token['exp'] - time.time()
+            )
+            if ttl > 0:
+                cache.set(token_user_key(token_id), True, ttl)
+        return user
@@ -0,0 +1,65 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min, OuterRef, Subquery
+
+from notification.models import Notification, UserNotification
+
+
+class Command(BaseCommand):
+    """
+    Copies the timestamp and the tag of each notification to its UserNotification rows.
+
+    The table is walked in ranges of primary keys and every range is updated in its
+    own short transaction, optionally sleeping between ranges, so the command can run
+    against a live table. Rows that already have a timestamp are skipped, so it can be
+    stopped and run again at any time, or resumed with `--start-id`.
+
+    Usage:
+        python manage.py backfill_user_notifications [--chunk-size 5000] [--sleep 0.1]
+                                                     [--start-id 0]
+    """
+
+    help = 'Backfills the denormalized timestamp and tag of UserNotification in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=5000,
+            help='Number of primary keys covered by each UPDATE.'
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0.0,
+            help='Seconds to wait between chunks.'
+        )
+        parser.add_argument(
+            '--start-id', type=int, default=None,
+            help='Primary key to resume from, defaults to the lowest pending one.'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        pending = UserNotification.objects.filter(timestamp__isnull=True)
+        bounds = pending.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            self.stdout.write('Nothing to backfill.')
+            return
+
+        notifications = Notification.objects.filter(id=OuterRef('notification_id'))
+        start_id = max(options['start_id'] or bounds['min_id'], bounds['min_id'])
+        updated = 0
+
+        while start_id <= bounds['max_id']:
+            end_id = start_id + chunk_size
+            updated += pending.filter(
+                id__gte=start_id,
+                id__lt=end_id
+            ).update(
+                timestamp=Subquery(notifications.values('timestamp')[:1]),
+                tag_id=Subquery(notifications.values('tag_id')[:1])
+            )
+            self.stdout.write(f'Backfilled up to id {end_id - 1} ({updated} rows).')
+            start_id = end_id
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(f'Backfilled {updated} rows.')
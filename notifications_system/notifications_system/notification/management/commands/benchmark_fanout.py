@@ -0,0 +1,120 @@
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from notification.models import Tag, Notification, NotificationSubscription, UserNotification
+from notification.services.fanout import fan_out_notification
+from notification.services.subscribers import invalidate_subscriber_index
+from notification.services.websocket.notifications import (
+    send_real_time_notification,
+    send_real_time_notifications,
+)
+
+
+def legacy_fan_out(notification, push):
+    """
+    Reproduces the per-subscriber fan-out previously done by NotificationViewSet.perform_create:
+    one INSERT (and one audit entry) plus one push per subscriber.
+    """
+    user_ids = NotificationSubscription.objects.filter(
+        tag_id=notification.tag_id
+    ).values_list(
+        'user_id', flat=True
+    )
+    for user_id in user_ids:
+        user_notification = UserNotification.objects.create(
+            user_id=user_id,
+            notification=notification
+        )
+        if push:
+            send_real_time_notification(user_notification=user_notification)
+
+
+def set_based_fan_out(notification, push):
+    """
+    Runs the set-based fan-out used by NotificationViewSet.perform_create.
+    """
+    recipients = fan_out_notification(notification)
+    if push:
+        send_real_time_notifications(notification, recipients)
+
+
+class Command(BaseCommand):
+    """
+    Measures how the cost of fanning out a notification grows with the number of
+    subscribers, before (one INSERT per subscriber) and after (set-based) the fan-out engine.
+
+    All the data is created inside a transaction that is rolled back at the end,
+    so the command can be run against any database.
+
+    Usage:
+        python manage.py benchmark_fanout --sizes 10 100 1000 10000 [--no-push]
+    """
+
+    help = 'Benchmarks the per-subscriber and the set-based notification fan-out.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', nargs='+', type=int, default=[10, 100, 1000, 10000],
+            help='Numbers of subscribers to benchmark.'
+        )
+        parser.add_argument(
+            '--no-push', action='store_true',
+            help='Only measure the database writes, skip the channel layer.'
+        )
+
+    def handle(self, *args, **options):
+        push = not options['no_push']
+        self.stdout.write(
+            f"{'subscribers':>12} {'legacy ms':>12} {'queries':>9} "
+            f"{'set-based ms':>13} {'queries':>9} {'speedup':>9}"
+        )
+        for size in options['sizes']:
+            with transaction.atomic():
+                legacy = self.measure(legacy_fan_out, size, push)
+                set_based = self.measure(set_based_fan_out, size, push)
+                transaction.set_rollback(True)
+
+            speedup = legacy[0] / set_based[0] if set_based[0] else float('inf')
+            self.stdout.write(
+                f"{size:>12} {legacy[0]:>12.1f} {legacy[1]:>9} "
+                f"{set_based[0]:>13.1f} {set_based[1]:>9} {speedup:>8.1f}x"
+            )
+
+    @staticmethod
+    def measure(strategy, size, push):
+        """
+        Creates a tag with `size` subscribers and times a fan-out strategy on it.
+
+        Returns:
+            tuple: The elapsed time in milliseconds and the number of queries executed.
+        """
+        prefix = uuid.uuid4().hex[:8]
+        tag = Tag.objects.create(name=f'benchmark-{prefix}')
+        users = User.objects.bulk_create(
+            [User(username=f'benchmark-{prefix}-{index}') for index in range(size)]
+        )
+        if any(user.pk is None for user in users):
+            users = User.objects.filter(username__startswith=f'benchmark-{prefix}-')
+        NotificationSubscription.objects.bulk_create(
+            [NotificationSubscription(user=user, tag=tag) for user in users]
+        )
+        # `bulk_create` sends no signals.
+        invalidate_subscriber_index(tag.id)
+        notification = Notification.objects.create(tag=tag, message='Benchmark notification')
+
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_queries):
+            start = time.perf_counter()
+            strategy(notification, push)
+            elapsed = (time.perf_counter() - start) * 1000
+        return elapsed, queries
@@ -0,0 +1,110 @@
+import asyncio
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from notification.services.websocket.authentication import get_token_cache
+from notification.services.websocket.consumers import NotificationConsumer
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+MODES = [
+    ('uncached', {'NOTIFICATIONS_WS_TOKEN_CACHE_SIZE': 0}),
+    ('cached', {'NOTIFICATIONS_WS_TOKEN_CACHE_SIZE': 10000}),
+    ('trusted claims', {'NOTIFICATIONS_WS_TOKEN_CACHE_SIZE': 10000, 'NOTIFICATIONS_WS_TRUST_TOKEN_CLAIMS': True}),
+]
+
+
+class Command(BaseCommand):
+    """
+    Measures the WebSocket handshake throughput of NotificationConsumer with and
+    without the token cache, simulating a reconnect storm: every user connects
+    `--rounds` times with the same token.
+
+    The connections run in-process with WebsocketCommunicator and the in-memory
+    channel layer. The benchmark users are deleted at the end.
+
+    Usage:
+        python manage.py benchmark_handshake [--users 100] [--rounds 5] [--concurrency 50]
+    """
+
+    help = 'Benchmarks the WebSocket handshake with and without the token cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='Number of distinct users/tokens.')
+        parser.add_argument('--rounds', type=int, default=5, help='Connections per user.')
+        parser.add_argument('--concurrency', type=int, default=50, help='Simultaneous handshakes.')
+
+    def handle(self, *args, **options):
+        prefix = uuid.uuid4().hex[:8]
+        User.objects.bulk_create(
+            [User(username=f'benchmark-{prefix}-{index}') for index in range(options['users'])]
+        )
+        users = User.objects.filter(username__startswith=f'benchmark-{prefix}-')
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+
+        self.stdout.write(f"{'mode':>15} {'handshakes':>11} {'per second':>11} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8}")
+        try:
+            for name, overrides in MODES:
+                with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, **overrides):
+                    get_token_cache().clear()
+                    latencies, elapsed, queries = self.measure(
+                        tokens * options['rounds'], options['concurrency']
+                    )
+                latencies.sort()
+                self.stdout.write(
+                    f"{name:>15} {len(latencies):>11} {len(latencies) / elapsed:>11.1f} "
+                    f"{latencies[len(latencies) // 2]:>8.2f} "
+                    f"{latencies[int(len(latencies) * 0.99)]:>8.2f} {queries:>8}"
+                )
+        finally:
+            users.delete()
+
+    def measure(self, tokens, concurrency):
+        """
+        Connects and disconnects once per token, `concurrency` at a time.
+
+        Returns:
+            tuple: The handshake latencies in milliseconds, the total elapsed time in
+                   seconds and the number of queries executed.
+        """
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        async def handshake(token, semaphore, latencies):
+            async with semaphore:
+                communicator = WebsocketCommunicator(
+                    NotificationConsumer.as_asgi(), f'/ws/notifications/?token={token}'
+                )
+                start = time.perf_counter()
+                connected, _ = await communicator.connect()
+                latencies.append((time.perf_counter() - start) * 1000)
+                if not connected:
+                    raise RuntimeError('Handshake rejected.')
+                await communicator.disconnect()
+
+        async def run():
+            semaphore = asyncio.Semaphore(concurrency)
+            latencies = []
+            start = time.perf_counter()
+            await asyncio.gather(*(handshake(token, semaphore, latencies) for token in tokens))
+            return latencies, time.perf_counter() - start
+
+        with connection.execute_wrapper(count_queries):
+            latencies, elapsed = async_to_sync(run)()
+        return latencies, elapsed, queries
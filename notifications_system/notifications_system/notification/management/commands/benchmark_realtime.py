@@ -0,0 +1,204 @@
+import asyncio
+import resource
+import time
+import uuid
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import AccessToken
+
+from notification.models import Tag, NotificationSubscription
+from notification.services.subscribers import invalidate_subscriber_index
+from notification.services.websocket.authentication import get_token_cache
+from notification.services.websocket.consumers import NotificationConsumer
+from notification.services.websocket.encoding import loads
+from notification.views import NotificationViewSet
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {'capacity': 10000},
+    },
+}
+
+MODES = [
+    ('tag broadcast', {'NOTIFICATIONS_TAG_BROADCAST': True}),
+    ('per user', {'NOTIFICATIONS_TAG_BROADCAST': False}),
+]
+
+
+def percentile(values, fraction):
+    """
+    Returns the value at `fraction` (0 to 1) of a sorted list.
+    """
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the process, in megabytes.
+    """
+    # ru_maxrss is reported in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    """
+    Measures the real-time delivery path end to end: notifications are posted to
+    NotificationViewSet for a tag with `--subscribers` subscribers, and `--connections`
+    of them are connected to NotificationConsumer and wait for the pushes.
+
+    The connections run in-process with WebsocketCommunicator and the in-memory
+    channel layer, and the fan-out runs inside the request. For every mode it reports
+    the delivery latency percentiles (from the POST until each connection receives
+    the notification), the throughput, the queries of the handshakes and of each
+    notification, the number of WebSocket frames sent and the peak RSS of the
+    process. The benchmark data is deleted at the end.
+
+    Usage:
+        python manage.py benchmark_realtime [--connections 100] [--subscribers 1000] [--notifications 10]
+    """
+
+    help = 'Benchmarks the end-to-end delivery of real-time notifications.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=100, help='Connected subscribers.')
+        parser.add_argument('--subscribers', type=int, default=1000, help='Subscribers of the tag.')
+        parser.add_argument('--notifications', type=int, default=10, help='Notifications to post.')
+        parser.add_argument(
+            '--timeout', type=float, default=30,
+            help='Seconds a connection waits for each notification.'
+        )
+
+    def handle(self, *args, **options):
+        if not 0 < options['connections'] <= options['subscribers']:
+            raise CommandError('--connections must be between 1 and --subscribers.')
+
+        prefix = uuid.uuid4().hex[:8]
+        tag = Tag.objects.create(name=f'benchmark-{prefix}')
+        User.objects.bulk_create(
+            [User(username=f'benchmark-{prefix}-{index}') for index in range(options['subscribers'])]
+        )
+        users = User.objects.filter(username__startswith=f'benchmark-{prefix}-').order_by('id')
+        NotificationSubscription.objects.bulk_create(
+            [NotificationSubscription(user=user, tag=tag) for user in users]
+        )
+        # `bulk_create` sends no signals.
+        invalidate_subscriber_index(tag.id)
+        connected_users = list(users[:options['connections']])
+
+        self.stdout.write(
+            f"{'mode':>14} {'deliveries':>11} {'per second':>11} {'p50 ms':>8} {'p95 ms':>8} "
+            f"{'p99 ms':>8} {'max ms':>8} {'frames':>8} {'handshake q':>12} {'q/notif':>8} {'peak RSS MB':>12}"
+        )
+        try:
+            for name, overrides in MODES:
+                with override_settings(
+                    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+                    NOTIFICATIONS_FANOUT_ASYNC=False,
+                    **overrides
+                ):
+                    get_token_cache().clear()
+                    result = self.measure(
+                        tag, connected_users, options['notifications'], options['timeout']
+                    )
+                latencies, elapsed, frames, handshake_queries, delivery_queries = result
+                latencies.sort()
+                self.stdout.write(
+                    f"{name:>14} {len(latencies):>11} {len(latencies) / elapsed:>11.1f} "
+                    f"{percentile(latencies, 0.5):>8.2f} {percentile(latencies, 0.95):>8.2f} "
+                    f"{percentile(latencies, 0.99):>8.2f} {latencies[-1]:>8.2f} {frames:>8} "
+                    f"{handshake_queries:>12} {delivery_queries / options['notifications']:>8.1f} "
+                    f"{peak_rss_mb():>12.1f}"
+                )
+        finally:
+            # Cascades to the subscriptions, notifications and user notifications.
+            tag.delete()
+            users.delete()
+
+    def measure(self, tag, users, count, timeout):
+        """
+        Connects the users, posts `count` notifications to the tag one after the
+        other and waits until every connection received all of them.
+
+        Returns:
+            tuple: The delivery latencies in milliseconds, the elapsed time of the
+                   deliveries in seconds, the number of frames received, and the number
+                   of queries executed by the handshakes and by the deliveries.
+        """
+        view = NotificationViewSet.as_view({'post': 'create'})
+        factory = APIRequestFactory()
+        sender = users[0]
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+        queries = 0
+        frames = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        def post(index):
+            request = factory.post(
+                '/notifications/', {'tag': tag.id, 'message': f'benchmark {index}'}, format='json'
+            )
+            force_authenticate(request, user=sender)
+            response = view(request)
+            if response.status_code != 201:
+                raise CommandError(f'POST /notifications/ returned {response.status_code}.')
+
+        async def receive_all(communicator, sent_at, latencies):
+            nonlocal frames
+            received = 0
+            while received < count:
+                frame = loads(await communicator.receive_from(timeout))
+                frames += 1
+                received_at = time.perf_counter()
+                # Events coalesced by the outbound buffer arrive in a single batch frame.
+                messages = frame['data'] if frame.get('type') == 'batch' else [frame]
+                for message in messages:
+                    index = int(message['message'].rsplit(' ', 1)[1])
+                    latencies.append((received_at - sent_at[index]) * 1000)
+                received += len(messages)
+
+        async def run():
+            nonlocal queries
+            communicators = []
+            for token in tokens:
+                communicator = WebsocketCommunicator(
+                    NotificationConsumer.as_asgi(), f'/ws/notifications/?token={token}'
+                )
+                connected, _ = await communicator.connect()
+                if not connected:
+                    raise CommandError('Handshake rejected.')
+                communicators.append(communicator)
+            handshake_queries, queries = queries, 0
+
+            sent_at = {}
+            latencies = []
+            receivers = [
+                asyncio.ensure_future(receive_all(communicator, sent_at, latencies))
+                for communicator in communicators
+            ]
+            start = time.perf_counter()
+            try:
+                for index in range(count):
+                    sent_at[index] = time.perf_counter()
+                    await sync_to_async(post)(index)
+                await asyncio.gather(*receivers)
+            finally:
+                for receiver in receivers:
+                    receiver.cancel()
+                elapsed = time.perf_counter() - start
+                for communicator in communicators:
+                    await communicator.disconnect()
+            return latencies, elapsed, handshake_queries
+
+        with connection.execute_wrapper(count_queries):
+            latencies, elapsed, handshake_queries = async_to_sync(run)()
+        return latencies, elapsed, frames, handshake_queries, queries
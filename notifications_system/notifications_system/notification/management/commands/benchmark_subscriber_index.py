@@ -0,0 +1,117 @@
+import pickle
+import sys
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from notification.models import Tag, NotificationSubscription
+from notification.services.subscribers import (
+    get_subscriber_ids,
+    invalidate_subscriber_index,
+    subscriber_index_key,
+)
+
+
+def list_size(user_ids):
+    """
+    Returns the bytes taken by a list of Python ints, including the ints themselves.
+    """
+    return sys.getsizeof(user_ids) + sum(sys.getsizeof(user_id) for user_id in user_ids)
+
+
+class Command(BaseCommand):
+    """
+    Measures the memory footprint of the cached subscriber index of large tags and
+    how long fan-out takes to read the subscribers from it instead of the database.
+
+    For every size it reports the size of the subscribers as a list of Python ints
+    (what the queryset returns), as the `array` kept in memory while fanning out and
+    as the pickled cache entry, and the time of the subscriber query compared to a
+    read of the warm index.
+
+    All the data is created inside a transaction that is rolled back at the end,
+    so the command can be run against any database.
+
+    Usage:
+        python manage.py benchmark_subscriber_index --sizes 1000 10000 100000 [--repeat 5]
+    """
+
+    help = 'Benchmarks the memory and the read time of the cached subscriber index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', nargs='+', type=int, default=[1000, 10000, 100000],
+            help='Numbers of subscribers to benchmark.'
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='Reads timed per size, the best one is reported.'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'subscribers':>12} {'list KB':>10} {'array KB':>10} {'cached KB':>10} "
+            f"{'query ms':>10} {'index ms':>10} {'speedup':>9}"
+        )
+        for size in options['sizes']:
+            with transaction.atomic():
+                tag_id, sizes, timings = self.measure(size, options['repeat'])
+                transaction.set_rollback(True)
+            invalidate_subscriber_index(tag_id)
+
+            list_bytes, array_bytes, cached_bytes = sizes
+            query_ms, index_ms = timings
+            speedup = query_ms / index_ms if index_ms else float('inf')
+            self.stdout.write(
+                f"{size:>12} {list_bytes / 1024:>10.1f} {array_bytes / 1024:>10.1f} "
+                f"{cached_bytes / 1024:>10.1f} {query_ms:>10.2f} {index_ms:>10.2f} {speedup:>8.1f}x"
+            )
+
+    @staticmethod
+    def measure(size, repeat):
+        """
+        Creates a tag with `size` subscribers, then measures its index and times the reads.
+
+        Returns:
+            tuple: The id of the tag, the (list, array, cache entry) sizes in bytes and
+                   the best (query, index) read times in milliseconds.
+        """
+        prefix = uuid.uuid4().hex[:8]
+        tag = Tag.objects.create(name=f'benchmark-{prefix}')
+        User.objects.bulk_create(
+            [User(username=f'benchmark-{prefix}-{index}') for index in range(size)]
+        )
+        users = User.objects.filter(username__startswith=f'benchmark-{prefix}-')
+        NotificationSubscription.objects.bulk_create(
+            [NotificationSubscription(user=user, tag=tag) for user in users]
+        )
+        # `bulk_create` sends no signals.
+        invalidate_subscriber_index(tag.id)
+
+        queryset = NotificationSubscription.objects.filter(
+            tag_id=tag.id
+        ).order_by(
+            'user_id'
+        ).values_list(
+            'user_id', flat=True
+        )
+        query_ms = index_ms = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            user_ids = list(queryset.all())
+            query_ms = min(query_ms, (time.perf_counter() - start) * 1000)
+
+        # Builds the index, the following reads hit the cache.
+        index = get_subscriber_ids(tag.id)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            get_subscriber_ids(tag.id)
+            index_ms = min(index_ms, (time.perf_counter() - start) * 1000)
+
+        entry = cache.get(subscriber_index_key(tag.id))
+        sizes = (list_size(user_ids), sys.getsizeof(index), len(pickle.dumps(entry)))
+        return tag.id, sizes, (query_ms, index_ms)
@@ -0,0 +1,167 @@
+import asyncio
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from notification.models import Tag, Notification, UserNotification
+from notification.services.database import get_db_pool_size
+from notification.services.websocket.authentication import get_token_cache
+from notification.services.websocket.consumers import NotificationConsumer
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {'capacity': 10000},
+    },
+}
+
+
+class Command(BaseCommand):
+    """
+    Measures how the throughput of the WebSocket messages that access the database
+    scales with the number of connections, with the database work on the single
+    `sync_to_async` thread and on the database pool.
+
+    Every connection belongs to its own user with `--notifications` notifications,
+    and sends `--messages` messages one after the other, alternating `notifications_list`
+    and `read`, waiting for each reply. The connections run in-process with
+    WebsocketCommunicator and the in-memory channel layer. The gain of the pool
+    depends on the database: threads only overlap while they wait on it, so an
+    in-process SQLite database shows much less than a networked PostgreSQL.
+    `--latency-ms` adds a sleep to every query to simulate the round trip to a
+    database server. The benchmark data is deleted at the end.
+
+    Usage:
+        python manage.py benchmark_ws_db [--connections 1 10 50] [--messages 20] [--pool-size 8]
+                                         [--latency-ms 1]
+    """
+
+    help = 'Benchmarks the WebSocket database work on the sync_to_async thread and on the database pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--connections', nargs='+', type=int, default=[1, 10, 50],
+            help='Numbers of concurrent connections to benchmark.'
+        )
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent by each connection.')
+        parser.add_argument('--notifications', type=int, default=50, help='Notifications of each user.')
+        parser.add_argument(
+            '--pool-size', type=int, default=None,
+            help='Threads of the database pool. Defaults to NOTIFICATIONS_WS_DB_POOL_SIZE.'
+        )
+        parser.add_argument(
+            '--latency-ms', type=float, default=0,
+            help='Milliseconds added to every query, to simulate a networked database.'
+        )
+
+    def handle(self, *args, **options):
+        pool_size = options['pool_size'] or get_db_pool_size()
+        prefix = uuid.uuid4().hex[:8]
+        tag = Tag.objects.create(name=f'benchmark-{prefix}')
+        User.objects.bulk_create(
+            [User(username=f'benchmark-{prefix}-{index}') for index in range(max(options['connections']))]
+        )
+        users = list(User.objects.filter(username__startswith=f'benchmark-{prefix}-').order_by('id'))
+        notifications = Notification.objects.bulk_create(
+            [Notification(tag=tag, message=f'benchmark {index}') for index in range(options['notifications'])]
+        )
+        UserNotification.objects.bulk_create([
+            UserNotification(user=user, notification=notification, timestamp=notification.timestamp, tag=tag)
+            for user in users
+            for notification in notifications
+        ])
+        read_ids = {
+            user_id: user_notification_id
+            for user_notification_id, user_id in UserNotification.objects.filter(
+                user__in=users
+            ).values_list('id', 'user_id')
+        }
+
+        latency = options['latency_ms'] / 1000
+
+        def delay(execute, sql, params, many, context):
+            time.sleep(latency)
+            return execute(sql, params, many, context)
+
+        def add_delay(sender, connection, **kwargs):
+            connection.execute_wrappers.append(delay)
+
+        if latency:
+            # The connections of the pool threads are opened during the benchmark.
+            connection.execute_wrappers.append(delay)
+            connection_created.connect(add_delay)
+
+        modes = [('sync_to_async', 0), (f'db pool ({pool_size})', pool_size)]
+        self.stdout.write(f"{'connections':>12} " + ' '.join(f'{name + " msg/s":>20}' for name, _ in modes) + f" {'speedup':>9}")
+        try:
+            for count in options['connections']:
+                rates = []
+                for _, size in modes:
+                    with override_settings(
+                        CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+                        NOTIFICATIONS_WS_DB_POOL_SIZE=size,
+                        NOTIFICATIONS_WS_COALESCE_WINDOW=0,
+                        NOTIFICATIONS_TAG_BROADCAST=False,
+                        # Measures the database work, not the rate limits.
+                        NOTIFICATIONS_WS_RATE_LIMITS={},
+                        NOTIFICATIONS_WS_USER_RATE_LIMITS={}
+                    ):
+                        get_token_cache().clear()
+                        elapsed = self.measure(users[:count], read_ids, options['messages'])
+                    rates.append(count * options['messages'] / elapsed)
+                self.stdout.write(
+                    f"{count:>12} " + ' '.join(f'{rate:>20.1f}' for rate in rates) + f" {rates[1] / rates[0]:>8.1f}x"
+                )
+        finally:
+            if latency:
+                connection_created.disconnect(add_delay)
+                connection.execute_wrappers.remove(delay)
+            # Cascades to the notifications and user notifications.
+            tag.delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+    @staticmethod
+    def measure(users, read_ids, messages):
+        """
+        Connects the users and makes each connection send `messages` messages concurrently.
+
+        Returns:
+            float: The elapsed time of the messages, in seconds.
+        """
+        async def client(communicator, user):
+            for index in range(messages):
+                if index % 2:
+                    await communicator.send_json_to({'type': 'read', 'id': read_ids[user.id]})
+                else:
+                    await communicator.send_json_to({'type': 'notifications_list', 'cursor': None})
+                await communicator.receive_from(30)
+
+        async def run():
+            communicators = []
+            for user in users:
+                communicator = WebsocketCommunicator(
+                    NotificationConsumer.as_asgi(), f'/ws/notifications/?token={AccessToken.for_user(user)}'
+                )
+                connected, _ = await communicator.connect()
+                if not connected:
+                    raise RuntimeError('Handshake rejected.')
+                communicators.append(communicator)
+
+            start = time.perf_counter()
+            try:
+                await asyncio.gather(*(client(communicator, user) for communicator, user in zip(communicators, users)))
+            finally:
+                elapsed = time.perf_counter() - start
+                for communicator in communicators:
+                    await communicator.disconnect()
+            return elapsed
+
+        return async_to_sync(run)()
@@ -0,0 +1,129 @@
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from notification.services.idempotency import purge_expired_idempotency_keys
+from notification.services.retention import (
+    get_deleted_retention_days,
+    get_expired_user_notifications,
+    get_orphan_grace_hours,
+    get_orphan_notifications,
+    get_retention_days,
+    purge_orphan_notifications_chunk,
+    purge_user_notifications_chunk,
+)
+
+USER_NOTIFICATION_CHECKPOINT_KEY = 'purge_notifications_user_notification_checkpoint'
+NOTIFICATION_CHECKPOINT_KEY = 'purge_notifications_notification_checkpoint'
+
+
+class Command(BaseCommand):
+    """
+    Deletes expired UserNotification rows and then the Notification rows that no
+    user references any more.
+
+    A UserNotification expires when it is older than the retention period or, if it
+    was soft-deleted, older than the soft-deleted retention period. Both tables are
+    walked in primary key order and every chunk is deleted by id in its own short
+    transaction, optionally sleeping between chunks, so the command can run beside
+    live traffic. The last processed id of each table is stored in the cache after
+    every chunk, so an interrupted run resumes where it stopped; a complete pass
+    starts over from the beginning. Finally, the stored responses of the idempotency
+    keys older than NOTIFICATIONS_IDEMPOTENCY_TTL are deleted.
+
+    Usage:
+        python manage.py purge_notifications [--retention-days 365] [--deleted-retention-days 30]
+                                             [--orphan-grace-hours 24] [--chunk-size 1000]
+                                             [--sleep 0.1] [--reset]
+    """
+
+    help = 'Purges expired and soft-deleted notifications in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--retention-days', type=int, default=None,
+            help='Days a notification is kept, 0 keeps them forever. '
+                 'Defaults to NOTIFICATIONS_RETENTION_DAYS.'
+        )
+        parser.add_argument(
+            '--deleted-retention-days', type=int, default=None,
+            help='Days a soft-deleted notification is kept. '
+                 'Defaults to NOTIFICATIONS_DELETED_RETENTION_DAYS.'
+        )
+        parser.add_argument(
+            '--orphan-grace-hours', type=int, default=None,
+            help='Hours a notification without recipients is kept. '
+                 'Defaults to NOTIFICATIONS_ORPHAN_GRACE_HOURS.'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of rows deleted by each DELETE.'
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0.0,
+            help='Seconds to wait between chunks.'
+        )
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Ignore the stored checkpoints and start from the beginning.'
+        )
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            cache.delete_many([USER_NOTIFICATION_CHECKPOINT_KEY, NOTIFICATION_CHECKPOINT_KEY])
+
+        retention_days = options['retention_days']
+        if retention_days is None:
+            retention_days = get_retention_days()
+        deleted_retention_days = options['deleted_retention_days']
+        if deleted_retention_days is None:
+            deleted_retention_days = get_deleted_retention_days()
+        orphan_grace_hours = options['orphan_grace_hours']
+
+        user_notifications = get_expired_user_notifications(retention_days, deleted_retention_days)
+        purged = self.purge(
+            'user notifications', user_notifications, purge_user_notifications_chunk,
+            USER_NOTIFICATION_CHECKPOINT_KEY, options
+        )
+
+        notifications = get_orphan_notifications(
+            get_orphan_grace_hours() if orphan_grace_hours is None else orphan_grace_hours,
+            retention_days,
+            deleted_retention_days
+        )
+        purged_orphans = self.purge(
+            'orphan notifications', notifications, purge_orphan_notifications_chunk,
+            NOTIFICATION_CHECKPOINT_KEY, options
+        )
+
+        purged_keys = purge_expired_idempotency_keys()
+
+        self.stdout.write(
+            f'Purged {purged} user notifications, {purged_orphans} orphan notifications '
+            f'and {purged_keys} expired idempotency keys.'
+        )
+
+    def purge(self, name, queryset, purge_chunk, checkpoint_key, options):
+        """
+        Purges a queryset chunk by chunk from its stored checkpoint.
+
+        Returns:
+            int: The number of rows deleted.
+        """
+        after_id = cache.get(checkpoint_key, 0)
+        purged = 0
+        while True:
+            deleted, last_id = purge_chunk(queryset, after_id, options['chunk_size'])
+            if last_id is None:
+                break
+            purged += deleted
+            after_id = last_id
+            cache.set(checkpoint_key, after_id, None)
+            self.stdout.write(f'Purged {name} up to id {after_id} ({purged} rows).')
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        # The pass is complete, the next run starts from the beginning.
+        cache.delete(checkpoint_key)
+        return purged
@@ -0,0 +1,68 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from notification.services.scheduler import DeliveryScheduler
+
+
+class Command(BaseCommand):
+    """
+    Runs the worker that drains the notification outbox.
+
+    It claims pending fan-outs, creates their UserNotification rows and sends the
+    real-time notifications chunk by chunk, saving a checkpoint after every chunk.
+    The chunks of the fan-outs in flight are interleaved by priority, so a high
+    priority notification does not wait behind a large low priority one, see
+    `DeliveryScheduler`. It stops gracefully, after the current chunk, on SIGINT
+    or SIGTERM; the fan-outs it leaves unfinished are resumed from their checkpoint
+    by the next worker once their lease expires.
+
+    Usage:
+        python manage.py run_fanout_worker [--batch-size 10] [--chunk-size 1000]
+                                           [--poll-interval 1] [--once]
+    """
+
+    help = 'Processes the pending notification fan-outs of the outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=10,
+            help='Maximum number of fan-outs in flight per priority lane.'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=None,
+            help='Number of subscribers per chunk, defaults to NOTIFICATIONS_FANOUT_CHUNK_SIZE.'
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help='Seconds to wait when the outbox is empty.'
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Drain the outbox and exit instead of polling forever.'
+        )
+
+    def handle(self, *args, **options):
+        self.running = True
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        scheduler = DeliveryScheduler(options['batch_size'], options['chunk_size'])
+        while self.running:
+            close_old_connections()
+            if scheduler.step():
+                continue
+            if options['once']:
+                break
+            time.sleep(options['poll_interval'])
+
+        close_old_connections()
+        self.stdout.write(f'Processed {scheduler.claimed} fan-outs.')
+
+    def stop(self, signum, frame):
+        """
+        Asks the worker to stop after the chunk it is processing.
+        """
+        self.running = False
@@ -0,0 +1,59 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from notification.services.dispatcher import ScheduledDispatcher
+
+
+class Command(BaseCommand):
+    """
+    Runs the dispatcher of the scheduled notifications.
+
+    It keeps the notifications due within NOTIFICATIONS_DISPATCH_WINDOW_SECONDS in
+    a heap and releases them in batches when they are due, optionally spread over
+    NOTIFICATIONS_DISPATCH_JITTER_SECONDS, writing their outbox rows (or fanning
+    them out) like a notification created without `deliver_at`. Between releases
+    it sleeps until the next due notification or load, see `ScheduledDispatcher`.
+    It stops gracefully, after the current batch, on SIGINT or SIGTERM. Several
+    dispatchers can run at once: a notification is only released by one of them.
+
+    Usage:
+        python manage.py run_notification_dispatcher [--max-sleep 1] [--once]
+    """
+
+    help = 'Releases the scheduled notifications when they are due.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-sleep', type=float, default=1.0,
+            help='Maximum seconds to sleep between two checks, bounds the reaction to a stop signal.'
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Release the notifications that are due now and exit.'
+        )
+
+    def handle(self, *args, **options):
+        self.running = True
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        dispatcher = ScheduledDispatcher()
+        while self.running:
+            close_old_connections()
+            if dispatcher.run_once():
+                continue
+            if options['once']:
+                break
+            time.sleep(min(dispatcher.seconds_until_next(), options['max_sleep']))
+
+        close_old_connections()
+        self.stdout.write(f'Released {dispatcher.released} scheduled notifications.')
+
+    def stop(self, signum, frame):
+        """
+        Asks the dispatcher to stop after the batch it is releasing.
+        """
+        self.running = False
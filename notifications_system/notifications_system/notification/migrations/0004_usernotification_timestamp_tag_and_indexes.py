@@ -0,0 +1,39 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+import notification.operations
+
+
+class Migration(migrations.Migration):
+
+    # The indexes are built concurrently on PostgreSQL, which cannot run in a transaction.
+    atomic = False
+
+    dependencies = [
+        ('notification', '0003_notificationoutbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usernotification',
+            name='tag',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='notification.tag'),
+        ),
+        migrations.AddField(
+            model_name='usernotification',
+            name='timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        notification.operations.AddIndexOnline(
+            model_name='usernotification',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['user', '-timestamp', '-id'], include=('is_read',), name='usernotification_inbox_idx'),
+        ),
+        notification.operations.AddIndexOnline(
+            model_name='usernotification',
+            index=models.Index(condition=models.Q(('is_deleted', False), ('is_read', False)), fields=['user', '-timestamp', '-id'], name='usernotification_unread_idx'),
+        ),
+    ]
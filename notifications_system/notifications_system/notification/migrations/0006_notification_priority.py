@@ -0,0 +1,27 @@
+# Generated by Django 5.0.4 on 2026-10-18 14:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notification', '0005_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='priority',
+            field=models.CharField(choices=[('high', 'High'), ('normal', 'Normal'), ('low', 'Low')], default='normal', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='notificationoutbox',
+            name='priority',
+            field=models.CharField(choices=[('high', 'High'), ('normal', 'Normal'), ('low', 'Low')], default='normal', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='notificationoutbox',
+            index=models.Index(fields=['priority', 'status', 'available_at'], name='outbox_priority_status_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.4 on 2026-10-18 14:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notification', '0006_notification_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='deliver_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='dispatched_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('deliver_at__isnull', False), ('dispatched_at__isnull', True)), fields=['deliver_at'], name='notification_scheduled_idx'),
+        ),
+    ]
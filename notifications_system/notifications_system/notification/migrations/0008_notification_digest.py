@@ -0,0 +1,38 @@
+# Generated by Django 5.0.4 on 2026-10-18 14:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notification', '0007_notification_deliver_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='digest',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='merged', to='notification.notification'),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='digest_count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='digest_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='digest_window',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('digest_until__isnull', False)), fields=['tag', 'digest_until'], name='notification_digest_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations
+from django.db.models import Max, Min, OuterRef, Subquery
+
+CHUNK_SIZE = 5000
+
+
+def backfill_timestamp_and_tag(apps, schema_editor):
+    """
+    Copies the timestamp and the tag of each notification to the UserNotification rows
+    that do not have them yet, in ranges of primary keys like `backfill_user_notifications`.
+
+    The inbox is sorted and paginated by the denormalized timestamp, so no row may be
+    left without it. The migration is not atomic, so each range is committed on its
+    own and only its rows are locked while it is updated. Running the command
+    beforehand on a large live table leaves nothing to do here.
+    """
+    Notification = apps.get_model('notification', 'Notification')
+    UserNotification = apps.get_model('notification', 'UserNotification')
+
+    pending = UserNotification.objects.filter(timestamp__isnull=True)
+    bounds = pending.aggregate(min_id=Min('id'), max_id=Max('id'))
+    if bounds['min_id'] is None:
+        return
+
+    notifications = Notification.objects.filter(id=OuterRef('notification_id'))
+    for start_id in range(bounds['min_id'], bounds['max_id'] + 1, CHUNK_SIZE):
+        pending.filter(
+            id__gte=start_id,
+            id__lt=start_id + CHUNK_SIZE
+        ).update(
+            timestamp=Subquery(notifications.values('timestamp')[:1]),
+            tag_id=Subquery(notifications.values('tag_id')[:1])
+        )
+
+
+class Migration(migrations.Migration):
+
+    # One short transaction per range instead of one holding the locks of every row.
+    atomic = False
+
+    dependencies = [
+        ('notification', '0008_notification_digest'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_timestamp_and_tag, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+import notification.operations
+
+
+class Migration(migrations.Migration):
+
+    # The index is built concurrently on PostgreSQL, which cannot run in a transaction.
+    atomic = False
+
+    dependencies = [
+        ('notification', '0009_backfill_usernotification_timestamp'),
+    ]
+
+    operations = [
+        notification.operations.AddIndexOnline(
+            model_name='usernotification',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['user', 'id'], name='usernotification_replay_idx'),
+        ),
+    ]
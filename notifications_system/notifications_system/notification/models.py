@@ -1,6 +1,8 @@
 from django.contrib.auth.models import User
 from django.db import models
-from auditlog.registry import auditlog
+from django.utils import timezone
+
+from notification.services.audit import register_audited_models
 
 
 class Tag(models.Model):
@@ -9,9 +11,12 @@ class Tag(models.Model):
 
     Attributes:
         name (str): The name of the tag, which must be unique.
+        digest_window (int): The seconds during which the notifications of the tag are
+            collapsed into a single digest, see `collapse_into_digests`. 0 disables it.
     """
 
     name = models.CharField(max_length=100, unique=True)
+    digest_window = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.name
@@ -25,11 +30,58 @@ class Notification(models.Model):
         tag (Tag): The tag associated with this notification.
         message (str): The content of the notification.
         timestamp (datetime): The time when the notification was created.
+        priority (str): The delivery lane of the notification, see `DeliveryScheduler`.
+        deliver_at (datetime): The time at which a scheduled notification is fanned out,
+            null for the notifications fanned out when they are created.
+        dispatched_at (datetime): The time at which a scheduled notification was released
+            by the `run_notification_dispatcher` command.
+        digest (Notification): The digest this notification was merged into, if its tag
+            is in digest mode and a digest was open.
+        digest_until (datetime): The end of the window of a digest, null for the
+            notifications that are not digests.
+        digest_count (int): The number of notifications collapsed into a digest, itself included.
+
+    Meta:
+        indexes: Partial index of the scheduled notifications not released yet, by due time,
+            and partial index of the digests, by tag and end of window.
     """
 
+    HIGH = 'high'
+    NORMAL = 'normal'
+    LOW = 'low'
+    # Highest first.
+    PRIORITIES = (HIGH, NORMAL, LOW)
+    PRIORITY_CHOICES = [
+        (HIGH, 'High'),
+        (NORMAL, 'Normal'),
+        (LOW, 'Low'),
+    ]
+
     tag = models.ForeignKey('notification.Tag', on_delete=models.CASCADE)
     message = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    priority = models.CharField(max_length=10, choices=PRIORITY_CHOICES, default=NORMAL)
+    deliver_at = models.DateTimeField(null=True, blank=True)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    digest = models.ForeignKey(
+        'self', on_delete=models.CASCADE, null=True, blank=True, related_name='merged'
+    )
+    digest_until = models.DateTimeField(null=True, blank=True)
+    digest_count = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['deliver_at'],
+                condition=models.Q(deliver_at__isnull=False, dispatched_at__isnull=True),
+                name='notification_scheduled_idx',
+            ),
+            models.Index(
+                fields=['tag', 'digest_until'],
+                condition=models.Q(digest_until__isnull=False),
+                name='notification_digest_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.tag} - {self.timestamp}"
@@ -68,25 +120,158 @@ class UserNotification(models.Model):
         notification (Notification): The notification received by the user.
         is_read (bool): Whether the notification has been read by the user.
         is_deleted (bool): Whether the notification has been deleted by the user.
+        timestamp (datetime): Copy of the notification timestamp, used to sort the inbox.
+        tag (Tag): Copy of the notification tag.
 
     Meta:
         unique_together: Ensures that a user cannot receive the same notification more than once.
+        indexes: Partial indexes for the undeleted inbox and the unread notifications of a user,
+                 newest first.
     """
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
     notification = models.ForeignKey('notification.Notification', on_delete=models.CASCADE)
     is_read = models.BooleanField(default=False)
     is_deleted = models.BooleanField(default=False)
+    # Denormalized from the notification so the inbox can be filtered and sorted
+    # without joining it. The existing rows are filled by migration 0009, and every
+    # new row gets it from `save()` or the fan-out.
+    timestamp = models.DateTimeField(null=True, blank=True)
+    tag = models.ForeignKey(
+        'notification.Tag', on_delete=models.CASCADE, null=True, blank=True,
+        related_name='+', db_index=False
+    )
 
     class Meta:
         unique_together = ('user', 'notification')
+        indexes = [
+            models.Index(
+                fields=['user', '-timestamp', '-id'],
+                include=['is_read'],
+                condition=models.Q(is_deleted=False),
+                name='usernotification_inbox_idx',
+            ),
+            models.Index(
+                fields=['user', '-timestamp', '-id'],
+                condition=models.Q(is_deleted=False, is_read=False),
+                name='usernotification_unread_idx',
+            ),
+            # The replay of missed notifications, in insertion order.
+            models.Index(
+                fields=['user', 'id'],
+                condition=models.Q(is_deleted=False),
+                name='usernotification_replay_idx',
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        """
+        Copies the timestamp and the tag of the notification before saving a new instance.
+        """
+        if self.timestamp is None and self.notification_id is not None:
+            self.timestamp = self.notification.timestamp
+            self.tag_id = self.notification.tag_id
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.user.username} - {self.notification.tag.name} - {self.is_read}"
 
 
-# Registering models with auditlog to track changes.
-auditlog.register(Tag)
-auditlog.register(Notification)
-auditlog.register(NotificationSubscription)
-auditlog.register(UserNotification)
+class NotificationOutbox(models.Model):
+    """
+    Represents a pending fan-out of a notification.
+
+    It is written in the same transaction as the notification and processed by the
+    `run_fanout_worker` management command, which creates the UserNotification rows
+    and sends the real-time notifications in chunks of subscribers.
+
+    Attributes:
+        notification (Notification): The notification to be fanned out.
+        priority (str): Copy of the notification priority, the lane of the fan-out.
+        status (str): The processing status of the fan-out.
+        attempts (int): The number of times a worker has claimed this fan-out.
+        last_user_id (int): Checkpoint, the highest subscriber id already delivered.
+        available_at (datetime): The time from which a worker may claim it.
+        locked_until (datetime): The time until which the claiming worker owns it.
+        last_error (str): The error raised by the last failed attempt.
+        created_at (datetime): The time when the fan-out was enqueued.
+    """
+
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    notification = models.OneToOneField(
+        'notification.Notification', on_delete=models.CASCADE, related_name='outbox'
+    )
+    priority = models.CharField(
+        max_length=10, choices=Notification.PRIORITY_CHOICES, default=Notification.NORMAL
+    )
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_user_id = models.BigIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='outbox_status_available_idx'),
+            models.Index(fields=['priority', 'status', 'available_at'], name='outbox_priority_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.notification_id} - {self.status} - {self.last_user_id}"
+
+
+class IdempotencyKey(models.Model):
+    """
+    Represents the stored response of a request made with an `Idempotency-Key` header.
+
+    It is written in the same transaction as the notifications created by the request,
+    so the unique constraint guarantees that a key creates them only once, and a retry
+    with the same key gets the stored response instead of creating and fanning them
+    out again. See `notification.services.idempotency`.
+
+    Attributes:
+        user (User): The user who made the request, keys are scoped per user.
+        key (str): The value of the Idempotency-Key header.
+        fingerprint (str): Hash of the method, the path and the body of the request.
+        status_code (int): The status code of the response.
+        response (dict|list): The body of the response.
+        created_at (datetime): The time when the request was made.
+
+    Meta:
+        constraints: Ensures that a user can only use a key once.
+        indexes: The creation time, to purge the expired keys.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField()
+    response = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='idempotency_key_user_key_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['created_at'], name='idempotency_key_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.key} - {self.status_code}"
+
+
+# Registering models with auditlog to track changes, according to NOTIFICATIONS_AUDIT_POLICY.
+register_audited_models(Tag, Notification, NotificationSubscription, UserNotification)
@@ -0,0 +1,25 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class AddIndexOnline(AddIndexConcurrently):
+    """
+    Creates an index without blocking the writes to its table where the database allows it.
+
+    On PostgreSQL the index is built with CREATE INDEX CONCURRENTLY, which must run
+    outside a transaction, so the migration must set `atomic = False`. Other databases
+    fall back to a regular CREATE INDEX: SQLite, used locally and in the tests, has no
+    concurrent build and holds a single writer anyway.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
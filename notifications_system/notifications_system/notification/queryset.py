@@ -1,41 +1,203 @@
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
 from math import ceil
-from django.db.models import F
-from notification.models import UserNotification
-from notification.serializers import UserNotificationSerializer
+from auditlog.models import LogEntry
+from django.db.models import F, Q
+from notification.models import NotificationSubscription, UserNotification
+from notification.serializers import user_notification_to_dict
+from notification.services.audit import audit_bulk
+from notification.services.counters import (
+    bump_inbox_versions,
+    decrement_inbox_count,
+    decrement_unread_count,
+    get_inbox_count,
+)
 
+# How the total of a COUNT-free page is computed: not at all, from the cached inbox
+# counter, or with a COUNT(*) that also refreshes the cached counter.
+TOTAL_NONE = 'none'
+TOTAL_APPROXIMATE = 'approximate'
+TOTAL_EXACT = 'exact'
+TOTAL_MODES = (TOTAL_NONE, TOTAL_APPROXIMATE, TOTAL_EXACT)
+# Maximum number of notifications of a page of the inbox requested by a client.
+MAX_PAGE_SIZE = 100
 
-def mark_notification_as_read(notification_id):
+
+def clamp_page_size(page_size, default=10):
+    """
+    Validates a page size sent by a client and caps it between 1 and MAX_PAGE_SIZE.
+
+    Args:
+        page_size (int|str|None): The requested page size, e.g. a query string
+            parameter or a JSON value; None means the default.
+        default (int, optional): The page size used when none is requested. Defaults to 10.
+
+    Returns:
+        int: The page size.
+
+    Raises:
+        ValueError: If the page size is not an integer.
+    """
+    if page_size is None:
+        return default
+    if isinstance(page_size, bool) or not isinstance(page_size, (int, str)):
+        raise ValueError('Invalid page size.')
+    try:
+        return max(1, min(int(page_size), MAX_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('Invalid page size.')
+
+
+def mark_notifications_as_read(user_id, notification_ids=None):
+    """
+    Marks the unread notifications of a user as read with a single UPDATE.
+
+    Args:
+        user_id (int): The ID of the user who owns the notifications.
+        notification_ids (list, optional): The IDs of the notifications to mark as read.
+            If None, all the unread notifications of the user are marked as read.
+
+    Returns:
+        list: The IDs of the notifications that changed from unread to read.
+
+    Notifications of other users, already read or deleted are ignored. The unread
+    counter of the user is decremented by the number of updated rows, the inbox
+    version is bumped, and the update is audited as a bulk operation of the user.
+    """
+    queryset = UserNotification.objects.filter(
+        user_id=user_id,
+        is_read=False,
+        is_deleted=False
+    )
+    if notification_ids is not None:
+        queryset = queryset.filter(id__in=notification_ids)
+
+    ids = list(queryset.values_list('id', flat=True))
+    if not ids:
+        return []
+
+    # Bounded by the highest selected id, so rows created in the meantime stay unread.
+    updated = queryset.filter(id__lte=max(ids)).update(is_read=True)
+    decrement_unread_count(user_id, updated)
+    bump_inbox_versions([user_id])
+    audit_bulk(
+        UserNotification, LogEntry.Action.UPDATE, ids,
+        changes={'is_read': ['False', 'True']}, actor_id=user_id
+    )
+    return ids
+
+
+def mark_notifications_as_deleted(user_id, notification_ids):
+    """
+    Marks notifications of a user as deleted with a single UPDATE.
+
+    Args:
+        user_id (int): The ID of the user who owns the notifications.
+        notification_ids (list): The IDs of the notifications to mark as deleted.
+
+    Returns:
+        list: The IDs of the notifications that changed to deleted.
+
+    Notifications of other users or already deleted are ignored. The unread counter
+    of the user is decremented by the number of unread notifications deleted, the
+    inbox counter by the number of notifications deleted, the inbox version is bumped,
+    and the update is audited as a bulk operation of the user.
+    """
+    queryset = UserNotification.objects.filter(
+        user_id=user_id,
+        is_deleted=False,
+        id__in=notification_ids
+    )
+
+    rows = list(queryset.values_list('id', 'is_read'))
+    if not rows:
+        return []
+
+    queryset.update(is_deleted=True)
+    decrement_unread_count(user_id, sum(1 for _, is_read in rows if not is_read))
+    decrement_inbox_count(user_id, len(rows))
+    bump_inbox_versions([user_id])
+    ids = [notification_id for notification_id, _ in rows]
+    audit_bulk(
+        UserNotification, LogEntry.Action.UPDATE, ids,
+        changes={'is_deleted': ['False', 'True']}, actor_id=user_id
+    )
+    return ids
+
+
+def mark_notification_as_read(notification_id, user_id):
     """
     Marks a specific notification as read by setting its `is_read` field to True.
 
     Args:
         notification_id (int): The ID of the notification to mark as read.
+        user_id (int): The ID of the user who owns the notification.
 
-    If the notification does not exist, no action is taken.
+    Returns:
+        bool: Whether the notification changed to read.
+
+    If the notification does not exist or belongs to another user, no action is taken.
     """
-    try:
-        notification = UserNotification.objects.get(id=notification_id)
-        notification.is_read = True
-        notification.save()
-    except UserNotification.DoesNotExist:
-        pass
+    return bool(mark_notifications_as_read(user_id, [notification_id]))
 
 
-def mark_notification_as_deleted(notification_id):
+def mark_notification_as_deleted(notification_id, user_id):
     """
     Marks a specific notification as deleted by setting its `is_deleted` field to True.
 
     Args:
         notification_id (int): The ID of the notification to mark as deleted.
+        user_id (int): The ID of the user who owns the notification.
+
+    Returns:
+        bool: Whether the notification changed to deleted.
 
-    If the notification does not exist, no action is taken.
+    If the notification does not exist or belongs to another user, no action is taken.
     """
-    try:
-        notification = UserNotification.objects.get(id=notification_id)
-        notification.is_deleted = True
-        notification.save()
-    except UserNotification.DoesNotExist:
-        pass
+    return bool(mark_notifications_as_deleted(user_id, [notification_id]))
+
+
+def get_user_tag_ids(user_id):
+    """
+    Returns the IDs of the tags a user is subscribed to.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        list: The IDs of the subscribed tags.
+    """
+    return list(
+        NotificationSubscription.objects.filter(user_id=user_id).values_list('tag_id', flat=True)
+    )
+
+
+def get_user_inbox(user_id):
+    """
+    Returns the queryset of the notifications that a user has not deleted, newest first.
+
+    Filtering and sorting use the timestamp denormalized on UserNotification, so they
+    are served by `usernotification_inbox_idx`; the notification is only joined to
+    read the message of the selected rows.
+
+    Args:
+        user_id (int): The ID of the user whose notifications are to be retrieved.
+
+    Returns:
+        QuerySet: A values queryset with the `id`, `is_read`, `timestamp` and `message` keys.
+    """
+    return UserNotification.objects.filter(
+        user_id=user_id,
+        is_deleted=False
+    ).order_by(
+        '-timestamp', '-id'
+    ).values(
+        'id',
+        'is_read',
+        'timestamp',
+        message=F('notification__message')
+    )
 
 
 def get_paginated_notifications(user_id, page, page_size=10):
@@ -52,25 +214,200 @@ def get_paginated_notifications(user_id, page, page_size=10):
             - A list of serialized notifications for the requested page.
             - The total number of pages available.
 
-    The notifications are filtered for the specified user and paginated manually.
+    The notifications are filtered for the specified user, excluding the deleted ones,
+    and only the requested page is fetched from the database.
     """
-    queryset = UserNotification.objects.filter(user_id=user_id).select_related(
-        'notification'
-    ).values(
-        'id',
-        'is_read',
-        timestamp=F('notification__timestamp'),
-        message=F('notification__message')
-    )
+    queryset = get_user_inbox(user_id)
 
-    notification_list = list(queryset)
-
-    total_pages = ceil(len(notification_list) / page_size)
+    total_pages = ceil(queryset.count() / page_size)
     page = max(1, min(page, total_pages))
     start = (page - 1) * page_size
     end = start + page_size
-    result_page = notification_list[start:end]
+    result_page = queryset[start:end]
+
+    return [user_notification_to_dict(row) for row in result_page], total_pages
+
+
+def get_inbox_total(user_id, total=TOTAL_NONE):
+    """
+    Returns the number of notifications in the inbox of a user, as requested by a client.
+
+    Args:
+        user_id (int): The ID of the user.
+        total (str, optional): One of TOTAL_MODES. Defaults to 'none'.
+
+    Returns:
+        int|None: The total, None for 'none'.
+
+    Raises:
+        ValueError: If the mode is not one of TOTAL_MODES.
+    """
+    if total not in TOTAL_MODES:
+        raise ValueError(f"Invalid total {total!r}, expected one of {', '.join(TOTAL_MODES)}.")
+    if total == TOTAL_NONE:
+        return None
+    return get_inbox_count(user_id, exact=total == TOTAL_EXACT)
+
+
+def get_notifications_page(user_id, page, page_size=10, total=TOTAL_NONE):
+    """
+    Retrieves a page of notifications for a specific user without counting them.
+
+    Unlike `get_paginated_notifications`, it does not run a `COUNT(*)` over the
+    whole history of the user: `page_size + 1` rows are fetched to know whether
+    there is a next page, and the total, if requested, comes from the cached inbox
+    counter. The offset still grows with the page number, so deep pages are better
+    served by `get_cursor_paginated_notifications`.
+
+    Args:
+        user_id (int): The ID of the user whose notifications are to be retrieved.
+        page (int): The page number to retrieve, from 1.
+        page_size (int, optional): The number of notifications per page. Defaults to 10.
+        total (str, optional): One of TOTAL_MODES, see `get_inbox_total`. Defaults to 'none'.
+
+    Returns:
+        tuple: A tuple containing three elements:
+            - A list of serialized notifications for the requested page.
+            - Whether there are more notifications after this page.
+            - The total number of notifications, or None if not requested.
+
+    Raises:
+        ValueError: If `total` is not one of TOTAL_MODES.
+    """
+    count = get_inbox_total(user_id, total)
+    start = (max(1, page) - 1) * page_size
+    rows = list(get_user_inbox(user_id)[start:start + page_size + 1])
+    has_more = len(rows) > page_size
+
+    return [user_notification_to_dict(row) for row in rows[:page_size]], has_more, count
+
+
+class InvalidCursor(ValueError):
+    """
+    Raised when a pagination cursor sent by a client cannot be decoded.
+    """
+
+
+def encode_cursor(timestamp, notification_id):
+    """
+    Encodes the position of a notification in the inbox as an opaque cursor.
+
+    Args:
+        timestamp (datetime): The timestamp of the notification.
+        notification_id (int): The ID of the user notification.
+
+    Returns:
+        str: A URL-safe cursor.
+    """
+    raw = f"{timestamp.isoformat()}|{notification_id}"
+    return urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by `encode_cursor`.
+
+    Args:
+        cursor (str): The cursor sent by the client.
+
+    Returns:
+        tuple: The timestamp and the ID of the user notification.
+
+    Raises:
+        InvalidCursor: If the cursor is malformed.
+    """
+    try:
+        raw_timestamp, raw_id = urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(raw_timestamp), int(raw_id)
+    except (AttributeError, ValueError, UnicodeDecodeError, binascii.Error):
+        raise InvalidCursor('Invalid pagination cursor.')
+
+
+def get_cursor_paginated_notifications(user_id, cursor=None, page_size=10):
+    """
+    Retrieves a page of notifications for a specific user using keyset pagination.
+
+    The inbox is ordered by (timestamp, id) descending and the page starts right
+    after the position encoded in `cursor`, so only `page_size + 1` rows are
+    fetched regardless of the size of the user history.
+
+    Args:
+        user_id (int): The ID of the user whose notifications are to be retrieved.
+        cursor (str, optional): The `next_cursor` of the previous page. None for the first page.
+        page_size (int, optional): The number of notifications per page. Defaults to 10.
+
+    Returns:
+        tuple: A tuple containing three elements:
+            - A list of serialized notifications for the requested page.
+            - The cursor of the next page, or None if this is the last one.
+            - Whether there are more notifications after this page.
+
+    Raises:
+        InvalidCursor: If the cursor is malformed.
+    """
+    queryset = get_user_inbox(user_id)
+    if cursor:
+        timestamp, notification_id = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(timestamp__lt=timestamp)
+            | Q(timestamp=timestamp, id__lt=notification_id)
+        )
+
+    rows = list(queryset[:page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    next_cursor = encode_cursor(rows[-1]['timestamp'], rows[-1]['id']) if has_more else None
+
+    return [user_notification_to_dict(row) for row in rows], next_cursor, has_more
+
+
+def get_notifications_since(user_id, since, limit=100):
+    """
+    Retrieves the notifications of a user that come after a given one, oldest first.
+
+    It is used to replay the notifications a client missed while it was offline:
+    the rows created after the position `since` are fetched in id order, with
+    keyset pagination served by `usernotification_replay_idx`, so a replay can be
+    streamed in chunks by passing back the returned cursor. The rows are not paged
+    by timestamp: the fan-out runs in the outbox worker and in priority lanes, so a
+    row may be created after the rows of newer notifications, and it would be
+    skipped by a client that already saw those.
+
+    Args:
+        user_id (int): The ID of the user whose notifications are to be retrieved.
+        since (str|int): The ID of the last user notification seen by the client,
+            or a cursor created by `encode_cursor`, whose ID is used.
+        limit (int, optional): The maximum number of notifications. Defaults to 100.
+
+    Returns:
+        tuple: A tuple containing three elements:
+            - A list of serialized notifications, oldest first.
+            - The ID of the last returned notification, or of `since` if none.
+            - Whether there are more notifications after the last one.
+
+    Raises:
+        InvalidCursor: If the cursor is malformed or the notification does not exist.
+    """
+    if isinstance(since, int) or (isinstance(since, str) and since.isdigit()):
+        notification_id = int(since)
+        if not UserNotification.objects.filter(user_id=user_id, id=notification_id).exists():
+            raise InvalidCursor('Unknown notification.')
+    else:
+        _, notification_id = decode_cursor(since)
+
+    rows = list(
+        get_user_inbox(
+            user_id
+        ).filter(
+            id__gt=notification_id
+        ).order_by(
+            'id'
+        )[:limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        notification_id = rows[-1]['id']
 
-    serializer = UserNotificationSerializer(result_page, many=True)
+    return [user_notification_to_dict(row) for row in rows], notification_id, has_more
 
-    return serializer.data, total_pages
@@ -1,5 +1,10 @@
+from datetime import timezone
+
+from auditlog.models import LogEntry
+from django.utils import timezone as django_timezone
 from rest_framework import serializers
 from notification.models import Notification, Tag, NotificationSubscription
+from notification.services.audit import audit_bulk
 
 
 class TagSerializer(serializers.ModelSerializer):
@@ -11,11 +16,76 @@ class TagSerializer(serializers.ModelSerializer):
     Fields:
         id (int): The unique identifier of the tag.
         name (str): The name of the tag.
+        digest_window (int): The seconds during which its notifications are collapsed
+            into a digest, 0 (the default) disables it.
     """
 
     class Meta:
         model = Tag
-        fields = ['id', 'name']
+        fields = ['id', 'name', 'digest_window']
+
+
+class TagPrimaryKeyField(serializers.PrimaryKeyRelatedField):
+    """
+    Tag field that looks the tag up in the `tags` preloaded in the serializer context
+    by NotificationListSerializer, and queries it only when it is not there.
+    """
+
+    def to_internal_value(self, data):
+        tags = self.context.get('tags')
+        if tags is not None:
+            try:
+                return tags[int(data)]
+            except (KeyError, TypeError, ValueError):
+                pass
+        return super().to_internal_value(data)
+
+
+class NotificationListSerializer(serializers.ListSerializer):
+    """
+    Serializer for lists of notifications, used to create them in bulk.
+
+    The tags of all the items are loaded with a single query, and the items that
+    are valid are kept in `valid_items` even when other items fail, so a batch can
+    be partially created.
+
+    Attributes:
+        valid_items (list): The validated data of the valid items, in order.
+    """
+
+    def to_internal_value(self, data):
+        self.valid_items = []
+        if isinstance(data, list):
+            tag_ids = set()
+            for item in data:
+                try:
+                    tag_ids.add(int(item['tag']))
+                except (KeyError, TypeError, ValueError):
+                    pass
+            self.context['tags'] = Tag.objects.in_bulk(tag_ids)
+        return super().to_internal_value(data)
+
+    def run_child_validation(self, data):
+        validated = super().run_child_validation(data)
+        self.valid_items.append(validated)
+        return validated
+
+    def create(self, validated_data):
+        """
+        Inserts the notifications with a single `bulk_create`, which bypasses the
+        auditlog signals, so they are audited with `audit_bulk`.
+
+        Args:
+            validated_data (list): The validated data of the items.
+
+        Returns:
+            list: The created Notification instances.
+        """
+        notifications = Notification.objects.bulk_create(
+            [Notification(**item) for item in validated_data]
+        )
+        audit_bulk(Notification, LogEntry.Action.CREATE, [notification.id for notification in notifications])
+        return notifications
 
 
 class NotificationSerializer(serializers.ModelSerializer):
@@ -29,11 +99,25 @@ class NotificationSerializer(serializers.ModelSerializer):
         tag (Tag): The tag associated with the notification.
         message (str): The content of the notification.
         timestamp (datetime): The time when the notification was created.
+        priority (str): The delivery lane, 'high', 'normal' (the default) or 'low'.
+        deliver_at (datetime): Optional, the time at which the notification is fanned out.
     """
 
+    tag = TagPrimaryKeyField(queryset=Tag.objects.all())
+
     class Meta:
         model = Notification
-        fields = ['id', 'tag', 'message', 'timestamp']
+        fields = ['id', 'tag', 'message', 'timestamp', 'priority', 'deliver_at']
+        list_serializer_class = NotificationListSerializer
+
+    def validate_deliver_at(self, value):
+        """
+        A time that is not in the future means right away: it is cleared so the
+        notification is fanned out when it is created.
+        """
+        if value is not None and value <= django_timezone.now():
+            return None
+        return value
 
 
 class NotificationSubscriptionSerializer(serializers.ModelSerializer):
@@ -71,3 +155,40 @@ class UserNotificationSerializer(serializers.Serializer):
     timestamp = serializers.DateTimeField()
     is_read = serializers.BooleanField()
     message = serializers.CharField()
+
+
+def format_timestamp(value):
+    """
+    Formats a timestamp as UserNotificationSerializer does: ISO 8601 in UTC with a `Z` suffix.
+
+    Args:
+        value (datetime): An aware datetime.
+
+    Returns:
+        str: The formatted timestamp.
+    """
+    value = value.astimezone(timezone.utc).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def user_notification_to_dict(row):
+    """
+    Converts a user notification row into the same data as UserNotificationSerializer.
+
+    It is the fast path used to list notifications, it skips the per-field machinery
+    of DRF since the rows come from a `values()` queryset with already validated types.
+
+    Args:
+        row (dict): A row with the `id`, `timestamp`, `is_read` and `message` keys.
+
+    Returns:
+        dict: The serialized notification.
+    """
+    return {
+        'id': row['id'],
+        'timestamp': format_timestamp(row['timestamp']),
+        'is_read': row['is_read'],
+        'message': row['message'],
+    }
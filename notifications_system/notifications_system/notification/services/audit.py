@@ -0,0 +1,109 @@
+from auditlog.models import LogEntry
+from auditlog.registry import auditlog
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+
+# One LogEntry per saved or deleted instance, and one per affected row in bulk operations.
+ROW = 'row'
+# One LogEntry per saved or deleted instance, and one per bulk operation.
+BATCH = 'batch'
+# No LogEntry at all.
+OFF = 'off'
+
+AUDIT_POLICIES = (ROW, BATCH, OFF)
+
+
+def get_audit_policy(model):
+    """
+    Returns the audit policy of a model.
+
+    NOTIFICATIONS_AUDIT_POLICY maps model labels (e.g. 'notification.UserNotification')
+    to one of 'row', 'batch' or 'off'. Models that are not listed use 'row'.
+
+    Args:
+        model (Model): The model class.
+
+    Returns:
+        str: The audit policy.
+    """
+    policy = getattr(settings, 'NOTIFICATIONS_AUDIT_POLICY', {}).get(model._meta.label, ROW)
+    if policy not in AUDIT_POLICIES:
+        raise ValueError(f"Invalid audit policy {policy!r} for {model._meta.label}.")
+    return policy
+
+
+def register_audited_models(*models):
+    """
+    Registers with auditlog the models whose policy is not 'off'.
+
+    Registered models get one LogEntry per instance saved or deleted through the
+    ORM. Bulk operations bypass those signals and are audited with `audit_bulk`.
+    The registration happens at import time, so changes to the policies that turn
+    auditing on or off require a restart.
+
+    Args:
+        *models (Model): The model classes.
+    """
+    for model in models:
+        if get_audit_policy(model) != OFF:
+            auditlog.register(model)
+
+
+def audit_bulk(model, action, ids, changes=None, actor_id=None, additional_data=None):
+    """
+    Records a bulk operation on the rows of a model according to its audit policy.
+
+    With the 'batch' policy a single compact LogEntry is written, with the number
+    of affected rows and their ID range in `additional_data`. With 'row' one
+    LogEntry per row is written in a single INSERT. With 'off' nothing is written.
+
+    Args:
+        model (Model): The model class of the affected rows.
+        action (int): A `LogEntry.Action`, e.g. `LogEntry.Action.UPDATE`.
+        ids (list): The IDs of the affected rows.
+        changes (dict, optional): The changed fields, as `{field: [old, new]}`.
+        actor_id (int, optional): The ID of the user who performed the operation.
+            If None, the actor of the current request is used for batch entries.
+        additional_data (dict, optional): Extra data stored with the entries.
+
+    Returns:
+        int: The number of LogEntry rows written.
+    """
+    policy = get_audit_policy(model)
+    if not ids or policy == OFF:
+        return 0
+
+    content_type = ContentType.objects.get_for_model(model)
+    if policy == BATCH:
+        first_id, last_id = min(ids), max(ids)
+        LogEntry.objects.create(
+            content_type=content_type,
+            object_pk=f'{first_id}-{last_id}',
+            object_repr=f'{len(ids)} {model._meta.verbose_name_plural}',
+            action=action,
+            changes=changes,
+            actor_id=actor_id,
+            additional_data={
+                **(additional_data or {}),
+                'batch': True,
+                'count': len(ids),
+                'first_id': first_id,
+                'last_id': last_id,
+            }
+        )
+        return 1
+
+    entries = LogEntry.objects.bulk_create([
+        LogEntry(
+            content_type=content_type,
+            object_pk=str(object_id),
+            object_id=object_id,
+            object_repr=f'{model.__name__} object ({object_id})',
+            action=action,
+            changes=changes,
+            actor_id=actor_id,
+            additional_data=additional_data
+        )
+        for object_id in ids
+    ])
+    return len(entries)
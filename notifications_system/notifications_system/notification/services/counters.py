@@ -0,0 +1,231 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from notification.models import UserNotification
+
+
+def get_unread_count_timeout():
+    """
+    Returns the number of seconds an unread counter is kept in the cache.
+
+    The counters are maintained incrementally, so this bounds how long a counter
+    that drifted (e.g. a fan-out chunk replayed after a crash) stays wrong.
+    """
+    return getattr(settings, 'NOTIFICATIONS_UNREAD_COUNT_TIMEOUT', 60 * 60 * 24)
+
+
+def unread_count_key(user_id):
+    """
+    Returns the cache key of the unread counter of a user.
+    """
+    return f'unread_count_{user_id}'
+
+
+def rebuild_unread_count(user_id):
+    """
+    Counts the unread notifications of a user in the database and caches the result.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        int: The number of notifications that are neither read nor deleted.
+    """
+    count = UserNotification.objects.filter(
+        user_id=user_id,
+        is_read=False,
+        is_deleted=False
+    ).count()
+    cache.set(unread_count_key(user_id), count, get_unread_count_timeout())
+    return count
+
+
+def get_unread_count(user_id):
+    """
+    Returns the number of unread notifications of a user.
+
+    The counter is read from the cache; the database is only queried to rebuild
+    it when it is missing.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        int: The number of notifications that are neither read nor deleted.
+    """
+    count = cache.get(unread_count_key(user_id))
+    if count is None:
+        count = rebuild_unread_count(user_id)
+    return count
+
+
+def _increment_cached(keys, delta):
+    """
+    Increments the counters at `keys` that are cached, with a single `get_many` to find them.
+    """
+    if not keys:
+        return
+    for key in cache.get_many(keys):
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # The counter expired after get_many.
+            pass
+
+
+def _decrement_cached(key, delta):
+    """
+    Decrements the counter at `key` if it is cached, dropping it if it would become negative.
+    """
+    if delta <= 0:
+        return
+    try:
+        count = cache.decr(key, delta)
+    except ValueError:
+        return
+    if count < 0:
+        cache.delete(key)
+
+
+def increment_unread_counts(user_ids, delta=1):
+    """
+    Increments the unread counters of several users.
+
+    Only the counters that are already cached are incremented, the missing ones
+    are rebuilt the next time they are read. They are looked up with a single
+    `get_many`, so users without a cached counter cost nothing.
+
+    Args:
+        user_ids (iterable): The IDs of the users.
+        delta (int, optional): The amount to add. Defaults to 1.
+    """
+    _increment_cached([unread_count_key(user_id) for user_id in user_ids], delta)
+
+
+def decrement_unread_count(user_id, delta=1):
+    """
+    Decrements the unread counter of a user, if it is cached.
+
+    A counter that would become negative is dropped so it is rebuilt on the next read.
+
+    Args:
+        user_id (int): The ID of the user.
+        delta (int, optional): The amount to subtract. Defaults to 1.
+    """
+    _decrement_cached(unread_count_key(user_id), delta)
+
+
+def inbox_count_key(user_id):
+    """
+    Returns the cache key of the inbox counter of a user.
+    """
+    return f'inbox_count_{user_id}'
+
+
+def rebuild_inbox_count(user_id):
+    """
+    Counts the notifications of a user that are not deleted and caches the result.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        int: The number of notifications in the inbox.
+    """
+    count = UserNotification.objects.filter(
+        user_id=user_id,
+        is_deleted=False
+    ).count()
+    cache.set(inbox_count_key(user_id), count, get_unread_count_timeout())
+    return count
+
+
+def get_inbox_count(user_id, exact=False):
+    """
+    Returns the number of notifications in the inbox of a user.
+
+    Like the unread counter, the inbox counter is cached and maintained
+    incrementally by fan-out, deletes and the retention purge, so it may drift
+    (e.g. a fan-out chunk replayed after a crash) until it expires. An exact count
+    runs a `COUNT(*)` over the history of the user and refreshes the cached one.
+
+    Args:
+        user_id (int): The ID of the user.
+        exact (bool, optional): Count in the database. Defaults to False.
+
+    Returns:
+        int: The number of notifications that are not deleted.
+    """
+    count = None if exact else cache.get(inbox_count_key(user_id))
+    if count is None:
+        count = rebuild_inbox_count(user_id)
+    return count
+
+
+def increment_inbox_counts(user_ids, delta=1):
+    """
+    Increments the cached inbox counters of several users, see `increment_unread_counts`.
+
+    Args:
+        user_ids (iterable): The IDs of the users.
+        delta (int, optional): The amount to add. Defaults to 1.
+    """
+    _increment_cached([inbox_count_key(user_id) for user_id in user_ids], delta)
+
+
+def decrement_inbox_count(user_id, delta=1):
+    """
+    Decrements the cached inbox counter of a user, see `decrement_unread_count`.
+
+    Args:
+        user_id (int): The ID of the user.
+        delta (int, optional): The amount to subtract. Defaults to 1.
+    """
+    _decrement_cached(inbox_count_key(user_id), delta)
+
+
+def inbox_version_key(user_id):
+    """
+    Returns the cache key of the inbox version of a user.
+    """
+    return f'inbox_version_{user_id}'
+
+
+def get_inbox_version(user_id):
+    """
+    Returns the version of the inbox of a user, which changes whenever its content does.
+
+    The version is created on the first read from the current time in nanoseconds,
+    and bumped by deleting it, see `bump_inbox_versions`. A version created after a
+    bump, or after the cache evicted the previous one, is therefore always greater
+    than any version handed out before.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        int|None: The version, or None if the cache does not store it (e.g. DummyCache).
+    """
+    key = inbox_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), get_unread_count_timeout())
+        version = cache.get(key)
+    return version
+
+
+def bump_inbox_versions(user_ids):
+    """
+    Changes the inbox version of several users, with a single `delete_many`.
+
+    Must be called after the change to the inboxes is committed, otherwise a
+    concurrent read could cache the new version with the old content.
+
+    Args:
+        user_ids (iterable): The IDs of the users.
+    """
+    keys = [inbox_version_key(user_id) for user_id in set(user_ids)]
+    if keys:
+        cache.delete_many(keys)
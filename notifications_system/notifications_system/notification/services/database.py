@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+
+def get_db_pool_size():
+    """
+    Returns the number of threads that run the database work of the WebSocket consumers.
+
+    Every thread holds its own database connection, so this also bounds the number
+    of connections opened by a process for the consumers. 0 runs the database work
+    on the single thread shared by every `sync_to_async` call of the process.
+
+    Returns:
+        int: The value of NOTIFICATIONS_WS_DB_POOL_SIZE, defaults to 8.
+    """
+    return getattr(settings, 'NOTIFICATIONS_WS_DB_POOL_SIZE', 8)
+
+
+_executor = None
+_executor_size = None
+
+
+def get_db_executor():
+    """
+    Returns the process-wide thread pool of the database work, sized by NOTIFICATIONS_WS_DB_POOL_SIZE.
+    """
+    global _executor, _executor_size
+    size = get_db_pool_size()
+    if _executor is None or _executor_size != size:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='notifications-db')
+        _executor_size = size
+    return _executor
+
+
+def call_with_connection(func, *args, **kwargs):
+    """
+    Calls a function in a pool thread, handling the connection of the thread like a request.
+
+    Connections that are broken or older than CONN_MAX_AGE are closed before and
+    after the call, so every pool thread reuses its connection while it is healthy.
+    """
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_db_pool(func, *args, **kwargs):
+    """
+    Runs a function that accesses the database without blocking the event loop.
+
+    Unlike `sync_to_async` with its default `thread_sensitive=True`, which runs
+    every call of the process on the same thread, the calls are spread over the
+    threads of `get_db_executor`, so the database work of several connections
+    runs concurrently, up to the size of the pool.
+
+    Args:
+        func (callable): The function.
+        *args: The positional arguments of the function.
+        **kwargs: The keyword arguments of the function.
+
+    Returns:
+        The result of the function.
+    """
+    if get_db_pool_size() <= 0:
+        return await sync_to_async(func)(*args, **kwargs)
+    return await sync_to_async(
+        partial(call_with_connection, func),
+        thread_sensitive=False,
+        executor=get_db_executor()
+    )(*args, **kwargs)
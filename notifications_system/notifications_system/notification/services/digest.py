@@ -0,0 +1,126 @@
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from auditlog.models import LogEntry
+from django.db import transaction
+from django.utils import timezone
+
+from notification.models import Notification, Tag, UserNotification
+from notification.services.audit import audit_bulk
+from notification.services.counters import bump_inbox_versions, increment_unread_counts
+from notification.services.fanout import tag_broadcast_is_enabled
+from notification.services.websocket.notifications import send_real_time_patch
+
+
+def collapse_into_digests(notifications, now=None):
+    """
+    Merges the new notifications of the tags in digest mode into the open digest of their tag.
+
+    A tag with a `digest_window` collapses a burst of notifications into one: the
+    first notification of a window becomes the digest and is fanned out as usual,
+    with `digest_until` set to the end of its window, and the notifications that
+    follow until then are not fanned out. Each one is linked to the digest with
+    `digest`, and the digest takes its message and counts it in `digest_count`, so
+    a burst of N notifications writes the UserNotification rows of one. The rows of
+    the digest that were read become unread again, and once the transaction is
+    committed the recipients get the new content as a patch of the item they
+    already have, see `deliver_digest_patches`.
+
+    The tags in digest mode are locked until the end of the transaction, so the
+    notifications of a tag created concurrently open a single digest. Must be
+    called inside the transaction that created the notifications.
+
+    Args:
+        notifications (list): The new notifications, in creation order, with their tag loaded.
+        now (datetime, optional): The reference time. Defaults to the current time.
+
+    Returns:
+        list: The notifications to be fanned out, the new digests included.
+    """
+    tag_ids = sorted({notification.tag_id for notification in notifications if notification.tag.digest_window})
+    if not tag_ids:
+        return notifications
+
+    now = now or timezone.now()
+    # Serializes the notifications of each tag, so only one digest is opened per window.
+    list(Tag.objects.select_for_update().filter(id__in=tag_ids).order_by('id').values_list('id', flat=True))
+    digests = {
+        digest.tag_id: digest
+        for digest in Notification.objects.filter(
+            tag_id__in=tag_ids,
+            digest_until__gt=now
+        ).order_by('digest_until')
+    }
+
+    due, opened, changed, patched = [], set(), {}, {}
+    for notification in notifications:
+        window = notification.tag.digest_window
+        digest = digests.get(notification.tag_id)
+        if not window:
+            due.append(notification)
+        elif digest is None or digest.digest_until <= notification.timestamp:
+            notification.digest_until = notification.timestamp + timedelta(seconds=window)
+            digests[notification.tag_id] = changed[notification.id] = notification
+            opened.add(notification.id)
+            due.append(notification)
+        else:
+            notification.digest = digest
+            digest.message = notification.message
+            digest.digest_count += 1
+            changed[notification.id] = notification
+            changed[digest.id] = digest
+            if digest.id not in opened:
+                # Already fanned out, its recipients get a patch.
+                patched[digest.id] = digest
+
+    Notification.objects.bulk_update(changed.values(), ['message', 'digest', 'digest_until', 'digest_count'])
+    if patched:
+        _reopen_digests(list(patched.values()))
+    return due
+
+
+def _reopen_digests(digests):
+    """
+    Marks the read rows of updated digests as unread and sends them their patch once committed.
+    """
+    rows = list(
+        UserNotification.objects.filter(
+            notification_id__in=[digest.id for digest in digests],
+            is_deleted=False
+        ).values_list('id', 'user_id', 'notification_id', 'is_read')
+    )
+    read_ids = [user_notification_id for user_notification_id, _, _, is_read in rows if is_read]
+    if read_ids:
+        UserNotification.objects.filter(id__in=read_ids).update(is_read=False)
+        audit_bulk(UserNotification, LogEntry.Action.UPDATE, read_ids, changes={'is_read': ['True', 'False']})
+
+    recipients = {digest.id: [] for digest in digests}
+    for user_notification_id, user_id, notification_id, _ in rows:
+        recipients[notification_id].append((user_notification_id, user_id))
+    reopened = [user_id for _, user_id, _, is_read in rows if is_read]
+    transaction.on_commit(
+        lambda: deliver_digest_patches(digests, recipients, reopened)
+    )
+
+
+def deliver_digest_patches(digests, recipients, reopened):
+    """
+    Runs the side effects of committed digest updates: increments the unread counters of
+    the rows that became unread, bumps the inbox versions of the recipients, and sends
+    them the patch, through the group of the tag when NOTIFICATIONS_TAG_BROADCAST is enabled.
+
+    Args:
+        digests (list): The updated digests.
+        recipients (dict): The (user_notification_id, user_id) tuples of the recipients
+                           of each digest, by digest id.
+        reopened (list): The IDs of the users whose row of a digest became unread, once per row.
+    """
+    user_ids_by_delta = defaultdict(list)
+    for user_id, delta in Counter(reopened).items():
+        user_ids_by_delta[delta].append(user_id)
+    for delta, user_ids in user_ids_by_delta.items():
+        increment_unread_counts(user_ids, delta)
+    bump_inbox_versions(user_id for rows in recipients.values() for _, user_id in rows)
+    broadcast = tag_broadcast_is_enabled()
+    for digest in digests:
+        send_real_time_patch(digest, recipients[digest.id], broadcast)
@@ -0,0 +1,269 @@
+import heapq
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from notification.models import Notification
+from notification.services import metrics
+from notification.services.digest import collapse_into_digests
+from notification.services.fanout import deliver_notifications, fan_out_notifications
+from notification.services.outbox import enqueue_fanouts, fanout_is_async
+
+
+def get_dispatch_window():
+    """
+    Returns the number of seconds ahead the dispatcher loads the scheduled notifications.
+
+    Every `window` seconds the whole window is read again, which also picks up the
+    notifications missed by the incremental loads, e.g. committed out of id order.
+    """
+    return getattr(settings, 'NOTIFICATIONS_DISPATCH_WINDOW_SECONDS', 60)
+
+
+def get_dispatch_poll_interval():
+    """
+    Returns the number of seconds between two incremental loads of the dispatcher,
+    that is how late a notification scheduled less than a window ahead may be released.
+    """
+    return getattr(settings, 'NOTIFICATIONS_DISPATCH_POLL_SECONDS', 5)
+
+
+def get_dispatch_batch_size():
+    """
+    Returns the maximum number of scheduled notifications released together.
+    """
+    return getattr(settings, 'NOTIFICATIONS_DISPATCH_BATCH_SIZE', 500)
+
+
+def get_dispatch_jitter():
+    """
+    Returns the number of seconds over which the notifications due at the same time
+    are spread, 0 releases them exactly at their due time.
+    """
+    return getattr(settings, 'NOTIFICATIONS_DISPATCH_JITTER_SECONDS', 0)
+
+
+def is_scheduled(notification, now=None):
+    """
+    Checks whether a notification must wait for the dispatcher instead of being fanned out now.
+
+    Args:
+        notification (Notification): The notification.
+        now (datetime, optional): The reference time. Defaults to the current time.
+
+    Returns:
+        bool: True if it has a `deliver_at` in the future and was not released yet.
+    """
+    return (
+        notification.deliver_at is not None
+        and notification.dispatched_at is None
+        and notification.deliver_at > (now or timezone.now())
+    )
+
+
+def release_time(notification_id, deliver_at, jitter):
+    """
+    Returns the time at which a scheduled notification is released, as a timestamp.
+
+    The jitter offset is derived from the id, so the notifications due at the same
+    time are spread evenly over `jitter` seconds and a restarted dispatcher releases
+    each one at the same time as before.
+
+    Args:
+        notification_id (int): The ID of the notification.
+        deliver_at (datetime): Its due time.
+        jitter (float): The spreading window in seconds.
+
+    Returns:
+        float: The release timestamp.
+    """
+    offset = 0.0
+    if jitter:
+        # Knuth's multiplicative hash, a well spread fraction of the id.
+        offset = (notification_id * 2654435761 % 2 ** 32) / 2 ** 32 * jitter
+    return deliver_at.timestamp() + offset
+
+
+def dispatch_notifications(notification_ids, now=None):
+    """
+    Releases scheduled notifications and fans them out through the usual path.
+
+    The notifications still pending are locked, skipping the ones locked by another
+    dispatcher, and stamped with `dispatched_at` and a `timestamp` of the release
+    time, so they are sorted in the inbox by when they were delivered. The ones of
+    a tag in digest mode are merged into its open digest, see `collapse_into_digests`.
+    Then, in the same transaction, their outbox rows are written with a single INSERT when
+    NOTIFICATIONS_FANOUT_ASYNC is enabled, or their UserNotification rows are created
+    at once by `fan_out_notifications` and delivered once the transaction is committed.
+
+    Args:
+        notification_ids (list): The IDs of the due notifications.
+        now (datetime, optional): The release time. Defaults to the current time.
+
+    Returns:
+        list: The released Notification instances.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        notifications = list(
+            Notification.objects.select_for_update(
+                skip_locked=True, of=('self',)
+            ).select_related(
+                'tag'
+            ).filter(
+                id__in=notification_ids,
+                dispatched_at__isnull=True
+            )
+        )
+        if not notifications:
+            return []
+
+        Notification.objects.filter(
+            id__in=[notification.id for notification in notifications]
+        ).update(
+            dispatched_at=now,
+            timestamp=now
+        )
+        for notification in notifications:
+            notification.dispatched_at = now
+            notification.timestamp = now
+
+        released = notifications
+        notifications = collapse_into_digests(notifications, now)
+        if not notifications:
+            return released
+        if fanout_is_async():
+            enqueue_fanouts(notifications)
+        else:
+            with metrics.fanout_duration.time(path='dispatcher'):
+                recipients = fan_out_notifications(notifications)
+            metrics.fanout_size.observe(sum(len(rows) for rows in recipients.values()), path='dispatcher')
+            transaction.on_commit(
+                lambda: deliver_notifications(notifications, recipients)
+            )
+    return released
+
+
+class ScheduledDispatcher:
+    """
+    Releases the scheduled notifications when they are due.
+
+    The notifications due within the next `window` seconds are kept in a heap by
+    release time (see `release_time`), loaded with a single query on the partial
+    index of the pending scheduled notifications. Every `poll_interval` seconds an
+    incremental load reads only the notifications beyond the loaded range or
+    created since the last load, and every `window` seconds the whole window is
+    read again. The due notifications are popped from the heap and released
+    together, up to `batch_size` per transaction, so thousands of notifications
+    due at the same time cost a few queries instead of one poll each.
+
+    Attributes:
+        window (float): The seconds ahead loaded into the heap.
+        poll_interval (float): The seconds between two incremental loads.
+        batch_size (int): The maximum number of notifications released together.
+        jitter (float): The seconds over which the notifications due together are spread.
+        released (int): The number of notifications released so far.
+    """
+
+    def __init__(self, window=None, poll_interval=None, batch_size=None, jitter=None):
+        self.window = get_dispatch_window() if window is None else window
+        self.poll_interval = get_dispatch_poll_interval() if poll_interval is None else poll_interval
+        self.batch_size = batch_size or get_dispatch_batch_size()
+        self.jitter = get_dispatch_jitter() if jitter is None else jitter
+        self.released = 0
+        self._heap = []
+        self._loaded_ids = set()
+        self._loaded_until = None
+        self._max_id = 0
+        self._next_load = None
+        self._next_full_load = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def load(self, now, full=False):
+        """
+        Loads the pending notifications due before `now + window` into the heap.
+
+        Args:
+            now (datetime): The current time.
+            full (bool, optional): Read the whole window instead of only the new rows.
+
+        Returns:
+            int: The number of notifications added to the heap.
+        """
+        horizon = now + timedelta(seconds=self.window)
+        queryset = Notification.objects.filter(
+            deliver_at__isnull=False,
+            dispatched_at__isnull=True,
+            deliver_at__lte=horizon
+        )
+        if not full and self._loaded_until is not None:
+            queryset = queryset.filter(Q(deliver_at__gt=self._loaded_until) | Q(id__gt=self._max_id))
+
+        added = 0
+        for notification_id, deliver_at in queryset.values_list('id', 'deliver_at').iterator():
+            self._max_id = max(self._max_id, notification_id)
+            if notification_id in self._loaded_ids:
+                continue
+            self._loaded_ids.add(notification_id)
+            heapq.heappush(self._heap, (release_time(notification_id, deliver_at, self.jitter), notification_id))
+            added += 1
+        self._loaded_until = horizon
+        return added
+
+    def pop_due(self, now):
+        """
+        Pops up to `batch_size` notifications whose release time has come.
+
+        Returns:
+            list: Their IDs.
+        """
+        timestamp = now.timestamp()
+        notification_ids = []
+        while self._heap and self._heap[0][0] <= timestamp and len(notification_ids) < self.batch_size:
+            _, notification_id = heapq.heappop(self._heap)
+            self._loaded_ids.discard(notification_id)
+            notification_ids.append(notification_id)
+        return notification_ids
+
+    def run_once(self, now=None):
+        """
+        Loads the heap if a load is due and releases one batch of due notifications.
+
+        Args:
+            now (datetime, optional): The current time. Defaults to the current time.
+
+        Returns:
+            int: The number of notifications released.
+        """
+        now = now or timezone.now()
+        if self._next_full_load is None or now >= self._next_full_load:
+            self.load(now, full=True)
+            self._next_full_load = now + timedelta(seconds=self.window)
+            self._next_load = now + timedelta(seconds=self.poll_interval)
+        elif now >= self._next_load:
+            self.load(now)
+            self._next_load = now + timedelta(seconds=self.poll_interval)
+
+        notification_ids = self.pop_due(now)
+        if not notification_ids:
+            return 0
+        released = len(dispatch_notifications(notification_ids, now))
+        self.released += released
+        return released
+
+    def seconds_until_next(self, now=None):
+        """
+        Returns the number of seconds until the next release or load, to sleep until then.
+        """
+        now = now or timezone.now()
+        if self._next_load is None:
+            return 0.0
+        seconds = (self._next_load - now).total_seconds()
+        if self._heap:
+            seconds = min(seconds, self._heap[0][0] - now.timestamp())
+        return max(0.0, seconds)
@@ -0,0 +1,415 @@
+from collections import Counter, defaultdict
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection
+
+from auditlog.models import LogEntry
+
+from notification.models import Notification, NotificationSubscription, UserNotification
+from notification.services.audit import audit_bulk
+from notification.services.counters import (
+    bump_inbox_versions,
+    increment_inbox_counts,
+    increment_unread_counts,
+)
+from notification.services.subscribers import get_subscriber_ids, get_subscriber_ids_after
+from notification.services.websocket.notifications import (
+    broadcast_real_time_notification,
+    send_real_time_notifications,
+)
+
+
+def get_fanout_chunk_size():
+    """
+    Returns the number of UserNotification rows written per statement by the
+    chunked fan-out path.
+
+    Returns:
+        int: The value of NOTIFICATIONS_FANOUT_CHUNK_SIZE, defaults to 1000.
+    """
+    return getattr(settings, 'NOTIFICATIONS_FANOUT_CHUNK_SIZE', 1000)
+
+
+def tag_broadcast_is_enabled():
+    """
+    Checks whether real-time notifications are sent once to the group of their tag
+    instead of once to the group of each recipient.
+
+    Returns:
+        bool: The value of NOTIFICATIONS_TAG_BROADCAST, defaults to True.
+    """
+    return getattr(settings, 'NOTIFICATIONS_TAG_BROADCAST', True)
+
+
+def _chunked(iterable, size):
+    """
+    Yields lists of at most `size` items from `iterable`.
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def build_user_notification(notification, user_id):
+    """
+    Builds an unsaved UserNotification of a notification for a user, with the
+    denormalized timestamp and tag already set.
+    """
+    return UserNotification(
+        user_id=user_id,
+        notification=notification,
+        timestamp=notification.timestamp,
+        tag_id=notification.tag_id
+    )
+
+
+def supports_insert_select_returning():
+    """
+    Checks whether the current database can run the set-based fan-out, that is
+    an `INSERT ... SELECT ... ON CONFLICT DO NOTHING RETURNING` statement.
+
+    Returns:
+        bool: True for PostgreSQL and SQLite >= 3.35, False otherwise.
+    """
+    return (
+        connection.vendor in ('postgresql', 'sqlite')
+        and connection.features.can_return_rows_from_bulk_insert
+    )
+
+
+def _insert_from_subscriptions(notification):
+    """
+    Creates the UserNotification rows of a notification with a single
+    `INSERT ... SELECT` from the subscriptions of its tag.
+
+    Rows that already exist are skipped, so running it twice for the same
+    notification does not raise nor duplicate recipients.
+
+    Args:
+        notification (Notification): The notification being delivered.
+
+    Returns:
+        list: A list of (user_notification_id, user_id) tuples for the new rows.
+    """
+    quote_name = connection.ops.quote_name
+    user_notification_table = quote_name(UserNotification._meta.db_table)
+    subscription_table = quote_name(NotificationSubscription._meta.db_table)
+
+    timestamp_field = UserNotification._meta.get_field('timestamp')
+
+    columns = ', '.join(
+        quote_name(column)
+        for column in ('user_id', 'notification_id', 'is_read', 'is_deleted', 'timestamp', 'tag_id')
+    )
+
+    sql = (
+        f"INSERT INTO {user_notification_table} ({columns}) "
+        f"SELECT user_id, %s, %s, %s, %s, tag_id FROM {subscription_table} "
+        f"WHERE tag_id = %s ORDER BY user_id "
+        f"ON CONFLICT (user_id, notification_id) DO NOTHING "
+        f"RETURNING id, user_id"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [
+            notification.id,
+            False,
+            False,
+            timestamp_field.get_db_prep_value(notification.timestamp, connection),
+            notification.tag_id
+        ])
+        return [tuple(row) for row in cursor.fetchall()]
+
+
+def _bulk_create_in_chunks(notification, chunk_size):
+    """
+    Creates the UserNotification rows of a notification with one `bulk_create`
+    per chunk of subscribers.
+
+    Used on backends that cannot return rows from an `INSERT ... SELECT`. The
+    subscribers are read from the cached subscriber index of the tag.
+
+    Args:
+        notification (Notification): The notification being delivered.
+        chunk_size (int): The number of rows inserted per statement.
+
+    Returns:
+        list: A list of (user_notification_id, user_id) tuples for the new rows.
+    """
+    user_ids = get_subscriber_ids(notification.tag_id)
+
+    recipients = []
+    for chunk in _chunked(user_ids, chunk_size):
+        created = UserNotification.objects.bulk_create(
+            [build_user_notification(notification, user_id) for user_id in chunk],
+            batch_size=chunk_size
+        )
+        if all(user_notification.pk is not None for user_notification in created):
+            recipients.extend((user_notification.pk, user_notification.user_id) for user_notification in created)
+        else:
+            # The backend does not return primary keys from bulk inserts.
+            recipients.extend(
+                UserNotification.objects.filter(
+                    notification=notification,
+                    user_id__in=chunk
+                ).values_list(
+                    'id', 'user_id'
+                )
+            )
+    return recipients
+
+
+def _insert_many_from_subscriptions(notifications):
+    """
+    Creates the UserNotification rows of several notifications with a single
+    `INSERT ... SELECT` joining them to the subscriptions of their tags.
+
+    Args:
+        notifications (list): The notifications being delivered.
+
+    Returns:
+        list: A list of (user_notification_id, user_id, notification_id) tuples for the new rows.
+    """
+    quote_name = connection.ops.quote_name
+    user_notification_table = quote_name(UserNotification._meta.db_table)
+    subscription_table = quote_name(NotificationSubscription._meta.db_table)
+    notification_table = quote_name(Notification._meta.db_table)
+
+    columns = ', '.join(
+        quote_name(column)
+        for column in ('user_id', 'notification_id', 'is_read', 'is_deleted', 'timestamp', 'tag_id')
+    )
+    placeholders = ', '.join(['%s'] * len(notifications))
+
+    sql = (
+        f"INSERT INTO {user_notification_table} ({columns}) "
+        f"SELECT s.user_id, n.id, %s, %s, n.timestamp, n.tag_id "
+        f"FROM {notification_table} n INNER JOIN {subscription_table} s ON s.tag_id = n.tag_id "
+        f"WHERE n.id IN ({placeholders}) ORDER BY n.id, s.user_id "
+        f"ON CONFLICT (user_id, notification_id) DO NOTHING "
+        f"RETURNING id, user_id, notification_id"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [False, False, *(notification.id for notification in notifications)])
+        return [tuple(row) for row in cursor.fetchall()]
+
+
+def _bulk_create_many_in_chunks(notifications, chunk_size):
+    """
+    Creates the UserNotification rows of several notifications with one `bulk_create`
+    per chunk of rows, reading the subscribers of each tag once from its cached index.
+
+    Used on backends that cannot return rows from an `INSERT ... SELECT`.
+
+    Args:
+        notifications (list): The notifications being delivered.
+        chunk_size (int): The number of rows inserted per statement.
+
+    Returns:
+        list: A list of (user_notification_id, user_id, notification_id) tuples for the new rows.
+    """
+    subscribers = {
+        tag_id: get_subscriber_ids(tag_id)
+        for tag_id in {notification.tag_id for notification in notifications}
+    }
+    rows = (
+        build_user_notification(notification, user_id)
+        for notification in notifications
+        for user_id in subscribers[notification.tag_id]
+    )
+
+    recipients = []
+    returns_pks = True
+    for chunk in _chunked(rows, chunk_size):
+        created = UserNotification.objects.bulk_create(chunk, batch_size=chunk_size)
+        returns_pks = returns_pks and all(user_notification.pk is not None for user_notification in created)
+        recipients.extend(
+            (user_notification.pk, user_notification.user_id, user_notification.notification_id)
+            for user_notification in created
+        )
+    if not returns_pks:
+        # The backend does not return primary keys from bulk inserts.
+        recipients = list(
+            UserNotification.objects.filter(
+                notification__in=notifications
+            ).values_list(
+                'id', 'user_id', 'notification_id'
+            )
+        )
+    return recipients
+
+
+def audit_fan_out(notification, recipients):
+    """
+    Records the creation of the UserNotification rows of a fan-out, see `audit_bulk`.
+
+    Args:
+        notification (Notification): The notification being delivered.
+        recipients (list): A list of (user_notification_id, user_id) tuples.
+    """
+    audit_bulk(
+        UserNotification,
+        LogEntry.Action.CREATE,
+        [user_notification_id for user_notification_id, _ in recipients],
+        additional_data={'notification_id': notification.id}
+    )
+
+
+def fan_out_notification(notification, chunk_size=None):
+    """
+    Creates a UserNotification for every user subscribed to the tag of a notification.
+
+    The rows are written set-based instead of one INSERT per subscriber: a single
+    `INSERT ... SELECT` from NotificationSubscription when the database supports
+    returning rows from it, and chunked `bulk_create` otherwise. Rows created this
+    way do not go through `save()`, so no per-row signals are sent; the fan-out is
+    audited as a bulk operation instead, see `audit_bulk`.
+
+    Args:
+        notification (Notification): The notification being delivered.
+        chunk_size (int, optional): The number of rows per statement for the chunked
+            path. Defaults to NOTIFICATIONS_FANOUT_CHUNK_SIZE.
+
+    Returns:
+        list: A list of (user_notification_id, user_id) tuples, one per recipient,
+              ready to be passed to `send_real_time_notifications`.
+    """
+    if supports_insert_select_returning():
+        recipients = _insert_from_subscriptions(notification)
+    else:
+        recipients = _bulk_create_in_chunks(notification, chunk_size or get_fanout_chunk_size())
+    audit_fan_out(notification, recipients)
+    return recipients
+
+
+def fan_out_notifications(notifications, chunk_size=None):
+    """
+    Creates the UserNotification rows of a batch of new notifications at once.
+
+    Like `fan_out_notification`, but the rows of every notification are written
+    together: a single `INSERT ... SELECT` joining the notifications to the
+    subscriptions of their tags, or chunked `bulk_create` across the batch. The
+    whole fan-out is audited with a single `audit_bulk` call.
+
+    Args:
+        notifications (list): The notifications being delivered.
+        chunk_size (int, optional): The number of rows per statement for the chunked
+            path. Defaults to NOTIFICATIONS_FANOUT_CHUNK_SIZE.
+
+    Returns:
+        dict: The (user_notification_id, user_id) tuples of the recipients of each
+              notification, by notification id, ready to be passed to `deliver_notifications`.
+    """
+    if not notifications:
+        return {}
+    if supports_insert_select_returning():
+        rows = _insert_many_from_subscriptions(notifications)
+    else:
+        rows = _bulk_create_many_in_chunks(notifications, chunk_size or get_fanout_chunk_size())
+
+    recipients = {notification.id: [] for notification in notifications}
+    for user_notification_id, user_id, notification_id in rows:
+        recipients[notification_id].append((user_notification_id, user_id))
+    audit_bulk(
+        UserNotification,
+        LogEntry.Action.CREATE,
+        [user_notification_id for user_notification_id, _, _ in rows],
+        additional_data={'notification_ids': sorted(recipients)}
+    )
+    return recipients
+
+
+def fan_out_notification_chunk(notification, after_user_id, limit):
+    """
+    Creates the UserNotification rows for the next chunk of subscribers of a notification.
+
+    The chunk is made of the first `limit` subscribers whose user id is greater than
+    `after_user_id`, so a fan-out can be resumed from the last user id it delivered.
+    Rows that already exist are kept and returned as recipients too, which makes
+    replaying a chunk after a crash deliver it again instead of losing it. The
+    subscribers are read from the cached subscriber index of the tag, so a hot tag
+    does not query NotificationSubscription once per chunk.
+
+    Args:
+        notification (Notification): The notification being delivered.
+        after_user_id (int): The checkpoint, the highest user id already delivered.
+        limit (int): The maximum number of subscribers in the chunk.
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - A list of (user_notification_id, user_id) tuples for the chunk.
+            - The highest user id of the chunk, or None when there are no subscribers left.
+    """
+    user_ids = get_subscriber_ids_after(notification.tag_id, after_user_id, limit)
+    if not user_ids:
+        return [], None
+
+    UserNotification.objects.bulk_create(
+        [build_user_notification(notification, user_id) for user_id in user_ids],
+        ignore_conflicts=True
+    )
+    recipients = list(
+        UserNotification.objects.filter(
+            notification=notification,
+            user_id__in=user_ids
+        ).order_by(
+            'user_id'
+        ).values_list(
+            'id', 'user_id'
+        )
+    )
+    audit_fan_out(notification, recipients)
+    return recipients, user_ids[-1]
+
+
+def deliver_notification(notification, recipients):
+    """
+    Runs the side effects of a committed fan-out: increments the unread and inbox
+    counters and bumps the inbox versions of the recipients, and sends them the real-time
+    notification, through the group of the tag when NOTIFICATIONS_TAG_BROADCAST is enabled.
+
+    Args:
+        notification (Notification): The notification that was fanned out.
+        recipients (list): A list of (user_notification_id, user_id) tuples, as returned
+                           by `fan_out_notification` or `fan_out_notification_chunk`.
+    """
+    increment_unread_counts(user_id for _, user_id in recipients)
+    increment_inbox_counts(user_id for _, user_id in recipients)
+    bump_inbox_versions(user_id for _, user_id in recipients)
+    _send_real_time(notification, recipients)
+
+
+def deliver_notifications(notifications, recipients):
+    """
+    Runs the side effects of a committed batch fan-out, see `deliver_notification`.
+
+    The unread and inbox counters are incremented once per user for the whole batch, by the
+    number of notifications the user received in it.
+
+    Args:
+        notifications (list): The notifications that were fanned out.
+        recipients (dict): The recipients of each notification, as returned by `fan_out_notifications`.
+    """
+    counts = Counter(user_id for rows in recipients.values() for _, user_id in rows)
+    user_ids_by_delta = defaultdict(list)
+    for user_id, delta in counts.items():
+        user_ids_by_delta[delta].append(user_id)
+    for delta, user_ids in user_ids_by_delta.items():
+        increment_unread_counts(user_ids, delta)
+        increment_inbox_counts(user_ids, delta)
+    bump_inbox_versions(counts)
+
+    for notification in notifications:
+        if recipients[notification.id]:
+            _send_real_time(notification, recipients[notification.id])
+
+
+def _send_real_time(notification, recipients):
+    """
+    Sends a notification to its connected recipients, through the group of its tag
+    when NOTIFICATIONS_TAG_BROADCAST is enabled.
+    """
+    if tag_broadcast_is_enabled():
+        broadcast_real_time_notification(notification, recipients)
+    else:
+        send_real_time_notifications(notification, recipients)
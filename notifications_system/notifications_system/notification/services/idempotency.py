@@ -0,0 +1,226 @@
+import functools
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from notification.models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+# Seconds between two checks of a request waiting for a duplicate in progress.
+POLL_INTERVAL = 0.05
+
+
+def get_idempotency_ttl():
+    """
+    Returns the number of seconds the response of an idempotent request is kept.
+
+    A retry made later than this with the same key is processed as a new request.
+    """
+    return getattr(settings, 'NOTIFICATIONS_IDEMPOTENCY_TTL', 60 * 60 * 24)
+
+
+def get_idempotency_wait_timeout():
+    """
+    Returns the number of seconds a request waits for a duplicate in progress to finish.
+
+    It is also how long the lock of a request in progress lasts, so a process that
+    dies while holding it does not block its key for longer than this.
+    """
+    return getattr(settings, 'NOTIFICATIONS_IDEMPOTENCY_WAIT_TIMEOUT', 30)
+
+
+def _key_hash(key):
+    """
+    Returns a digest of an idempotency key, safe to be used in a cache key.
+    """
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def idempotency_cache_key(user_id, key):
+    """
+    Returns the cache key of the stored response of an idempotency key.
+    """
+    return f'idempotency_{user_id}_{_key_hash(key)}'
+
+
+def idempotency_lock_key(user_id, key):
+    """
+    Returns the cache key held while a request with an idempotency key is in progress.
+    """
+    return f'idempotency_lock_{user_id}_{_key_hash(key)}'
+
+
+def get_request_fingerprint(request):
+    """
+    Returns a hash of the method, the path and the parsed body of a request.
+
+    Args:
+        request (Request): The request.
+
+    Returns:
+        str: The hex digest.
+    """
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method} {request.path}\n{body}'.encode()).hexdigest()
+
+
+def get_stored_response(user_id, key):
+    """
+    Returns the stored response of an idempotency key from the database.
+
+    The response is cached again, so the following retries are answered from the
+    cache. An expired response is deleted and None is returned.
+
+    Args:
+        user_id (int): The ID of the user.
+        key (str): The idempotency key.
+
+    Returns:
+        tuple|None: The (fingerprint, status code, body) of the response, or None.
+    """
+    record = IdempotencyKey.objects.filter(user_id=user_id, key=key).first()
+    if record is None:
+        return None
+    ttl = get_idempotency_ttl() - (timezone.now() - record.created_at).total_seconds()
+    if ttl <= 0:
+        record.delete()
+        return None
+    stored = (record.fingerprint, record.status_code, record.response)
+    cache.set(idempotency_cache_key(user_id, key), stored, ttl)
+    return stored
+
+
+def replay(stored, fingerprint):
+    """
+    Builds the response of a retry from the stored response of its key.
+
+    Returns:
+        Response: The stored response, or 422 if the key was used with a different request.
+    """
+    stored_fingerprint, status_code, body = stored
+    if stored_fingerprint != fingerprint:
+        return Response(
+            {'detail': f'The {IDEMPOTENCY_HEADER} was already used with a different request.'},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    return Response(body, status=status_code, headers={REPLAYED_HEADER: 'true'})
+
+
+def run_idempotent(request, handler):
+    """
+    Runs a request that creates notifications at most once per Idempotency-Key header.
+
+    Requests without the header are run as usual. Otherwise the response is looked
+    up in the cache and then in the database, and replayed if found. A duplicate
+    that arrives while the first request is still in progress waits for it, up to
+    NOTIFICATIONS_IDEMPOTENCY_WAIT_TIMEOUT seconds, and then replays its response,
+    or gets 409 if it did not finish in time. A successful response is stored in
+    the same transaction as the notifications: if another process stored the key
+    first, the unique constraint makes the transaction roll back, so nothing is
+    created or fanned out twice, and its response is replayed instead. Responses
+    are kept NOTIFICATIONS_IDEMPOTENCY_TTL seconds; failed requests are not
+    stored and can be retried with the same key.
+
+    Args:
+        request (Request): The request.
+        handler (callable): Runs the request and returns its Response.
+
+    Returns:
+        Response: The response of the request or the replayed one.
+    """
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return handler()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return Response(
+            {'detail': f'The {IDEMPOTENCY_HEADER} header must have between 1 and {MAX_KEY_LENGTH} characters.'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    user_id = request.user.id
+    fingerprint = get_request_fingerprint(request)
+    cache_key = idempotency_cache_key(user_id, key)
+    lock_key = idempotency_lock_key(user_id, key)
+    wait_timeout = get_idempotency_wait_timeout()
+
+    deadline = time.monotonic() + wait_timeout
+    while True:
+        stored = cache.get(cache_key)
+        if stored is not None:
+            return replay(stored, fingerprint)
+        if cache.add(lock_key, True, wait_timeout):
+            break
+        if time.monotonic() >= deadline:
+            return Response(
+                {'detail': f'A request with the same {IDEMPOTENCY_HEADER} is still in progress.'},
+                status=status.HTTP_409_CONFLICT,
+                headers={'Retry-After': str(max(1, round(wait_timeout)))}
+            )
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        # The cache entry may have been evicted.
+        stored = get_stored_response(user_id, key)
+        if stored is not None:
+            return replay(stored, fingerprint)
+
+        try:
+            with transaction.atomic():
+                response = handler()
+                if not status.is_success(response.status_code):
+                    return response
+                IdempotencyKey.objects.create(
+                    user_id=user_id,
+                    key=key,
+                    fingerprint=fingerprint,
+                    status_code=response.status_code,
+                    response=response.data
+                )
+        except IntegrityError:
+            # Another process stored the key after its lock expired.
+            stored = get_stored_response(user_id, key)
+            if stored is None:
+                raise
+            return replay(stored, fingerprint)
+
+        cache.set(cache_key, (fingerprint, response.status_code, response.data), get_idempotency_ttl())
+        return response
+    finally:
+        cache.delete(lock_key)
+
+
+def idempotent(view_method):
+    """
+    Decorates a view method so it honours the Idempotency-Key header, see `run_idempotent`.
+    """
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        return run_idempotent(request, lambda: view_method(self, request, *args, **kwargs))
+    return wrapper
+
+
+def purge_expired_idempotency_keys(now=None):
+    """
+    Deletes the stored responses older than NOTIFICATIONS_IDEMPOTENCY_TTL.
+
+    Args:
+        now (datetime, optional): The reference time. Defaults to the current time.
+
+    Returns:
+        int: The number of responses deleted.
+    """
+    now = now or timezone.now()
+    deleted, _ = IdempotencyKey.objects.filter(
+        created_at__lt=now - timedelta(seconds=get_idempotency_ttl())
+    ).delete()
+    return deleted
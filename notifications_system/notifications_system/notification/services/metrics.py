@@ -0,0 +1,323 @@
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# Prefix of the cache keys where the processes aggregate their metrics.
+CACHE_PREFIX = 'metrics:'
+# Cache key of the list of series reported by any process.
+SERIES_KEY = 'metrics:series'
+# Histogram sums are aggregated as integers, in millionths.
+SUM_SCALE = 1_000_000
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+_NOOP_TIMER = nullcontext()
+
+
+def metrics_are_enabled():
+    """
+    Checks whether the metrics are recorded.
+
+    Returns:
+        bool: The value of NOTIFICATIONS_METRICS_ENABLED, defaults to False.
+    """
+    return getattr(settings, 'NOTIFICATIONS_METRICS_ENABLED', False)
+
+
+def get_flush_interval():
+    """
+    Returns the number of seconds between two flushes of the metrics of a process.
+    """
+    return getattr(settings, 'NOTIFICATIONS_METRICS_FLUSH_SECONDS', 5)
+
+
+# Read by the instrumented code before measuring anything, so disabled metrics cost
+# a single attribute lookup.
+ENABLED = metrics_are_enabled()
+
+
+@receiver(setting_changed)
+def _reload_enabled(setting, **kwargs):
+    global ENABLED
+    if setting == 'NOTIFICATIONS_METRICS_ENABLED':
+        ENABLED = metrics_are_enabled()
+
+
+def _sort_key(series):
+    """
+    Sorts the series by name and labels, with the histogram buckets in increasing order.
+    """
+    name, _, labels = series.partition('{')
+    pairs = [pair.split('=', 1) for pair in labels.rstrip('}').split(',') if pair]
+    bound = next((value.strip('"') for key, value in pairs if key == 'le'), None)
+    others = [pair for pair in pairs if pair[0] != 'le']
+    return name, others, float(bound) if bound is not None else 0.0
+
+
+def _series(name, labels):
+    """
+    Returns the Prometheus series name of a metric and its labels.
+    """
+    if not labels:
+        return name
+    pairs = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f'{name}{{{pairs}}}'
+
+
+class Registry:
+    """
+    In-process store of the metric deltas recorded since the last flush.
+
+    Recording a value only updates a dictionary under a lock. A daemon thread
+    periodically adds the deltas to counters in the Django cache, where every
+    process of the deployment aggregates its values, so the metrics are shared
+    when the cache is (e.g. Redis) and per process otherwise.
+
+    Attributes:
+        metrics (dict): The declared metrics, by name.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._deltas = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add(self, series, amount):
+        """
+        Adds an amount to the pending delta of a series.
+        """
+        self.add_many(((series, amount),))
+
+    def add_many(self, items):
+        """
+        Adds amounts to the pending deltas of several series.
+
+        Args:
+            items (iterable): (series, amount) tuples.
+        """
+        with self._lock:
+            for series, amount in items:
+                self._deltas[series] = self._deltas.get(series, 0) + amount
+        if self._flusher is None:
+            self._start_flusher()
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_forever, name='metrics-flusher', daemon=True)
+        self._flusher.start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(get_flush_interval())
+            try:
+                self.flush()
+            except Exception:
+                # The cache is unavailable, the deltas are kept for the next flush.
+                pass
+
+    def flush(self):
+        """
+        Adds the pending deltas of this process to the shared counters in the cache.
+        """
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        if not deltas:
+            return
+        try:
+            known = set(cache.get(SERIES_KEY) or ())
+            if not known.issuperset(deltas):
+                cache.set(SERIES_KEY, sorted(known.union(deltas)), None)
+            for series, delta in deltas.items():
+                key = CACHE_PREFIX + series
+                cache.add(key, 0, None)
+                cache.incr(key, int(delta))
+        except Exception:
+            with self._lock:
+                for series, delta in deltas.items():
+                    self._deltas[series] = self._deltas.get(series, 0) + delta
+            raise
+
+    def collect(self):
+        """
+        Returns the aggregated value of every series reported by any process.
+
+        Returns:
+            dict: The values by series name.
+        """
+        series = cache.get(SERIES_KEY) or []
+        values = cache.get_many([CACHE_PREFIX + name for name in series])
+        return {name[len(CACHE_PREFIX):]: value for name, value in values.items()}
+
+    def render(self):
+        """
+        Renders the aggregated metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics, one block per declared metric.
+        """
+        values = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            for series in sorted(values, key=_sort_key):
+                base = series.split('{', 1)[0]
+                if base == name or (metric.type == 'histogram' and base in metric.series_names):
+                    value = values[series]
+                    if base.endswith('_sum'):
+                        value = value / SUM_SCALE
+                    lines.append(f'{series} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Metric:
+    """
+    Base class of the metrics, declared once at import time.
+
+    Attributes:
+        name (str): The Prometheus name.
+        help (str): The description.
+    """
+
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        registry.register(self)
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, e.g. the number of handshake failures.
+    """
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if ENABLED:
+            registry.add(_series(self.name, labels), amount)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, e.g. the number of open connections. Every
+    process adds its own increments, so the aggregated value is the deployment total.
+    """
+
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        if ENABLED:
+            registry.add(_series(self.name, labels), amount)
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, in cumulative buckets.
+
+    Attributes:
+        buckets (tuple): The upper bounds of the buckets, `+Inf` is implicit.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DURATION_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.series_names = {f'{name}_bucket', f'{name}_sum', f'{name}_count'}
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        items = [
+            (_series(f'{self.name}_bucket', {**labels, 'le': bound}), 1)
+            for bound in self.buckets
+            if value <= bound
+        ]
+        items.append((_series(f'{self.name}_bucket', {**labels, 'le': '+Inf'}), 1))
+        items.append((_series(f'{self.name}_sum', labels), value * SUM_SCALE))
+        items.append((_series(f'{self.name}_count', labels), 1))
+        registry.add_many(items)
+
+    def time(self, **labels):
+        """
+        Returns a context manager that observes the duration of its block, in seconds.
+        """
+        if not ENABLED:
+            return _NOOP_TIMER
+        return self._time(labels)
+
+    @contextmanager
+    def _time(self, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+fanout_duration = Histogram(
+    'notifications_fanout_duration_seconds',
+    'Time spent creating the UserNotification rows of a fan-out, or of an outbox chunk.'
+)
+fanout_size = Histogram(
+    'notifications_fanout_recipients',
+    'Number of recipients of a fan-out, or of an outbox chunk.',
+    buckets=SIZE_BUCKETS
+)
+group_send_duration = Histogram(
+    'notifications_group_send_duration_seconds',
+    'Time spent sending the real-time notifications of a fan-out to the channel layer.'
+)
+lane_wait = Histogram(
+    'notifications_lane_wait_seconds',
+    'Time a fan-out chunk or a real-time push of the outbox worker waited in its lane, by lane and queue.'
+)
+ws_message_db_duration = Histogram(
+    'notifications_ws_message_db_duration_seconds',
+    'Database time spent handling a WebSocket message, by message type.'
+)
+ws_message_queries = Counter(
+    'notifications_ws_message_queries_total',
+    'Queries executed handling WebSocket messages, by message type.'
+)
+ws_messages = Counter(
+    'notifications_ws_messages_total',
+    'WebSocket messages received, by message type.'
+)
+ws_throttled = Counter(
+    'notifications_ws_throttled_total',
+    'WebSocket messages rejected by the rate limits, by message type.'
+)
+ws_connections = Gauge(
+    'notifications_ws_connections',
+    'Open WebSocket connections.'
+)
+ws_groups = Gauge(
+    'notifications_ws_groups',
+    'Channel layer group memberships of the open WebSocket connections.'
+)
+ws_handshake_failures = Counter(
+    'notifications_ws_handshake_failures_total',
+    'Rejected WebSocket handshakes, by reason.'
+)
@@ -0,0 +1,259 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from notification.models import NotificationOutbox
+from notification.services import metrics
+from notification.services.fanout import (
+    deliver_notification,
+    fan_out_notification_chunk,
+    get_fanout_chunk_size,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def fanout_is_async():
+    """
+    Checks whether notifications are fanned out by the outbox worker instead of
+    inside the request that creates them.
+
+    Returns:
+        bool: The value of NOTIFICATIONS_FANOUT_ASYNC, defaults to False.
+    """
+    return getattr(settings, 'NOTIFICATIONS_FANOUT_ASYNC', False)
+
+
+def get_outbox_max_attempts():
+    """
+    Returns the number of times a fan-out is attempted before it is marked as failed.
+    """
+    return getattr(settings, 'NOTIFICATIONS_OUTBOX_MAX_ATTEMPTS', 5)
+
+
+def get_outbox_lease_seconds():
+    """
+    Returns the number of seconds a worker owns a claimed fan-out without reporting progress.
+    """
+    return getattr(settings, 'NOTIFICATIONS_OUTBOX_LEASE_SECONDS', 60)
+
+
+def enqueue_fanout(notification):
+    """
+    Writes the outbox row of a notification.
+
+    Must be called inside the transaction that creates the notification, so the
+    fan-out is enqueued if and only if the notification is committed.
+
+    Args:
+        notification (Notification): The notification to be fanned out.
+
+    Returns:
+        NotificationOutbox: The created outbox row.
+    """
+    return NotificationOutbox.objects.create(notification=notification, priority=notification.priority)
+
+
+def enqueue_fanouts(notifications):
+    """
+    Writes the outbox rows of several notifications with a single INSERT, see `enqueue_fanout`.
+
+    Args:
+        notifications (list): The notifications to be fanned out.
+
+    Returns:
+        list: The created outbox rows.
+    """
+    return NotificationOutbox.objects.bulk_create(
+        [
+            NotificationOutbox(notification=notification, priority=notification.priority)
+            for notification in notifications
+        ]
+    )
+
+
+def claim_outbox_items(limit, priority=None):
+    """
+    Claims up to `limit` fan-outs that are ready to be processed, optionally of a single priority.
+
+    A fan-out is ready when it is pending and available, or when the lease of the
+    worker that was processing it expired, that is the worker crashed or stalled.
+    Claimed rows are leased to the caller and their attempts are incremented.
+    Concurrent workers skip the rows locked by each other on databases that
+    support `SKIP LOCKED`.
+
+    Args:
+        limit (int): The maximum number of fan-outs to claim.
+        priority (str, optional): The lane to claim from. Defaults to every lane.
+
+    Returns:
+        list: The claimed NotificationOutbox instances.
+    """
+    now = timezone.now()
+    # Locks the outbox rows only, not the joined notifications.
+    queryset = NotificationOutbox.objects.select_for_update(skip_locked=True, of=('self',))
+    if priority is not None:
+        queryset = queryset.filter(priority=priority)
+    with transaction.atomic():
+        items = list(
+            queryset.select_related(
+                'notification'
+            ).filter(
+                Q(status=NotificationOutbox.PENDING, available_at__lte=now)
+                | Q(status=NotificationOutbox.PROCESSING, locked_until__lte=now)
+            ).order_by(
+                'available_at', 'id'
+            )[:limit]
+        )
+        if not items:
+            return []
+
+        locked_until = now + timedelta(seconds=get_outbox_lease_seconds())
+        NotificationOutbox.objects.filter(
+            id__in=[item.id for item in items]
+        ).update(
+            status=NotificationOutbox.PROCESSING,
+            locked_until=locked_until,
+            attempts=F('attempts') + 1
+        )
+        for item in items:
+            item.status = NotificationOutbox.PROCESSING
+            item.locked_until = locked_until
+            item.attempts += 1
+        return items
+
+
+def renew_outbox_leases(items):
+    """
+    Extends the lease of claimed fan-outs that are waiting to be processed, with a single UPDATE.
+
+    Args:
+        items (list): NotificationOutbox instances claimed with `claim_outbox_items`.
+    """
+    if not items:
+        return
+    locked_until = timezone.now() + timedelta(seconds=get_outbox_lease_seconds())
+    NotificationOutbox.objects.filter(
+        id__in=[item.id for item in items]
+    ).update(
+        locked_until=locked_until
+    )
+    for item in items:
+        item.locked_until = locked_until
+
+
+def fan_out_outbox_chunk(item, chunk_size):
+    """
+    Creates the UserNotification rows of the next chunk of a claimed fan-out.
+
+    When there are no subscribers left the fan-out is marked as done.
+
+    Args:
+        item (NotificationOutbox): A fan-out claimed with `claim_outbox_items`.
+        chunk_size (int): The number of subscribers per chunk.
+
+    Returns:
+        tuple|None: The recipients of the chunk and its highest user id, to be passed
+                    to `deliver_outbox_chunk`, or None when the fan-out is done.
+    """
+    with metrics.fanout_duration.time(path='outbox'), transaction.atomic():
+        recipients, last_user_id = fan_out_notification_chunk(
+            item.notification, item.last_user_id, chunk_size
+        )
+    if last_user_id is None:
+        item.status = NotificationOutbox.DONE
+        item.locked_until = None
+        item.last_error = ''
+        item.save(update_fields=['status', 'locked_until', 'last_error'])
+        return None
+    metrics.fanout_size.observe(len(recipients), path='outbox')
+    return recipients, last_user_id
+
+
+def deliver_outbox_chunk(item, recipients, last_user_id):
+    """
+    Sends the real-time notifications of a chunk created by `fan_out_outbox_chunk`
+    and then saves the checkpoint of the fan-out.
+
+    Args:
+        item (NotificationOutbox): The fan-out.
+        recipients (list): The recipients of the chunk.
+        last_user_id (int): The highest user id of the chunk.
+    """
+    deliver_notification(item.notification, recipients)
+
+    item.last_user_id = last_user_id
+    item.locked_until = timezone.now() + timedelta(seconds=get_outbox_lease_seconds())
+    item.save(update_fields=['last_user_id', 'locked_until'])
+
+
+def process_outbox_item(item, chunk_size=None):
+    """
+    Fans out a claimed notification chunk by chunk.
+
+    Each chunk creates the UserNotification rows, sends the real-time notifications
+    and then saves the checkpoint, so a fan-out interrupted at any point resumes
+    from the last delivered chunk. A chunk can be delivered twice after a crash,
+    but never lost. The `run_fanout_worker` command interleaves the chunks of
+    several fan-outs by priority instead, see `DeliveryScheduler`.
+
+    Args:
+        item (NotificationOutbox): A fan-out claimed with `claim_outbox_items`.
+        chunk_size (int, optional): The number of subscribers per chunk.
+            Defaults to NOTIFICATIONS_FANOUT_CHUNK_SIZE.
+    """
+    chunk_size = chunk_size or get_fanout_chunk_size()
+    while True:
+        chunk = fan_out_outbox_chunk(item, chunk_size)
+        if chunk is None:
+            break
+        deliver_outbox_chunk(item, *chunk)
+
+
+def fail_outbox_item(item, error):
+    """
+    Records a failed attempt of a fan-out.
+
+    The fan-out is scheduled again with an exponential backoff, keeping its
+    checkpoint, or marked as failed once it reached the maximum number of attempts.
+
+    Args:
+        item (NotificationOutbox): The fan-out that failed.
+        error (Exception): The error raised while processing it.
+    """
+    item.last_error = repr(error)
+    item.locked_until = None
+    if item.attempts >= get_outbox_max_attempts():
+        item.status = NotificationOutbox.FAILED
+    else:
+        item.status = NotificationOutbox.PENDING
+        item.available_at = timezone.now() + timedelta(seconds=min(2 ** item.attempts, 300))
+    item.save(update_fields=['status', 'available_at', 'locked_until', 'last_error'])
+
+
+def process_outbox(batch_size=10, chunk_size=None):
+    """
+    Claims and processes one batch of fan-outs.
+
+    Args:
+        batch_size (int, optional): The maximum number of fan-outs to claim. Defaults to 10.
+        chunk_size (int, optional): The number of subscribers per chunk.
+
+    Returns:
+        int: The number of fan-outs claimed.
+    """
+    items = claim_outbox_items(batch_size)
+    for item in items:
+        if item.attempts > get_outbox_max_attempts():
+            fail_outbox_item(item, RuntimeError('Maximum number of attempts exceeded.'))
+            continue
+        try:
+            process_outbox_item(item, chunk_size)
+        except Exception as error:
+            logger.exception('Fan-out of notification %s failed.', item.notification_id)
+            fail_outbox_item(item, error)
+    return len(items)
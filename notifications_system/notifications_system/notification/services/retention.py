@@ -0,0 +1,240 @@
+from collections import Counter
+from datetime import timedelta
+
+from auditlog.models import LogEntry
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from notification.models import Notification, NotificationOutbox, UserNotification
+from notification.services.audit import audit_bulk
+from notification.services.counters import (
+    bump_inbox_versions,
+    decrement_inbox_count,
+    decrement_unread_count,
+)
+
+
+def get_retention_days():
+    """
+    Returns the number of days a UserNotification is kept, 0 keeps them forever.
+    """
+    return getattr(settings, 'NOTIFICATIONS_RETENTION_DAYS', 365)
+
+
+def get_deleted_retention_days():
+    """
+    Returns the number of days a soft-deleted UserNotification is kept, counted from
+    the creation of its notification.
+    """
+    return getattr(settings, 'NOTIFICATIONS_DELETED_RETENTION_DAYS', 30)
+
+
+def get_orphan_grace_hours():
+    """
+    Returns the number of hours a Notification without UserNotification rows is kept.
+    """
+    return getattr(settings, 'NOTIFICATIONS_ORPHAN_GRACE_HOURS', 24)
+
+
+def get_expired_user_notifications(retention_days, deleted_retention_days, now=None):
+    """
+    Returns the UserNotification rows that are past their retention period.
+
+    Args:
+        retention_days (int): Rows older than this are expired, 0 disables this policy.
+        deleted_retention_days (int|None): Soft-deleted rows older than this are
+            expired, None disables this policy.
+        now (datetime, optional): The reference time. Defaults to the current time.
+
+    Returns:
+        QuerySet: The expired rows, empty when both policies are disabled.
+    """
+    now = now or timezone.now()
+    condition = Q(pk__in=[])
+    if retention_days:
+        condition |= Q(timestamp__lt=now - timedelta(days=retention_days))
+    if deleted_retention_days is not None:
+        condition |= Q(is_deleted=True, timestamp__lt=now - timedelta(days=deleted_retention_days))
+    return UserNotification.objects.filter(condition)
+
+
+def delete_by_ids(model, field_name, values, using):
+    """
+    Deletes the rows of a model whose field is one of the values, with a single
+    DELETE statement.
+
+    The statement is run on a cursor on purpose: no instance is loaded and the
+    deletion collector does not run, so neither the per-row signals (auditlog would
+    write one entry per row) nor the foreign key cascades happen. The callers delete
+    the referencing rows first and audit the deletion with `audit_bulk`.
+
+    Args:
+        model (Model): The model of the rows.
+        field_name (str): The name of the field, e.g. 'id'.
+        values (list): The values of the rows to delete.
+        using (str): The database alias.
+
+    Returns:
+        int: The number of rows deleted.
+    """
+    if not values:
+        return 0
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    column = model._meta.get_field(field_name).column
+    placeholders = ', '.join(['%s'] * len(values))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {quote_name(model._meta.db_table)} WHERE {quote_name(column)} IN ({placeholders})',
+            list(values)
+        )
+        return cursor.rowcount
+
+
+def get_orphan_notifications(grace_hours, retention_days, deleted_retention_days, now=None):
+    """
+    Returns the notifications that no UserNotification references any more.
+
+    A notification is only an orphan once it is older than the shortest enabled
+    retention period, the earliest its rows may have been purged: a notification
+    fanned out to no one, e.g. because its tag had no subscribers, is kept as long
+    as its rows would have been. With both policies disabled no row is purged, so
+    there are no orphans.
+
+    Notifications younger than the grace period, scheduled and not released yet, or
+    whose fan-out is still pending, processing or failed in the outbox, are not
+    orphans: their rows may still be created. Neither are the notifications merged
+    into a digest, which are never fanned out and go with their digest, nor the
+    digests still open, which may merge more notifications.
+
+    Args:
+        grace_hours (int): The minimum age of an orphan, in hours.
+        retention_days (int): The retention period of UserNotification rows, 0 if disabled.
+        deleted_retention_days (int|None): The retention period of soft-deleted rows,
+            None if disabled.
+        now (datetime, optional): The reference time. Defaults to the current time.
+
+    Returns:
+        QuerySet: The orphan notifications.
+    """
+    now = now or timezone.now()
+    periods = [timedelta(days=retention_days)] if retention_days else []
+    if deleted_retention_days is not None:
+        periods.append(timedelta(days=deleted_retention_days))
+    if not periods:
+        return Notification.objects.none()
+
+    return Notification.objects.filter(
+        timestamp__lt=now - max(timedelta(hours=grace_hours), min(periods))
+    ).exclude(
+        Exists(UserNotification.objects.filter(notification_id=OuterRef('pk')))
+    ).exclude(
+        deliver_at__isnull=False, dispatched_at__isnull=True
+    ).exclude(
+        digest__isnull=False
+    ).exclude(
+        digest_until__gt=now
+    ).exclude(
+        outbox__status__in=[
+            NotificationOutbox.PENDING,
+            NotificationOutbox.PROCESSING,
+            NotificationOutbox.FAILED
+        ]
+    )
+
+
+def purge_user_notifications_chunk(queryset, after_id, limit):
+    """
+    Deletes the next chunk of rows of a UserNotification queryset.
+
+    The chunk is made of the first `limit` rows whose id is greater than `after_id`,
+    found by walking the primary key index, and is deleted by id in its own short
+    transaction. The rows are deleted without loading them or sending per-row
+    signals; the deletion is audited as a bulk operation, the unread counters of
+    the owners of unread rows are decremented, and the inbox counters and versions
+    of the owners of rows that were not soft-deleted are updated.
+
+    Args:
+        queryset (QuerySet): The rows to purge, see `get_expired_user_notifications`.
+        after_id (int): The checkpoint, the highest id already processed.
+        limit (int): The maximum number of rows in the chunk.
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - The number of rows deleted.
+            - The highest id of the chunk, or None when there are no rows left.
+    """
+    with transaction.atomic():
+        rows = list(
+            queryset.filter(
+                id__gt=after_id
+            ).order_by(
+                'id'
+            ).values_list(
+                'id', 'user_id', 'is_read', 'is_deleted'
+            )[:limit]
+        )
+        if not rows:
+            return 0, None
+
+        ids = [row[0] for row in rows]
+        deleted = delete_by_ids(UserNotification, 'id', ids, queryset.db)
+        audit_bulk(
+            UserNotification, LogEntry.Action.DELETE, ids,
+            additional_data={'reason': 'retention'}
+        )
+
+    unread = Counter(user_id for _, user_id, is_read, is_deleted in rows if not is_read and not is_deleted)
+    for user_id, count in unread.items():
+        decrement_unread_count(user_id, count)
+    visible = Counter(user_id for _, user_id, _, is_deleted in rows if not is_deleted)
+    for user_id, count in visible.items():
+        decrement_inbox_count(user_id, count)
+    bump_inbox_versions(visible)
+    return deleted, ids[-1]
+
+
+def purge_orphan_notifications_chunk(queryset, after_id, limit):
+    """
+    Deletes the next chunk of orphan notifications, together with their outbox rows
+    and the notifications merged into them.
+
+    Args:
+        queryset (QuerySet): The notifications to purge, see `get_orphan_notifications`.
+        after_id (int): The checkpoint, the highest id already processed.
+        limit (int): The maximum number of notifications in the chunk.
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - The number of notifications deleted, the merged ones included.
+            - The highest id of the chunk, or None when there are no notifications left.
+    """
+    with transaction.atomic():
+        orphan_ids = list(
+            queryset.filter(
+                id__gt=after_id
+            ).order_by(
+                'id'
+            ).values_list(
+                'id', flat=True
+            )[:limit]
+        )
+        if not orphan_ids:
+            return 0, None
+
+        # The merged notifications and the outbox rows first, the foreign keys are not
+        # cascaded by `delete_by_ids`.
+        merged_ids = list(
+            Notification.objects.filter(digest_id__in=orphan_ids).values_list('id', flat=True)
+        )
+        ids = merged_ids + orphan_ids
+        delete_by_ids(NotificationOutbox, 'notification', ids, queryset.db)
+        deleted = delete_by_ids(Notification, 'id', merged_ids, queryset.db)
+        deleted += delete_by_ids(Notification, 'id', orphan_ids, queryset.db)
+        audit_bulk(
+            Notification, LogEntry.Action.DELETE, ids,
+            additional_data={'reason': 'orphan'}
+        )
+    return deleted, orphan_ids[-1]
@@ -0,0 +1,216 @@
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+
+from notification.models import Notification
+from notification.services import metrics
+from notification.services.fanout import get_fanout_chunk_size
+from notification.services.outbox import (
+    claim_outbox_items,
+    deliver_outbox_chunk,
+    fail_outbox_item,
+    fan_out_outbox_chunk,
+    get_outbox_max_attempts,
+    renew_outbox_leases,
+)
+
+logger = logging.getLogger(__name__)
+
+FANOUT = 'fanout'
+PUSH = 'push'
+
+
+def get_lane_weights():
+    """
+    Returns the share of the work of the outbox worker given to each priority lane
+    while several of them have work.
+
+    A lane with weight 0 only runs when the others are idle.
+
+    Returns:
+        dict: The weight of each priority, defaults to {'high': 8, 'normal': 3, 'low': 1}.
+    """
+    return getattr(
+        settings, 'NOTIFICATIONS_LANE_WEIGHTS',
+        {Notification.HIGH: 8, Notification.NORMAL: 3, Notification.LOW: 1}
+    )
+
+
+def get_refill_interval():
+    """
+    Returns the number of seconds between two claims of new fan-outs by a busy worker,
+    that is how long a new high priority fan-out may wait for a worker to notice it.
+    """
+    return getattr(settings, 'NOTIFICATIONS_SCHEDULER_REFILL_SECONDS', 0.5)
+
+
+class Lane:
+    """
+    The queues of a priority: the fan-out chunks to be created and the real-time
+    pushes of the chunks already created.
+
+    Attributes:
+        priority (str): The priority of the lane.
+        weight (int): The share of the work of the lane, see `get_lane_weights`.
+        fanout (deque): (NotificationOutbox, ready time) pairs, a fan-out waiting for its next chunk.
+        push (deque): (NotificationOutbox, recipients, last user id, ready time) tuples,
+            a created chunk waiting for its real-time push.
+        credit (int): The smooth weighted round-robin counter of the lane.
+    """
+
+    __slots__ = ('priority', 'weight', 'fanout', 'push', 'credit')
+
+    def __init__(self, priority, weight):
+        self.priority = priority
+        self.weight = weight
+        self.fanout = deque()
+        self.push = deque()
+        self.credit = 0
+
+    def __len__(self):
+        return len(self.fanout) + len(self.push)
+
+
+class DeliveryScheduler:
+    """
+    Schedules the work of the outbox worker in priority lanes, one step at a time.
+
+    Each priority of Notification has a lane with two queues: fan-out, the claimed
+    fan-outs waiting for their next chunk of UserNotification rows, and push, the
+    chunks already created waiting for their real-time notifications. Every step
+    picks a lane by smooth weighted round-robin among the lanes with work, so each
+    lane gets its weight's share of the steps, and runs one unit of it: the push of
+    a chunk first, then the next chunk of a fan-out. A fan-out goes back to the
+    queue after every chunk, so a 100k-recipient low priority blast is preempted
+    between its chunks as soon as a high priority fan-out is claimed. The checkpoint
+    of a fan-out is saved after the push of each chunk, as in `process_outbox_item`.
+
+    New fan-outs are claimed per lane, up to `batch_size` in flight each, whenever
+    the worker is idle and at most every `refill_interval` seconds while busy; the
+    leases of the fan-outs waiting in the queues are renewed at the same time. The
+    time each unit waited in its queue is observed in `notifications_lane_wait_seconds`,
+    from the time the fan-out became available for the first chunk.
+
+    Attributes:
+        batch_size (int): The maximum number of fan-outs in flight per lane.
+        chunk_size (int): The number of subscribers per chunk.
+        refill_interval (float): The seconds between two claims while busy.
+        lanes (list): The Lane of each priority, highest first.
+        claimed (int): The number of fan-outs claimed so far.
+    """
+
+    def __init__(self, batch_size=10, chunk_size=None, weights=None, refill_interval=None):
+        weights = get_lane_weights() if weights is None else weights
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size or get_fanout_chunk_size()
+        self.refill_interval = get_refill_interval() if refill_interval is None else refill_interval
+        self.lanes = [Lane(priority, weights.get(priority, 1)) for priority in Notification.PRIORITIES]
+        self.claimed = 0
+        self._last_refill = None
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def refill(self):
+        """
+        Claims new fan-outs for the lanes that have room and renews the leases of the waiting ones.
+
+        Returns:
+            int: The number of fan-outs claimed.
+        """
+        self._last_refill = time.monotonic()
+        renew_outbox_leases([
+            entry[0] for lane in self.lanes for queue in (lane.fanout, lane.push) for entry in queue
+        ])
+
+        claimed = 0
+        for lane in self.lanes:
+            room = self.batch_size - len(lane)
+            if room <= 0:
+                continue
+            for item in claim_outbox_items(room, priority=lane.priority):
+                claimed += 1
+                if item.attempts > get_outbox_max_attempts():
+                    fail_outbox_item(item, RuntimeError('Maximum number of attempts exceeded.'))
+                    continue
+                lane.fanout.append((item, item.available_at.timestamp()))
+        self.claimed += claimed
+        return claimed
+
+    def next_lane(self):
+        """
+        Picks the lane of the next step by smooth weighted round-robin.
+
+        Every lane with work earns its weight and the richest one runs and pays the
+        total; lanes without work lose their credit, so an idle lane cannot save up
+        steps. Ties go to the highest priority.
+
+        Returns:
+            Lane|None: The lane, or None when no lane has work.
+        """
+        active = []
+        for lane in self.lanes:
+            if len(lane):
+                active.append(lane)
+            else:
+                lane.credit = 0
+        if not active:
+            return None
+        for lane in active:
+            lane.credit += lane.weight
+        selected = max(active, key=lambda lane: lane.credit)
+        selected.credit -= sum(lane.weight for lane in active)
+        return selected
+
+    def step(self):
+        """
+        Runs one unit of work: the real-time push of a chunk or the next chunk of a fan-out.
+
+        Returns:
+            bool: False when there was nothing to do.
+        """
+        if (
+            not len(self)
+            or self._last_refill is None
+            or time.monotonic() - self._last_refill >= self.refill_interval
+        ):
+            self.refill()
+        lane = self.next_lane()
+        if lane is None:
+            return False
+        if lane.push:
+            self.run_push(lane)
+        else:
+            self.run_chunk(lane)
+        return True
+
+    def run_chunk(self, lane):
+        """
+        Creates the next chunk of the first fan-out of a lane and queues its push.
+        """
+        item, ready_at = lane.fanout.popleft()
+        metrics.lane_wait.observe(max(0.0, time.time() - ready_at), lane=lane.priority, queue=FANOUT)
+        try:
+            chunk = fan_out_outbox_chunk(item, self.chunk_size)
+        except Exception as error:
+            logger.exception('Fan-out of notification %s failed.', item.notification_id)
+            fail_outbox_item(item, error)
+            return
+        if chunk is not None:
+            lane.push.append((item, *chunk, time.time()))
+
+    def run_push(self, lane):
+        """
+        Sends the real-time notifications of the first chunk of a lane and queues its fan-out again.
+        """
+        item, recipients, last_user_id, ready_at = lane.push.popleft()
+        metrics.lane_wait.observe(max(0.0, time.time() - ready_at), lane=lane.priority, queue=PUSH)
+        try:
+            deliver_outbox_chunk(item, recipients, last_user_id)
+        except Exception as error:
+            logger.exception('Fan-out of notification %s failed.', item.notification_id)
+            fail_outbox_item(item, error)
+            return
+        lane.fanout.append((item, time.time()))
@@ -0,0 +1,173 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+from django.core.cache import cache
+
+from notification.models import NotificationSubscription
+
+# Signed 64-bit integers, 8 bytes per subscriber.
+TYPECODE = 'q'
+
+
+def get_subscriber_index_timeout():
+    """
+    Returns the number of seconds a subscriber index is kept in the cache.
+
+    The indexes are patched on every subscription change made through the ORM, so
+    this only bounds how long one stays stale after a change that bypassed the
+    signals (e.g. `bulk_create` or a raw query).
+    """
+    return getattr(settings, 'NOTIFICATIONS_SUBSCRIBER_INDEX_TIMEOUT', 60 * 60)
+
+
+def subscriber_index_key(tag_id):
+    """
+    Returns the cache key of the subscriber index of a tag.
+    """
+    return f'tag_subscribers_{tag_id}'
+
+
+def subscriber_version_key(tag_id):
+    """
+    Returns the cache key of the version of the subscriber index of a tag.
+    """
+    return f'tag_subscribers_version_{tag_id}'
+
+
+def _get_version(tag_id):
+    """
+    Returns the current version of the subscriber index of a tag, creating it if needed.
+    """
+    key = subscriber_version_key(tag_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 1, None)
+        version = cache.get(key, 1)
+    return version
+
+
+def _bump_version(tag_id):
+    """
+    Increments the version of the subscriber index of a tag.
+
+    Returns:
+        int: The new version.
+    """
+    key = subscriber_version_key(tag_id)
+    cache.add(key, 0, None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # The version was evicted after `add`.
+        cache.add(key, 1, None)
+        return cache.get(key, 1)
+
+
+def rebuild_subscriber_index(tag_id, version=None):
+    """
+    Loads the IDs of the subscribers of a tag from the database and caches them.
+
+    Args:
+        tag_id (int): The ID of the tag.
+        version (int, optional): The version read before the query. Defaults to the current one.
+
+    Returns:
+        array: The sorted user IDs.
+    """
+    if version is None:
+        version = _get_version(tag_id)
+    user_ids = array(
+        TYPECODE,
+        NotificationSubscription.objects.filter(
+            tag_id=tag_id
+        ).order_by(
+            'user_id'
+        ).values_list(
+            'user_id', flat=True
+        )
+    )
+    cache.set(subscriber_index_key(tag_id), (version, user_ids.tobytes()), get_subscriber_index_timeout())
+    return user_ids
+
+
+def get_subscriber_ids(tag_id):
+    """
+    Returns the IDs of the users subscribed to a tag, sorted.
+
+    The IDs are kept in the cache as the bytes of an `array` of 64-bit integers
+    stamped with the version of the index, which is bumped on every change. An
+    index whose stamp is not the current version is rebuilt from the database,
+    so the database is only queried the first time a tag is used after a change
+    that could not be patched in place.
+
+    Args:
+        tag_id (int): The ID of the tag.
+
+    Returns:
+        array: The sorted user IDs.
+    """
+    values = cache.get_many([subscriber_index_key(tag_id), subscriber_version_key(tag_id)])
+    entry = values.get(subscriber_index_key(tag_id))
+    version = values.get(subscriber_version_key(tag_id))
+    if entry is not None and version is not None and entry[0] == version:
+        user_ids = array(TYPECODE)
+        user_ids.frombytes(entry[1])
+        return user_ids
+    return rebuild_subscriber_index(tag_id, version if version is not None else _get_version(tag_id))
+
+
+def get_subscriber_ids_after(tag_id, after_user_id, limit):
+    """
+    Returns up to `limit` subscribers of a tag whose user ID is greater than `after_user_id`.
+
+    Args:
+        tag_id (int): The ID of the tag.
+        after_user_id (int): The exclusive lower bound.
+        limit (int): The maximum number of IDs.
+
+    Returns:
+        list: The sorted user IDs.
+    """
+    user_ids = get_subscriber_ids(tag_id)
+    start = bisect_right(user_ids, after_user_id)
+    return user_ids[start:start + limit].tolist()
+
+
+def patch_subscriber_index(tag_id, user_id, subscribed):
+    """
+    Adds a user to, or removes it from, the cached subscriber index of a tag.
+
+    The version is bumped first. The index is patched in place only if it was
+    stamped with the previous version, that is no other process changed it in the
+    meantime; otherwise it is left stale and rebuilt by the next reader.
+
+    Args:
+        tag_id (int): The ID of the tag.
+        user_id (int): The ID of the user.
+        subscribed (bool): True to add the user, False to remove it.
+    """
+    version = _bump_version(tag_id)
+    entry = cache.get(subscriber_index_key(tag_id))
+    if entry is None or entry[0] != version - 1:
+        return
+
+    user_ids = array(TYPECODE)
+    user_ids.frombytes(entry[1])
+    index = bisect_left(user_ids, user_id)
+    present = index < len(user_ids) and user_ids[index] == user_id
+    if subscribed and not present:
+        user_ids.insert(index, user_id)
+    elif not subscribed and present:
+        del user_ids[index]
+    cache.set(subscriber_index_key(tag_id), (version, user_ids.tobytes()), get_subscriber_index_timeout())
+
+
+def invalidate_subscriber_index(tag_id):
+    """
+    Marks the subscriber index of a tag as stale, e.g. after a `bulk_create` of subscriptions.
+
+    Args:
+        tag_id (int): The ID of the tag.
+    """
+    _bump_version(tag_id)
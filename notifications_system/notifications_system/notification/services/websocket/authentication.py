@@ -0,0 +1,132 @@
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from notification.services.database import run_in_db_pool
+
+
+class TokenCache:
+    """
+    Bounded in-process cache with per-entry expiration.
+
+    Entries are evicted when they expire or, once the cache is full, in least
+    recently used order. It is meant to be used from a single event loop, so it
+    is not thread-safe.
+
+    Attributes:
+        max_size (int): The maximum number of entries.
+        ttl (float): The default lifetime of an entry, in seconds.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the value of a key, or None if it is missing or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores a value for `ttl` seconds, defaults to the cache TTL.
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all the entries.
+        """
+        self._entries.clear()
+
+
+_token_cache = None
+
+
+def get_token_cache():
+    """
+    Returns the process-wide cache of validated tokens.
+
+    It is sized by NOTIFICATIONS_WS_TOKEN_CACHE_SIZE (0 disables it) and its entries
+    live NOTIFICATIONS_WS_TOKEN_CACHE_TTL seconds at most.
+    """
+    global _token_cache
+    max_size = getattr(settings, 'NOTIFICATIONS_WS_TOKEN_CACHE_SIZE', 10000)
+    ttl = getattr(settings, 'NOTIFICATIONS_WS_TOKEN_CACHE_TTL', 300)
+    if _token_cache is None or (_token_cache.max_size, _token_cache.ttl) != (max_size, ttl):
+        _token_cache = TokenCache(max_size, ttl)
+    return _token_cache
+
+
+def trust_token_claims():
+    """
+    Checks whether a valid token is enough to accept a connection, without
+    fetching its user from the database.
+
+    Returns:
+        bool: The value of NOTIFICATIONS_WS_TRUST_TOKEN_CLAIMS, defaults to False.
+    """
+    return getattr(settings, 'NOTIFICATIONS_WS_TRUST_TOKEN_CLAIMS', False)
+
+
+def _get_active_user(user_id):
+    """
+    Returns the active user with the given ID, or None.
+    """
+    return User.objects.filter(id=user_id, is_active=True).first()
+
+
+async def get_token_user(token):
+    """
+    Returns the user of a decoded token for a WebSocket handshake.
+
+    The outcome is cached by token id (the `jti` claim) until the cache TTL or the
+    token expiration, whichever comes first, so reconnections with the same token
+    do not query the database. On a cache hit, or when the token claims are trusted,
+    the user is a `TokenUser` built from the claims instead of a `User` instance.
+
+    Args:
+        token (UntypedToken): A token already validated by simplejwt.
+
+    Returns:
+        User|TokenUser|None: The user, or None if it does not exist or is inactive.
+    """
+    cache = get_token_cache()
+    token_id = token.get(api_settings.JTI_CLAIM)
+    user_id = token[api_settings.USER_ID_CLAIM]
+
+    is_active = cache.get(token_id) if token_id else None
+    if is_active is not None:
+        return TokenUser(token) if is_active else None
+
+    if trust_token_claims():
+        user = TokenUser(token)
+    else:
+        user = await run_in_db_pool(_get_active_user, user_id)
+
+    if token_id:
+        cache.set(token_id, user is not None, token['exp'] - time.time())
+    return user
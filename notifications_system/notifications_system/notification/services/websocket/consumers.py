@@ -1,18 +1,50 @@
-import json
+import math
+import time
+from bisect import bisect_left
 
-from asgiref.sync import sync_to_async
-from django.contrib.auth.models import User
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.db import connection
 from urllib.parse import parse_qs
 
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from rest_framework_simplejwt.tokens import UntypedToken
 
 from notification.queryset import (
+    InvalidCursor,
+    clamp_page_size,
+    get_cursor_paginated_notifications,
+    get_inbox_total,
+    get_notifications_page,
+    get_notifications_since,
     get_paginated_notifications,
+    get_user_tag_ids,
     mark_notification_as_read,
-    mark_notification_as_deleted
+    mark_notification_as_deleted,
+    mark_notifications_as_deleted,
+    mark_notifications_as_read
+)
+from notification.services import metrics
+from notification.services.counters import get_unread_count
+from notification.services.database import run_in_db_pool
+from notification.services.fanout import tag_broadcast_is_enabled
+from notification.services.websocket.authentication import get_token_user
+from notification.services.websocket.encoding import (
+    dumps, encode_notification, encode_patch, loads, unpack_ids
+)
+from notification.services.websocket.outbound import create_outbound_buffer
+from notification.services.websocket.throttling import create_rate_limiter
+
+# Maximum number of notification IDs accepted by `read_many` and `delete_many`.
+MAX_BULK_IDS = 1000
+# Number of notifications per message of a replay, and per replay.
+REPLAY_CHUNK_SIZE = 100
+REPLAY_LIMIT = 1000
+# Seconds the IDs of a replay are kept to drop their live pushes.
+REPLAY_DEDUPE_SECONDS = 30
+# Message types reported in the metrics, any other one is reported as 'unknown'.
+MESSAGE_TYPES = (
+    'notifications_list', 'replay', 'unread_count', 'read', 'deleted',
+    'read_many', 'read_all', 'delete_many'
 )
 
 
@@ -23,6 +55,14 @@ class NotificationConsumerBase(AsyncWebsocketConsumer):
     Attributes:
         user_id (int|None): The ID of the authenticated user.
         group_name (str|None): The name of the WebSocket group associated with the user.
+        tag_groups (set): The names of the tag groups joined by the connection.
+        replayed_ids (set): The IDs sent by the last replay, see `replay`.
+        replayed_until (float): The monotonic time until which `replayed_ids` are dropped
+            from the live pushes.
+        outbound (OutboundBuffer): The queue of the events sent to the client, which
+            coalesces them and bounds their number, see `OutboundBuffer`.
+        rate_limiter (RateLimiter|None): The limits of the messages of the client per
+            type, set once the user is authenticated, see `RateLimiter`.
     """
 
     def __init__(self, *args, **kwargs):
@@ -32,19 +72,32 @@ class NotificationConsumerBase(AsyncWebsocketConsumer):
         super().__init__(*args, **kwargs)
         self.user_id = None
         self.group_name = None
+        self.tag_groups = set()
+        self.replayed_ids = set()
+        self.replayed_until = 0.0
+        self.outbound = create_outbound_buffer(self.send_frame, self.close_with_code)
+        self.rate_limiter = None
 
     async def connect(self):
         """
         Handle the WebSocket connection.
 
         Verifies the user's authentication via JWT token passed in the query string.
-        If authenticated, adds the user to a group for receiving notifications.
+        If authenticated, adds the user to a group for receiving notifications and
+        to the group of each subscribed tag, where notifications are broadcast when
+        NOTIFICATIONS_TAG_BROADCAST is enabled.
+        The user lookup is cached by token, see `get_token_user`.
+
+        A `since` parameter in the query string replays the missed notifications
+        right after the connection is accepted, see `replay`.
         """
         query_string = self.scope['query_string'].decode()
         query_params = parse_qs(query_string)
         token = query_params.get('token', [None])[0]
+        since = query_params.get('since', [None])[0]
 
         if token is None:
+            metrics.ws_handshake_failures.inc(reason='missing_token')
             await self.close()
             return
 
@@ -52,30 +105,222 @@ class NotificationConsumerBase(AsyncWebsocketConsumer):
             decoded_token = UntypedToken(token)
             self.user_id = decoded_token['user_id']
             # If the token is valid, continue with the connection
-            user = await database_sync_to_async(User.objects.get)(id=self.user_id)
+            user = await get_token_user(decoded_token)
+            if user is None:
+                metrics.ws_handshake_failures.inc(reason='inactive_user')
+                await self.close()
+                return
             self.scope['user'] = user
             self.group_name = f'notifications_{self.user_id}'
+            self.rate_limiter = create_rate_limiter(self.user_id)
 
             await self.channel_layer.group_add(
                 self.group_name,
                 self.channel_name
             )
+            metrics.ws_connections.inc()
+            metrics.ws_groups.inc()
+            if tag_broadcast_is_enabled():
+                for tag_id in await run_in_db_pool(get_user_tag_ids, self.user_id):
+                    await self.join_tag_group(tag_id)
             await self.accept()
+            if since:
+                await self.replay(since)
 
         except (InvalidToken, TokenError):
             # If the token is invalid, close the connection
+            metrics.ws_handshake_failures.inc(reason='invalid_token')
             await self.close()
 
     async def disconnect(self, close_code):
         """
         Handle the WebSocket disconnection.
 
-        Removes the user from the notification group.
+        Removes the user from the notification group and the tag groups, and
+        discards the events not sent yet.
         """
+        self.outbound.cancel()
+        if self.rate_limiter is not None:
+            self.rate_limiter.close()
+            self.rate_limiter = None
+        if self.group_name is None:
+            # The connection was rejected before joining the group.
+            return
         await self.channel_layer.group_discard(
             self.group_name,
             self.channel_name
         )
+        for tag_group in self.tag_groups:
+            await self.channel_layer.group_discard(tag_group, self.channel_name)
+        metrics.ws_connections.dec()
+        metrics.ws_groups.dec(1 + len(self.tag_groups))
+        self.tag_groups.clear()
+
+    async def run_query(self, message_type, func, *args):
+        """
+        Runs a function that accesses the database in a thread of the database pool,
+        so the messages of different connections are handled concurrently, see
+        `run_in_db_pool`.
+
+        When the metrics are enabled, its database time and number of queries are
+        recorded under the message type being handled.
+
+        Args:
+            message_type (str): The type of the message being handled.
+            func (callable): The function.
+            *args: The arguments of the function.
+
+        Returns:
+            The result of the function.
+        """
+        if not metrics.ENABLED:
+            return await run_in_db_pool(func, *args)
+        if message_type not in MESSAGE_TYPES:
+            message_type = 'unknown'
+        return await run_in_db_pool(self.measure_queries, message_type, func, *args)
+
+    @staticmethod
+    def measure_queries(message_type, func, *args):
+        """
+        Calls a function and records the time and number of its queries, see `run_query`.
+        """
+        queries = 0
+        duration = 0.0
+
+        def measure(execute, sql, params, many, context):
+            nonlocal queries, duration
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                duration += time.perf_counter() - start
+                queries += 1
+
+        with connection.execute_wrapper(measure):
+            result = func(*args)
+        metrics.ws_message_db_duration.observe(duration, type=message_type)
+        metrics.ws_message_queries.inc(queries, type=message_type)
+        return result
+
+    async def send_frame(self, payload):
+        """
+        Sends an encoded frame to the client, used by the outbound buffer.
+        """
+        await self.send(text_data=payload)
+
+    async def close_with_code(self, code):
+        """
+        Closes the connection with a code, used by the outbound buffer.
+        """
+        await self.close(code=code)
+
+    async def join_tag_group(self, tag_id):
+        """
+        Adds the connection to the broadcast group of a tag.
+
+        Args:
+            tag_id (int): The ID of the tag.
+        """
+        tag_group = f'tag_{tag_id}'
+        if tag_group not in self.tag_groups:
+            self.tag_groups.add(tag_group)
+            await self.channel_layer.group_add(tag_group, self.channel_name)
+            metrics.ws_groups.inc()
+
+    async def leave_tag_group(self, tag_id):
+        """
+        Removes the connection from the broadcast group of a tag.
+
+        Args:
+            tag_id (int): The ID of the tag.
+        """
+        tag_group = f'tag_{tag_id}'
+        if tag_group in self.tag_groups:
+            self.tag_groups.discard(tag_group)
+            await self.channel_layer.group_discard(tag_group, self.channel_name)
+            metrics.ws_groups.dec()
+
+    async def replay(self, since):
+        """
+        Send the notifications the client missed, oldest first.
+
+        The notifications after `since` are streamed in `replay` messages of at most
+        REPLAY_CHUNK_SIZE notifications, each with the `cursor` of its last one; the
+        last message has `done` set, and `truncated` too if more than REPLAY_LIMIT
+        notifications were missed, in which case the client can replay again from
+        the cursor.
+
+        The groups are joined before the replay starts and the consumer handles one
+        message at a time, so pushes sent meanwhile wait in the channel layer and are
+        delivered right after it: nothing is lost between the replay and the live
+        pushes. The pushes of notifications that were already replayed are dropped
+        for REPLAY_DEDUPE_SECONDS, so nothing is delivered twice either.
+
+        Args:
+            since (str|int): A cursor, or the ID of the last notification seen by the client.
+        """
+        replayed_ids = set()
+        cursor = since
+        done = False
+        while not done:
+            try:
+                notifications_data, cursor, has_more = await self.run_query(
+                    'replay', get_notifications_since, self.user_id, cursor, REPLAY_CHUNK_SIZE
+                )
+            except InvalidCursor as error:
+                await self.send(text_data=dumps({
+                    'type': 'error',
+                    'message': str(error)
+                }))
+                return
+            replayed_ids.update(item['id'] for item in notifications_data)
+            truncated = has_more and len(replayed_ids) >= REPLAY_LIMIT
+            done = not has_more or truncated
+            await self.send(text_data=dumps({
+                'type': 'replay',
+                'data': notifications_data,
+                'cursor': cursor,
+                'done': done,
+                'truncated': truncated
+            }))
+        self.replayed_ids = replayed_ids
+        self.replayed_until = time.monotonic() + REPLAY_DEDUPE_SECONDS
+
+    def was_replayed(self, notification_id):
+        """
+        Checks whether a live push is for a notification already sent by the last replay.
+
+        Args:
+            notification_id (int): The ID of the user notification.
+
+        Returns:
+            bool: True if the push must be dropped.
+        """
+        if not self.replayed_ids:
+            return False
+        if time.monotonic() >= self.replayed_until:
+            self.replayed_ids = set()
+            return False
+        return notification_id in self.replayed_ids
+
+    async def subscription_added(self, event):
+        """
+        Join the group of a tag the user subscribed to.
+
+        Args:
+            event (dict): Event data containing the tag ID.
+        """
+        if tag_broadcast_is_enabled():
+            await self.join_tag_group(event['tag_id'])
+
+    async def subscription_removed(self, event):
+        """
+        Leave the group of a tag the user unsubscribed from.
+
+        Args:
+            event (dict): Event data containing the tag ID.
+        """
+        await self.leave_tag_group(event['tag_id'])
 
 
 class NotificationConsumer(NotificationConsumerBase):
@@ -83,9 +328,18 @@ class NotificationConsumer(NotificationConsumerBase):
     WebSocket consumer that handles receiving and processing notification-related messages.
     Inherits from NotificationConsumerBase.
 
+    The notification, read and delete events are queued in the outbound buffer and
+    sent by its own task, so a slow client holds at most NOTIFICATIONS_WS_MAX_QUEUE_DEPTH
+    of them; when NOTIFICATIONS_WS_COALESCE_WINDOW is set, the ones arriving within
+    that many seconds are sent in a single `batch` frame. Replies to the client
+    messages are sent right away.
+
     Methods:
         receive: Handles incoming WebSocket messages and processes them based on the message type.
         notification_message: Sends a notification message to the client.
+        tag_notification: Sends a notification broadcast to a tag group to the client.
+        notification_patch: Sends the new content of a digest to the client.
+        tag_notification_patch: Sends the patch of a digest broadcast to a tag group to the client.
         notifications_list: Sends a list of notifications to the client.
         notification_read: Sends a message indicating a notification has been read.
         notification_delete: Sends a message indicating a notification has been deleted.
@@ -96,31 +350,128 @@ class NotificationConsumer(NotificationConsumerBase):
         Handle incoming WebSocket messages.
 
         Processes different types of messages like retrieving notifications,
-        marking notifications as read, and marking notifications as deleted.
+        retrieving the number of unread notifications, marking notifications
+        as read, and marking notifications as deleted.
+
+        `read_many` and `delete_many` take a list of `ids` and `read_all` marks every
+        unread notification of the user as read; each of them runs a single UPDATE
+        and is confirmed with a single event listing the affected IDs.
+
+        A `notifications_list` message that includes a `cursor` key is paginated by
+        cursor and answered with `next_cursor` and `has_more`; without it, the
+        `page` number is used and the answer includes `total_pages`, unless the
+        message includes a `total` key: then no `COUNT(*)` is run and the answer
+        includes `has_more`. In both cases a `total` of 'approximate' or 'exact'
+        adds the number of notifications of the user to the answer, read from the
+        cached inbox counter or counted in the database, see `get_inbox_total`.
+
+        A `replay` message with a `since` cursor or notification ID replays the
+        notifications missed after it, like the `since` query string parameter.
+
+        Before any database work, every message is counted against the rate limits
+        of its type, per connection and per user, see `RateLimiter`. A message over
+        the limit is not handled and is answered with `{"type": "throttled",
+        "message_type": ..., "retry_after": seconds}`.
 
         Args:
             text_data (str): The JSON-encoded message received from the client.
             bytes_data (bytes): Raw bytes received (not used here).
         """
-        data = json.loads(text_data)
+        data = loads(text_data)
         message_type = data.get('type')
+        metrics.ws_messages.inc(type=message_type if message_type in MESSAGE_TYPES else 'unknown')
+
+        if message_type in MESSAGE_TYPES:
+            retry_after = self.rate_limiter.check(message_type)
+            if retry_after:
+                metrics.ws_throttled.inc(type=message_type)
+                await self.send(text_data=dumps({
+                    'type': 'throttled',
+                    'message_type': message_type,
+                    'retry_after': round(retry_after, 3) if math.isfinite(retry_after) else None
+                }))
+                return
 
         # Handle different message types
-        if message_type == 'notifications_list':
+        if message_type == 'notifications_list' and 'cursor' in data:
+            # Keyset pagination, the client sends the `next_cursor` of the previous page
+            # (null for the first one).
+            try:
+                page_size = clamp_page_size(data.get('page_size'))
+                total = await self.run_query(
+                    message_type, get_inbox_total, self.user_id, data.get('total', 'none')
+                )
+                notifications_data, next_cursor, has_more = await self.run_query(
+                    message_type, get_cursor_paginated_notifications,
+                    self.user_id, data['cursor'], page_size
+                )
+            except ValueError as error:
+                # An InvalidCursor, or an invalid page size or total.
+                await self.send(text_data=dumps({
+                    'type': 'error',
+                    'message': str(error)
+                }))
+                return
+            response = {
+                'type': 'notifications_list',
+                'data': notifications_data,
+                'next_cursor': next_cursor,
+                'has_more': has_more
+            }
+            if total is not None:
+                response['total'] = total
+            await self.send(text_data=dumps(response))
+        elif message_type == 'notifications_list' and 'total' in data:
+            # Page number without COUNT(*): `has_more` instead of `total_pages`.
+            try:
+                page_size = clamp_page_size(data.get('page_size'))
+                notifications_data, has_more, total = await self.run_query(
+                    message_type, get_notifications_page,
+                    self.user_id, data.get('page', 1), page_size, data['total']
+                )
+            except ValueError as error:
+                await self.send(text_data=dumps({
+                    'type': 'error',
+                    'message': str(error)
+                }))
+                return
+            response = {
+                'type': 'notifications_list',
+                'data': notifications_data,
+                'has_more': has_more
+            }
+            if total is not None:
+                response['total'] = total
+            await self.send(text_data=dumps(response))
+        elif message_type == 'notifications_list':
             page = data.get('page', 1)
             page_size = data.get('page_size', 10)
-            notifications_data, total = await sync_to_async(
-                get_paginated_notifications
-            )(self.user_id, page, page_size)
-            await self.send(text_data=json.dumps({
+            notifications_data, total = await self.run_query(
+                message_type, get_paginated_notifications, self.user_id, page, page_size
+            )
+            await self.send(text_data=dumps({
                 'type': 'notifications_list',
                 'data': notifications_data,
                 'total_pages': total
             }))
+        elif message_type == 'replay':
+            await self.replay(data.get('since'))
+        elif message_type == 'unread_count':
+            count = await self.run_query(message_type, get_unread_count, self.user_id)
+            await self.send(text_data=dumps({
+                'type': 'unread_count',
+                'count': count
+            }))
         elif message_type == 'read':
             notification_id = data.get('id')
             # Call the service to mark the notification as read
-            await sync_to_async(mark_notification_as_read)(notification_id)
+            changed = await self.run_query(
+                message_type, mark_notification_as_read, notification_id, self.user_id
+            )
+            if not changed:
+                # Nothing to echo to the other tabs, only this client gets its reply.
+                await self.send(text_data=dumps({'type': 'read', 'id': notification_id}))
+                return
 
             await self.channel_layer.group_send(
                 self.group_name,
@@ -132,7 +483,13 @@ class NotificationConsumer(NotificationConsumerBase):
         elif message_type == 'deleted':
             notification_id = data.get('id')
             # Call the service to mark the notification as deleted
-            await sync_to_async(mark_notification_as_deleted)(notification_id)
+            changed = await self.run_query(
+                message_type, mark_notification_as_deleted, notification_id, self.user_id
+            )
+            if not changed:
+                # Nothing to echo to the other tabs, only this client gets its reply.
+                await self.send(text_data=dumps({'type': 'delete', 'id': notification_id}))
+                return
 
             await self.channel_layer.group_send(
                 self.group_name,
@@ -141,25 +498,153 @@ class NotificationConsumer(NotificationConsumerBase):
                     'id': notification_id
                 }
             )
+        elif message_type in ('read_many', 'read_all', 'delete_many'):
+            if message_type == 'read_all':
+                notification_ids = None
+            else:
+                notification_ids = self.get_notification_ids(data)
+                if notification_ids is None:
+                    await self.send(text_data=dumps({
+                        'type': 'error',
+                        'message': f"'ids' must be a list of at most {MAX_BULK_IDS} integers."
+                    }))
+                    return
+
+            if message_type == 'delete_many':
+                affected_ids = await self.run_query(
+                    message_type, mark_notifications_as_deleted, self.user_id, notification_ids
+                )
+                event_type = 'notification_delete'
+            else:
+                affected_ids = await self.run_query(
+                    message_type, mark_notifications_as_read, self.user_id, notification_ids
+                )
+                event_type = 'notification_read'
+            if not affected_ids:
+                await self.send(text_data=dumps({
+                    'type': 'delete' if message_type == 'delete_many' else 'read',
+                    'ids': []
+                }))
+                return
+
+            # A single event for the whole batch, echoed to every tab of the user.
+            await self.channel_layer.group_send(
+                self.group_name,
+                {
+                    'type': event_type,
+                    'ids': affected_ids
+                }
+            )
+
+    @staticmethod
+    def get_notification_ids(data):
+        """
+        Returns the list of notification IDs of a bulk message.
+
+        Args:
+            data (dict): The decoded message received from the client.
+
+        Returns:
+            list|None: The IDs, or None if `ids` is not a list of at most
+                       MAX_BULK_IDS integers.
+        """
+        notification_ids = data.get('ids')
+        if (
+            not isinstance(notification_ids, list)
+            or len(notification_ids) > MAX_BULK_IDS
+            or not all(isinstance(notification_id, int) for notification_id in notification_ids)
+        ):
+            return None
+        return notification_ids
 
     async def notification_message(self, event):
         """
         Send a notification message to the client.
 
         Args:
-            event (dict): Event data containing the notification details.
+            event (dict): Event data containing the notification details, either as
+                          separate fields or with the shared ones pre-encoded (`encoded`).
         """
+        if self.was_replayed(event['id']):
+            return
+        if 'encoded' in event:
+            # The fields shared by every recipient were encoded once by the sender.
+            await self.outbound.push(encode_notification(
+                event['id'], event['is_read'], event['encoded']
+            ))
+            return
         notification_id = event['id']
         message = event['message']
         timestamp = event['timestamp']
         is_read = event['is_read']
-        await self.send(text_data=json.dumps({
+        await self.outbound.push(dumps({
             'id': notification_id,
             'message': message,
             'is_read': is_read,
             'timestamp': timestamp
         }))
 
+    async def tag_notification(self, event):
+        """
+        Send a notification broadcast to the group of a tag to the client, if the
+        user is one of its recipients.
+
+        Args:
+            event (dict): Event data containing the packed, sorted recipient IDs (`user_ids`),
+                          the user notification ID of each one (`ids`) and the
+                          pre-encoded shared fields (`encoded`).
+        """
+        user_notification_id = self.get_broadcast_recipient(event)
+        if user_notification_id is None or self.was_replayed(user_notification_id):
+            return
+        await self.outbound.push(encode_notification(
+            user_notification_id, False, event['encoded']
+        ))
+
+    def get_broadcast_recipient(self, event):
+        """
+        Returns the ID of the user notification of the user for an event broadcast to
+        the group of a tag, or None if the user is not one of its recipients.
+
+        The user is looked up with a binary search in the packed map of the event,
+        see `send_to_tag_group`, so the database is not queried.
+        """
+        user_ids = unpack_ids(event['user_ids'])
+        index = bisect_left(user_ids, self.user_id)
+        if index == len(user_ids) or user_ids[index] != self.user_id:
+            # Subscribed after the fan-out, or the event belongs to another chunk.
+            return None
+        return unpack_ids(event['ids'])[index]
+
+    async def notification_patch(self, event):
+        """
+        Send the new content of a digest the user already has to the client.
+
+        Queued patches of the same item are replaced, so only the last one is sent.
+
+        Args:
+            event (dict): Event data containing the user notification ID (`id`) and
+                          the pre-encoded changed fields (`encoded`).
+        """
+        await self.outbound.push(encode_patch(event['id'], event['encoded']), key=('patch', event['id']))
+
+    async def tag_notification_patch(self, event):
+        """
+        Send the patch of a digest broadcast to the group of a tag to the client, if
+        the user is one of its recipients, see `tag_notification`.
+
+        Args:
+            event (dict): Event data containing the packed, sorted recipient IDs (`user_ids`),
+                          the user notification ID of each one (`ids`) and the
+                          pre-encoded changed fields (`encoded`).
+        """
+        user_notification_id = self.get_broadcast_recipient(event)
+        if user_notification_id is None:
+            return
+        await self.outbound.push(
+            encode_patch(user_notification_id, event['encoded']), key=('patch', user_notification_id)
+        )
+
     async def notifications_list(self, event):
         """
         Send a list of notifications to the client.
@@ -168,7 +653,7 @@ class NotificationConsumer(NotificationConsumerBase):
             event (dict): Event data containing the list of notifications.
         """
         data = event['data']
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps({
             'type': 'read',
             'data': data
         }))
@@ -178,10 +663,17 @@ class NotificationConsumer(NotificationConsumerBase):
         Send a message indicating a notification has been read.
 
         Args:
-            event (dict): Event data containing the notification ID.
+            event (dict): Event data containing the notification ID, or the list of
+                          IDs (`ids`) of a bulk operation.
         """
+        if 'ids' in event:
+            await self.outbound.push(dumps({
+                'type': 'read',
+                'ids': event['ids']
+            }))
+            return
         notification_id = event['id']
-        await self.send(text_data=json.dumps({
+        await self.outbound.push(dumps({
             'type': 'read',
             'id': notification_id
         }))
@@ -191,10 +683,17 @@ class NotificationConsumer(NotificationConsumerBase):
         Send a message indicating a notification has been deleted.
 
         Args:
-            event (dict): Event data containing the notification ID.
+            event (dict): Event data containing the notification ID, or the list of
+                          IDs (`ids`) of a bulk operation.
         """
+        if 'ids' in event:
+            await self.outbound.push(dumps({
+                'type': 'delete',
+                'ids': event['ids']
+            }))
+            return
         notification_id = event['id']
-        await self.send(text_data=json.dumps({
+        await self.outbound.push(dumps({
             'type': 'delete',
             'id': notification_id
         }))
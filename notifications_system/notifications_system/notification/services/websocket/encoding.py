@@ -0,0 +1,156 @@
+import json
+import sys
+from array import array
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _orjson_dumps(data):
+    return orjson.dumps(data).decode()
+
+
+def _orjson_loads(text):
+    return orjson.loads(text)
+
+
+def _json_dumps(data):
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+
+def _json_loads(text):
+    return json.loads(text)
+
+
+BACKENDS = {
+    'json': (_json_dumps, _json_loads),
+    'orjson': (_orjson_dumps, _orjson_loads),
+}
+
+
+def get_json_backend():
+    """
+    Returns the name of the JSON backend used for WebSocket payloads.
+
+    NOTIFICATIONS_JSON_BACKEND can be 'orjson', 'json' or 'auto' (the default),
+    which picks orjson when it is installed and the standard library otherwise.
+    """
+    backend = getattr(settings, 'NOTIFICATIONS_JSON_BACKEND', 'auto')
+    if backend == 'auto':
+        return 'orjson' if orjson is not None else 'json'
+    if backend == 'orjson' and orjson is None:
+        raise ImportError("NOTIFICATIONS_JSON_BACKEND is 'orjson' but orjson is not installed.")
+    return backend
+
+
+_dumps, _loads = BACKENDS[get_json_backend()]
+
+
+@receiver(setting_changed)
+def _reload_backend(setting, **kwargs):
+    global _dumps, _loads
+    if setting == 'NOTIFICATIONS_JSON_BACKEND':
+        _dumps, _loads = BACKENDS[get_json_backend()]
+
+
+def dumps(data):
+    """
+    Encodes data as a compact JSON string with the configured backend.
+    """
+    return _dumps(data)
+
+
+def loads(text):
+    """
+    Decodes a JSON string or bytes with the configured backend.
+    """
+    return _loads(text)
+
+
+def encode_fragment(data):
+    """
+    Encodes the members of a JSON object, without the enclosing braces, so they
+    can be spliced into several payloads.
+
+    Args:
+        data (dict): A non empty dictionary.
+
+    Returns:
+        str: The encoded members, e.g. `"message":"Hi","timestamp":"..."`.
+    """
+    return dumps(data)[1:-1]
+
+
+def encode_notification(notification_id, is_read, fragment):
+    """
+    Builds the JSON payload of a real-time notification from its per-recipient
+    fields and the fragment shared by every recipient.
+
+    Args:
+        notification_id (int): The ID of the user notification.
+        is_read (bool): Whether the notification has been read.
+        fragment (str): The shared fields, encoded with `encode_fragment`.
+
+    Returns:
+        str: The JSON payload sent to the client.
+    """
+    return f'{{"id":{int(notification_id)},"is_read":{"true" if is_read else "false"},{fragment}}}'
+
+
+def encode_patch(notification_id, fragment):
+    """
+    Builds the JSON payload of the patch of a digest, applied by the client to the
+    item it already has, from the ID of the user notification and the changed fields.
+
+    The digest became unread again, so `is_read` is always false.
+
+    Args:
+        notification_id (int): The ID of the user notification.
+        fragment (str): The changed fields, encoded with `encode_fragment`.
+
+    Returns:
+        str: The JSON payload sent to the client.
+    """
+    return f'{{"type":"patch","id":{int(notification_id)},"is_read":false,{fragment}}}'
+
+
+def pack_ids(ids):
+    """
+    Packs integer IDs into bytes, as little-endian signed 64-bit integers, so a
+    long list of them travels through the channel layer as a single compact value.
+
+    Args:
+        ids (iterable): The IDs.
+
+    Returns:
+        bytes: 8 bytes per ID.
+    """
+    packed = array('q', ids)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_ids(data):
+    """
+    Returns the IDs packed by `pack_ids` as a sequence, which can be indexed and
+    bisected without copying them on little-endian hosts.
+
+    Args:
+        data (bytes): The packed IDs.
+
+    Returns:
+        Sequence: The IDs.
+    """
+    if sys.byteorder == 'little':
+        return memoryview(data).cast('q')
+    unpacked = array('q')
+    unpacked.frombytes(data)
+    unpacked.byteswap()
+    return unpacked
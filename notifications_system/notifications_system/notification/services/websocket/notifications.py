@@ -2,6 +2,9 @@ from datetime import timezone
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
+from notification.services import metrics
+from notification.services.websocket.encoding import encode_fragment, pack_ids
+
 
 def send_real_time_notification(user_notification):
     """
@@ -20,21 +23,225 @@ def send_real_time_notification(user_notification):
     The message contains the following fields:
     - 'type': Specifies the handler method in the WebSocket consumer to be called.
     - 'id': The ID of the user notification.
-    - 'message': The content of the notification.
     - 'is_read': A boolean indicating whether the notification has been read.
-    - 'timestamp': The timestamp of the notification in ISO 8601 format.
+    - 'encoded': The content ('message') and the timestamp in ISO 8601 format ('timestamp')
+      of the notification, already encoded as JSON by `encode_shared_fields`.
     """
     channel_layer = get_channel_layer()
-    group_name = f"notifications_{user_notification.user.id}"
+    group_name = f"notifications_{user_notification.user_id}"
 
     # Type specifies the name of the function in the WebSocket consumer that should handle this message
+    with metrics.group_send_duration.time(target='user'):
+        async_to_sync(channel_layer.group_send)(
+            group_name,
+            {
+                'type': 'notification_message',
+                'id': user_notification.id,
+                'is_read': user_notification.is_read,
+                'encoded': encode_shared_fields(user_notification.notification)
+            }
+        )
+
+
+def encode_shared_fields(notification):
+    """
+    Encodes the fields of a real-time notification that are the same for every recipient.
+
+    Args:
+        notification (Notification): The notification being sent.
+
+    Returns:
+        str: The `message` and `timestamp` members, encoded with `encode_fragment`.
+    """
+    return encode_fragment({
+        'message': notification.message,
+        'timestamp': notification.timestamp.astimezone(timezone.utc).isoformat()
+    })
+
+
+def send_real_time_notifications(notification, recipients):
+    """
+    Sends a real-time notification to the WebSocket group of every recipient.
+
+    This is the bulk counterpart of `send_real_time_notification`, meant to be used
+    with the output of `fan_out_notification`. The shared fields are encoded once
+    per notification and all the messages are sent from a single `async_to_sync`
+    call, so no UserNotification instance has to be loaded per recipient.
+
+    Args:
+        notification (Notification): The notification that was fanned out.
+        recipients (list): A list of (user_notification_id, user_id) tuples.
+
+    Each message has the same fields as the ones sent by `send_real_time_notification`.
+    """
+    if not recipients:
+        return
+
+    channel_layer = get_channel_layer()
+    encoded = encode_shared_fields(notification)
+
+    async def send_all():
+        for user_notification_id, user_id in recipients:
+            await channel_layer.group_send(
+                f"notifications_{user_id}",
+                {
+                    'type': 'notification_message',
+                    'id': user_notification_id,
+                    'is_read': False,
+                    'encoded': encoded
+                }
+            )
+
+    with metrics.group_send_duration.time(target='user'):
+        async_to_sync(send_all)()
+
+
+def send_to_tag_group(notification, recipients, event_type, encoded, chunk_size):
+    """
+    Sends an event to the WebSocket group of the tag of a notification, in chunks of
+    recipients, each with the map from its recipients to their user notifications.
+
+    The recipients of a chunk are sorted by user ID and the map is packed by
+    `pack_ids` as two parallel arrays, `user_ids` and `ids`, of 8 bytes per
+    recipient, so a consumer finds its own entry with a binary search.
+
+    Args:
+        notification (Notification): The notification, whose tag names the group.
+        recipients (list): A non empty list of (user_notification_id, user_id) tuples.
+        event_type (str): The handler method in the WebSocket consumer.
+        encoded (str): The fields shared by every recipient, already encoded.
+        chunk_size (int): The maximum number of recipients per event.
+    """
+    channel_layer = get_channel_layer()
+    group_name = f"tag_{notification.tag_id}"
+    recipients = sorted(recipients, key=lambda recipient: recipient[1])
+
+    async def send_all():
+        for start in range(0, len(recipients), chunk_size):
+            chunk = recipients[start:start + chunk_size]
+            await channel_layer.group_send(
+                group_name,
+                {
+                    'type': event_type,
+                    'user_ids': pack_ids(user_id for _, user_id in chunk),
+                    'ids': pack_ids(user_notification_id for user_notification_id, _ in chunk),
+                    'encoded': encoded
+                }
+            )
+
+    with metrics.group_send_duration.time(target='tag'):
+        async_to_sync(send_all)()
+
+
+def broadcast_real_time_notification(notification, recipients, chunk_size=1000):
+    """
+    Sends a real-time notification to the WebSocket group of its tag.
+
+    Every consumer joins the `tag_{id}` group of each tag its user is subscribed to,
+    so a single `group_send` per chunk of `chunk_size` recipients reaches all the
+    recipients connected to any process. The event carries the packed map from the
+    recipients to their user notifications, see `send_to_tag_group`; each consumer
+    looks its user up in memory and ignores the event if it is not a recipient,
+    e.g. because it subscribed after the fan-out or belongs to another chunk.
+
+    Args:
+        notification (Notification): The notification that was fanned out.
+        recipients (list): A list of (user_notification_id, user_id) tuples.
+        chunk_size (int, optional): The maximum number of recipients per event. Defaults to 1000.
+
+    The message contains the following fields:
+    - 'type': 'tag_notification', the handler method in the WebSocket consumer.
+    - 'user_ids': The sorted IDs of the recipients, packed by `pack_ids`.
+    - 'ids': The ID of the user notification of each recipient, in the same order and packed.
+    - 'encoded': The shared fields, as in `send_real_time_notification`.
+    """
+    if not recipients:
+        return
+
+    send_to_tag_group(
+        notification, recipients, 'tag_notification', encode_shared_fields(notification), chunk_size
+    )
+
+
+def encode_patch_fields(notification):
+    """
+    Encodes the fields of a digest that change when a notification is merged into it.
+
+    Args:
+        notification (Notification): The digest.
+
+    Returns:
+        str: The `message` and `count` members, encoded with `encode_fragment`.
+    """
+    return encode_fragment({
+        'message': notification.message,
+        'count': notification.digest_count
+    })
+
+
+def send_real_time_patch(notification, recipients, broadcast=False, chunk_size=1000):
+    """
+    Sends the new content of a digest to its recipients, to be applied to the item
+    they already have instead of being shown as a new one.
+
+    The events mirror the ones of a new notification: one `tag_notification_patch`
+    per `chunk_size` recipients to the group of the tag when `broadcast` is set, as
+    in `broadcast_real_time_notification`, and one `notification_patch` per recipient
+    otherwise, as in `send_real_time_notifications`.
+
+    Args:
+        notification (Notification): The digest.
+        recipients (list): A list of (user_notification_id, user_id) tuples.
+        broadcast (bool, optional): Send the patch to the group of the tag. Defaults to False.
+        chunk_size (int, optional): The maximum number of recipients per broadcast event.
+
+    The message contains the following fields:
+    - 'type': 'notification_patch' or 'tag_notification_patch'.
+    - 'id', or 'user_ids' and 'ids': The recipients, as in the events of a new notification.
+    - 'encoded': The changed fields, encoded by `encode_patch_fields`.
+    """
+    if not recipients:
+        return
+
+    encoded = encode_patch_fields(notification)
+    if broadcast:
+        send_to_tag_group(notification, recipients, 'tag_notification_patch', encoded, chunk_size)
+        return
+
+    channel_layer = get_channel_layer()
+
+    async def send_all():
+        for user_notification_id, user_id in recipients:
+            await channel_layer.group_send(
+                f"notifications_{user_id}",
+                {
+                    'type': 'notification_patch',
+                    'id': user_notification_id,
+                    'encoded': encoded
+                }
+            )
+
+    with metrics.group_send_duration.time(target='user'):
+        async_to_sync(send_all)()
+
+
+def send_subscription_change(user_id, tag_id, subscribed):
+    """
+    Tells the consumers of a user to join or leave the WebSocket group of a tag.
+
+    Args:
+        user_id (int): The ID of the subscribed user.
+        tag_id (int): The ID of the tag.
+        subscribed (bool): True if the user subscribed to the tag, False if unsubscribed.
+
+    The message is handled by the `subscription_added` or `subscription_removed`
+    method of the consumers in the user's group.
+    """
+    channel_layer = get_channel_layer()
     async_to_sync(channel_layer.group_send)(
-        group_name,
+        f"notifications_{user_id}",
         {
-            'type': 'notification_message',
-            'id': user_notification.id,
-            'message': user_notification.notification.message,
-            'is_read': user_notification.is_read,
-            'timestamp': user_notification.notification.timestamp.astimezone(timezone.utc).isoformat()
+            'type': 'subscription_added' if subscribed else 'subscription_removed',
+            'tag_id': tag_id
         }
     )
@@ -0,0 +1,208 @@
+import asyncio
+from collections import deque
+
+from django.conf import settings
+
+DROP_OLDEST = 'drop_oldest'
+RESYNC = 'resync'
+DISCONNECT = 'disconnect'
+
+OVERFLOW_POLICIES = (DROP_OLDEST, RESYNC, DISCONNECT)
+
+# Sent instead of the queued events when they were collapsed by the `resync` policy.
+RESYNC_FRAME = '{"type":"resync"}'
+# Close code of the connections closed by the `disconnect` policy ("try again later").
+OVERFLOW_CLOSE_CODE = 1013
+
+
+def get_coalesce_window():
+    """
+    Returns the number of seconds events are held to be sent together, 0 sends each one in its own frame.
+
+    Batching changes the frames the clients receive, so it is off by default.
+    """
+    return getattr(settings, 'NOTIFICATIONS_WS_COALESCE_WINDOW', 0)
+
+
+def get_max_queue_depth():
+    """
+    Returns the maximum number of events waiting to be sent per connection.
+    """
+    return getattr(settings, 'NOTIFICATIONS_WS_MAX_QUEUE_DEPTH', 1000)
+
+
+def get_overflow_policy():
+    """
+    Returns what is done when the queue of a connection is full: 'drop_oldest',
+    'resync' or 'disconnect'.
+    """
+    policy = getattr(settings, 'NOTIFICATIONS_WS_OVERFLOW_POLICY', DROP_OLDEST)
+    if policy not in OVERFLOW_POLICIES:
+        raise ValueError(f"Invalid NOTIFICATIONS_WS_OVERFLOW_POLICY {policy!r}.")
+    return policy
+
+
+def encode_batch(payloads):
+    """
+    Joins several encoded events into a single `batch` frame without decoding them.
+
+    Args:
+        payloads (list): The JSON payloads of the events.
+
+    Returns:
+        str: The JSON payload `{"type":"batch","data":[...]}`.
+    """
+    return '{"type":"batch","data":[' + ','.join(payloads) + ']}'
+
+
+class OutboundBuffer:
+    """
+    Per-connection queue of outbound events.
+
+    Every event is queued and a single sender task sends them in order, so the
+    handlers of the connection never wait for the client. The events are held
+    while a frame is being sent, e.g. to a slow client behind a server that waits
+    for its socket to drain, up to `max_depth`; beyond that the overflow policy
+    applies to the events not sent yet:
+
+    - 'drop_oldest': the oldest queued event is discarded.
+    - 'resync': the queue collapses into a single `resync` frame, which tells the
+      client to reload its notifications, and new events are dropped until it is sent.
+    - 'disconnect': the queue is discarded and the connection is closed.
+
+    Coalescing is independent of the queue: with a `window`, the sender waits that
+    many seconds after the first event and sends the queued events together, a
+    single event as is and several of them in one `batch` frame. Without it, each
+    event is sent in its own frame.
+
+    An event pushed with a `key`, e.g. the patch of a digest, replaces the queued
+    event with the same key instead of being queued after it, so a burst of updates
+    of the same item is sent once, with its last content.
+
+    It is meant to be used from the event loop of its connection, so it is not thread-safe.
+
+    Attributes:
+        window (float): The coalescing window in seconds, 0 sends each event in its own frame.
+        max_depth (int): The maximum number of queued events.
+        overflow_policy (str): One of OVERFLOW_POLICIES.
+        dropped (int): The number of events discarded by the overflow policy.
+    """
+
+    def __init__(self, send, close, window, max_depth, overflow_policy):
+        self._send = send
+        self._close = close
+        self.window = window
+        self.max_depth = max_depth
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self._queue = deque()
+        self._keyed = {}
+        self._resync = False
+        self._closed = False
+        self._sender = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    async def push(self, payload, key=None):
+        """
+        Queues an encoded event and starts the sender task if it is not running.
+
+        Args:
+            payload (str): The JSON payload of the event.
+            key (hashable, optional): Replaces the queued event pushed with the same key.
+        """
+        if self._closed:
+            return
+        if self._resync:
+            self.dropped += 1
+            return
+
+        if key is not None:
+            queued = self._keyed.get(key)
+            self._keyed[key] = payload
+            if queued is not None:
+                try:
+                    self._queue[self._queue.index(queued)] = payload
+                    return
+                except ValueError:
+                    # Already sent, or discarded by the overflow policy.
+                    pass
+        self._queue.append(payload)
+        if len(self._queue) > self.max_depth:
+            await self._overflow()
+        if self._sender is None and not self._closed:
+            self._sender = asyncio.ensure_future(self._run_sender())
+
+    async def _overflow(self):
+        """
+        Applies the overflow policy to the full queue.
+        """
+        if self.overflow_policy == DROP_OLDEST:
+            self._queue.popleft()
+            self.dropped += 1
+        elif self.overflow_policy == RESYNC:
+            self.dropped += len(self._queue)
+            self._queue.clear()
+            self._keyed.clear()
+            self._resync = True
+        else:
+            self.dropped += len(self._queue)
+            self.cancel()
+            await self._close(OVERFLOW_CLOSE_CODE)
+
+    async def _run_sender(self):
+        try:
+            if self.window > 0:
+                await asyncio.sleep(self.window)
+            await self.flush()
+        finally:
+            self._sender = None
+
+    async def flush(self):
+        """
+        Sends the queued events, until the queue is empty.
+        """
+        while self._queue or self._resync:
+            if self._resync:
+                self._resync = False
+                self._queue.clear()
+                self._keyed.clear()
+                await self._send(RESYNC_FRAME)
+                continue
+            if self.window > 0:
+                payloads = list(self._queue)
+                self._queue.clear()
+                frame = payloads[0] if len(payloads) == 1 else encode_batch(payloads)
+            else:
+                frame = self._queue.popleft()
+            if not self._queue:
+                self._keyed.clear()
+            await self._send(frame)
+
+    def cancel(self):
+        """
+        Discards the queued events and stops accepting new ones.
+        """
+        self._closed = True
+        self._queue.clear()
+        self._keyed.clear()
+        if self._sender is not None and self._sender is not asyncio.current_task():
+            self._sender.cancel()
+        self._sender = None
+
+
+def create_outbound_buffer(send, close):
+    """
+    Creates an OutboundBuffer configured by the NOTIFICATIONS_WS_* settings.
+
+    Args:
+        send (callable): A coroutine function that sends a text frame.
+        close (callable): A coroutine function that closes the connection with a code.
+
+    Returns:
+        OutboundBuffer: The buffer.
+    """
+    return OutboundBuffer(
+        send, close, get_coalesce_window(), get_max_queue_depth(), get_overflow_policy()
+    )
@@ -0,0 +1,181 @@
+import time
+
+from django.conf import settings
+
+
+def get_rate_limits():
+    """
+    Returns the (rate per second, burst) of each message type, per connection.
+
+    The defaults are defined in the settings. Message types that are not listed are not limited.
+    """
+    return getattr(settings, 'NOTIFICATIONS_WS_RATE_LIMITS', None) or {}
+
+
+def get_user_rate_limits():
+    """
+    Returns the (rate per second, burst) of each message type, per user and process.
+
+    The defaults are defined in the settings. Message types that are not listed are not limited.
+    """
+    return getattr(settings, 'NOTIFICATIONS_WS_USER_RATE_LIMITS', None) or {}
+
+
+class TokenBucket:
+    """
+    Token bucket of a message type: it holds up to `capacity` tokens, refills at
+    `rate` tokens per second and every message takes one.
+
+    Attributes:
+        rate (float): The tokens added per second.
+        capacity (float): The maximum number of tokens, the burst allowed after a pause.
+        tokens (float): The tokens available at `updated`.
+        updated (float): The monotonic time of the last refill.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def wait_time(self, now):
+        """
+        Refills the bucket and returns the seconds until a token is available, 0 if there is one.
+        """
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """
+        Takes a token, after `wait_time` returned 0.
+        """
+        self.tokens -= 1
+
+
+class UserBuckets:
+    """
+    The token buckets of the users connected to this process, shared by their connections.
+
+    The buckets of a user are dropped when the last of its connections is released.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._connections = {}
+
+    def acquire(self, user_id):
+        """
+        Returns the buckets of a user, by message type, for a new connection.
+        """
+        self._connections[user_id] = self._connections.get(user_id, 0) + 1
+        return self._buckets.setdefault(user_id, {})
+
+    def release(self, user_id):
+        """
+        Releases the buckets of a user when one of its connections is closed.
+        """
+        count = self._connections.get(user_id, 0) - 1
+        if count > 0:
+            self._connections[user_id] = count
+        else:
+            self._connections.pop(user_id, None)
+            self._buckets.pop(user_id, None)
+
+
+user_buckets = UserBuckets()
+
+
+class RateLimiter:
+    """
+    Rate limiter of the messages of a connection: a token bucket per message type
+    for the connection, and another one for its user shared by every connection
+    of the user in this process.
+
+    A message is allowed when both buckets of its type have a token, and only then
+    are the tokens taken, so throttled messages do not use up the limit. Checking a
+    message costs a couple of dict lookups and some arithmetic, cheap enough to be
+    done for every frame. It is meant to be used from the event loop of the process,
+    so it is not thread-safe.
+
+    Attributes:
+        user_id (int): The ID of the user of the connection.
+        limits (dict): The (rate, burst) per message type of the connection.
+        user_limits (dict): The (rate, burst) per message type of the user.
+    """
+
+    def __init__(self, user_id, limits, user_limits, registry=user_buckets):
+        self.user_id = user_id
+        self.limits = limits
+        self.user_limits = user_limits
+        self._registry = registry
+        self._buckets = {}
+        self._user_buckets = registry.acquire(user_id)
+
+    @staticmethod
+    def _bucket(buckets, limits, message_type, now):
+        """
+        Returns the bucket of a message type, created full, or None if the type is not limited.
+        """
+        bucket = buckets.get(message_type)
+        if bucket is None:
+            limit = limits.get(message_type)
+            if limit is None:
+                return None
+            rate, burst = limit
+            bucket = buckets[message_type] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def check(self, message_type, now=None):
+        """
+        Counts a message against the limits of its type.
+
+        Args:
+            message_type (str): The type of the message.
+            now (float, optional): The monotonic time. Defaults to the current one.
+
+        Returns:
+            float: 0 if the message is allowed, otherwise the seconds until it would be.
+        """
+        if now is None:
+            now = time.monotonic()
+        bucket = self._bucket(self._buckets, self.limits, message_type, now)
+        user_bucket = self._bucket(self._user_buckets, self.user_limits, message_type, now)
+        wait = max(
+            bucket.wait_time(now) if bucket is not None else 0.0,
+            user_bucket.wait_time(now) if user_bucket is not None else 0.0
+        )
+        if wait:
+            return wait
+        if bucket is not None:
+            bucket.take()
+        if user_bucket is not None:
+            user_bucket.take()
+        return 0.0
+
+    def close(self):
+        """
+        Releases the buckets of the user, when the connection is closed.
+        """
+        self._registry.release(self.user_id)
+
+
+def create_rate_limiter(user_id):
+    """
+    Creates the RateLimiter of a connection configured by the NOTIFICATIONS_WS_*RATE_LIMITS settings.
+
+    Args:
+        user_id (int): The ID of the user of the connection.
+
+    Returns:
+        RateLimiter: The limiter.
+    """
+    return RateLimiter(user_id, get_rate_limits(), get_user_rate_limits())
@@ -0,0 +1,108 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from notification.models import NotificationSubscription, Tag
+from notification.services.fanout import tag_broadcast_is_enabled
+from notification.services.subscribers import invalidate_subscriber_index, patch_subscriber_index
+from notification.services.websocket.notifications import send_subscription_change
+
+
+@receiver(pre_save, sender=NotificationSubscription)
+def remember_previous_tag(sender, instance, **kwargs):
+    """
+    Stores the tag a subscription had before it is updated, so the user can be
+    removed from the subscriber index of the old tag and its consumers can leave
+    the group of the old tag.
+    """
+    instance._previous_tag_id = None
+    if instance.pk is not None:
+        instance._previous_tag_id = sender.objects.filter(
+            pk=instance.pk
+        ).values_list('tag_id', flat=True).first()
+
+
+@receiver(post_save, sender=NotificationSubscription)
+def subscription_saved(sender, instance, created, **kwargs):
+    """
+    Makes the connected consumers of the user join the group of the subscribed tag
+    once the subscription is committed.
+    """
+    if not tag_broadcast_is_enabled():
+        return
+    user_id, tag_id = instance.user_id, instance.tag_id
+    previous_tag_id = getattr(instance, '_previous_tag_id', None)
+    if not created and previous_tag_id == tag_id:
+        return
+
+    def notify():
+        if previous_tag_id is not None:
+            send_subscription_change(user_id, previous_tag_id, subscribed=False)
+        send_subscription_change(user_id, tag_id, subscribed=True)
+
+    transaction.on_commit(notify, robust=True)
+
+
+@receiver(post_delete, sender=NotificationSubscription)
+def subscription_deleted(sender, instance, **kwargs):
+    """
+    Makes the connected consumers of the user leave the group of the tag once the
+    subscription deletion is committed.
+    """
+    if not tag_broadcast_is_enabled():
+        return
+    user_id, tag_id = instance.user_id, instance.tag_id
+    transaction.on_commit(
+        lambda: send_subscription_change(user_id, tag_id, subscribed=False),
+        robust=True
+    )
+
+
+@receiver(post_save, sender=NotificationSubscription)
+def patch_index_on_save(sender, instance, created, **kwargs):
+    """
+    Adds the user to the subscriber index of the subscribed tag, and removes it
+    from the one of the previous tag, once the subscription is committed.
+    """
+    user_id, tag_id = instance.user_id, instance.tag_id
+    previous_tag_id = getattr(instance, '_previous_tag_id', None)
+    if not created and previous_tag_id == tag_id:
+        return
+
+    def patch():
+        if previous_tag_id is not None:
+            patch_subscriber_index(previous_tag_id, user_id, subscribed=False)
+        patch_subscriber_index(tag_id, user_id, subscribed=True)
+
+    transaction.on_commit(patch, robust=True)
+
+
+@receiver(post_delete, sender=NotificationSubscription)
+def patch_index_on_delete(sender, instance, **kwargs):
+    """
+    Removes the user from the subscriber index of the tag once the subscription
+    deletion is committed.
+    """
+    user_id, tag_id = instance.user_id, instance.tag_id
+    transaction.on_commit(
+        lambda: patch_subscriber_index(tag_id, user_id, subscribed=False),
+        robust=True
+    )
+
+
+@receiver(post_save, sender=Tag)
+def invalidate_index_of_new_tag(sender, instance, created, **kwargs):
+    """
+    Discards any index cached for the id of a new tag, e.g. left by a tag whose
+    creation was rolled back and whose id was reused.
+    """
+    if created:
+        invalidate_subscriber_index(instance.pk)
+
+
+@receiver(post_delete, sender=Tag)
+def invalidate_index_of_deleted_tag(sender, instance, **kwargs):
+    """
+    Discards the index cached for a deleted tag.
+    """
+    invalidate_subscriber_index(instance.pk)
@@ -1,16 +1,68 @@
+import asyncio
+import importlib
+import json
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from auditlog.models import LogEntry
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.apps import apps as django_apps
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
 from django.core.management import call_command
 
 from notification.models import (
-    Tag, Notification, NotificationSubscription, UserNotification
+    Tag, Notification, NotificationSubscription, UserNotification, NotificationOutbox, IdempotencyKey
+)
+from notification.queryset import (
+    InvalidCursor, get_cursor_paginated_notifications, get_notifications_page, get_paginated_notifications,
+    mark_notification_as_deleted, mark_notification_as_read,
+    mark_notifications_as_deleted, mark_notifications_as_read
 )
 from notification.serializers import (
     TagSerializer, NotificationSerializer,
-    NotificationSubscriptionSerializer, UserNotificationSerializer
+    NotificationSubscriptionSerializer, UserNotificationSerializer,
+    user_notification_to_dict
+)
+from notification.services import fanout, metrics
+from notification.services.counters import get_unread_count, inbox_count_key, unread_count_key
+from notification.services.database import run_in_db_pool
+from notification.services import idempotency
+from notification.services.fanout import (
+    deliver_notification, deliver_notifications, fan_out_notification, fan_out_notifications
+)
+from notification.services.websocket.authentication import TokenCache, get_token_cache
+from notification.services.websocket.consumers import NotificationConsumer
+from notification.services.websocket import encoding
+from notification.services.websocket.encoding import (
+    dumps, encode_fragment, encode_notification, pack_ids, unpack_ids
+)
+from notification.services.websocket.notifications import (
+    broadcast_real_time_notification, send_real_time_notifications, send_real_time_patch
+)
+from notification.services.websocket.throttling import RateLimiter, TokenBucket, UserBuckets, user_buckets
+from notification.services.websocket.outbound import (
+    DISCONNECT, DROP_OLDEST, OVERFLOW_CLOSE_CODE, RESYNC, RESYNC_FRAME, OutboundBuffer
+)
+from notification.services.outbox import enqueue_fanout, process_outbox
+from notification.services.retention import get_orphan_notifications, purge_orphan_notifications_chunk
+from notification.services.dispatcher import ScheduledDispatcher, release_time
+from notification.services.scheduler import DeliveryScheduler
+from notification.services.subscribers import (
+    get_subscriber_ids, invalidate_subscriber_index, subscriber_index_key
 )
 
 
@@ -54,7 +106,7 @@ class NotificationSerializersTest(APITestCase):
 
     def test_tag_serializer(self):
         serializer = TagSerializer(self.tag)
-        self.assertEqual(serializer.data, {'id': self.tag.id, 'name': 'Test Tag'})
+        self.assertEqual(serializer.data, {'id': self.tag.id, 'name': 'Test Tag', 'digest_window': 0})
 
     def test_notification_serializer(self):
         serializer = NotificationSerializer(self.notification)
@@ -62,7 +114,9 @@ class NotificationSerializersTest(APITestCase):
             'id': self.notification.id,
             'tag': self.tag.id,
             'message': 'Test Notification',
-            'timestamp': self.notification.timestamp.isoformat()
+            'timestamp': self.notification.timestamp.isoformat(),
+            'priority': Notification.NORMAL,
+            'deliver_at': None
         })
 
     def test_notification_subscription_serializer(self):
@@ -126,3 +180,1893 @@ class NotificationViewsTest(APITestCase):
         response = self.client.post(url, data)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertTrue(NotificationSubscription.objects.filter(user=self.user, tag=self.tag).exists())
+
+
+class NotificationFanOutTest(APITestCase):
+
+    def setUp(self):
+        self.tag = Tag.objects.create(name='Fan Out Tag')
+        self.other_tag = Tag.objects.create(name='Other Tag')
+        self.users = [
+            User.objects.create_user(username=f'subscriber{index}', password='testpass')
+            for index in range(3)
+        ]
+        for user in self.users:
+            NotificationSubscription.objects.create(user=user, tag=self.tag)
+        self.outsider = User.objects.create_user(username='outsider', password='testpass')
+        NotificationSubscription.objects.create(user=self.outsider, tag=self.other_tag)
+
+    def test_fan_out_creates_one_row_per_subscriber(self):
+        notification = Notification.objects.create(tag=self.tag, message='Fan out')
+        recipients = fan_out_notification(notification)
+
+        self.assertEqual(sorted(user_id for _, user_id in recipients), [user.id for user in self.users])
+        self.assertEqual(
+            sorted(recipients),
+            sorted(UserNotification.objects.filter(notification=notification).values_list('id', 'user_id'))
+        )
+
+    def test_fan_out_denormalizes_timestamp_and_tag(self):
+        notification = Notification.objects.create(tag=self.tag, message='Fan out')
+        fan_out_notification(notification)
+
+        for user_notification in UserNotification.objects.filter(notification=notification):
+            self.assertEqual(user_notification.timestamp, notification.timestamp)
+            self.assertEqual(user_notification.tag_id, self.tag.id)
+
+    def test_fan_out_skips_existing_rows(self):
+        notification = Notification.objects.create(tag=self.tag, message='Fan out')
+        fan_out_notification(notification)
+
+        self.assertEqual(fan_out_notification(notification), [])
+        self.assertEqual(UserNotification.objects.filter(notification=notification).count(), 3)
+
+    def test_fan_out_chunked_fallback(self):
+        notification = Notification.objects.create(tag=self.tag, message='Fan out')
+        with mock.patch.object(fanout, 'supports_insert_select_returning', return_value=False):
+            recipients = fan_out_notification(notification, chunk_size=2)
+
+        self.assertEqual(len(recipients), 3)
+        self.assertEqual(
+            sorted(recipients),
+            sorted(UserNotification.objects.filter(notification=notification).values_list('id', 'user_id'))
+        )
+
+    def test_fan_out_many_groups_recipients_by_notification(self):
+        for chunked in (False, True):
+            notifications = [
+                Notification.objects.create(tag=tag, message='Fan out') for tag in (self.tag, self.other_tag, self.tag)
+            ]
+            with mock.patch.object(fanout, 'supports_insert_select_returning', return_value=not chunked):
+                recipients = fan_out_notifications(notifications, chunk_size=2)
+
+            for notification in notifications:
+                self.assertEqual(
+                    sorted(recipients[notification.id]),
+                    sorted(UserNotification.objects.filter(notification=notification).values_list('id', 'user_id'))
+                )
+            self.assertEqual(len(recipients[notifications[0].id]), 3)
+            self.assertEqual(recipients[notifications[1].id][0][1], self.outsider.id)
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=False, NOTIFICATIONS_TAG_BROADCAST=True)
+    def test_create_notification_pushes_to_subscribers(self):
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(f'tag_{self.tag.id}', channel_name)
+
+        self.client.force_authenticate(self.users[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('notification:notification-list'),
+                {'tag': self.tag.id, 'message': 'Realtime'}
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        user_notification = UserNotification.objects.get(
+            user=self.users[0], notification_id=response.data['id']
+        )
+        message = async_to_sync(channel_layer.receive)(channel_name)
+        self.assertEqual(message['type'], 'tag_notification')
+        # The recipients are sorted by user ID, with 8 bytes per recipient in each array.
+        self.assertEqual(list(unpack_ids(message['user_ids'])), [user.id for user in self.users])
+        self.assertEqual(len(message['ids']), 8 * len(self.users))
+        self.assertEqual(
+            list(unpack_ids(message['ids'])),
+            [UserNotification.objects.get(user=user, notification_id=response.data['id']).id for user in self.users]
+        )
+        self.assertEqual(
+            json.loads(encode_notification(user_notification.id, False, message['encoded'])),
+            {
+                'id': user_notification.id,
+                'is_read': False,
+                'message': 'Realtime',
+                'timestamp': user_notification.timestamp.isoformat()
+            }
+        )
+        self.assertFalse(UserNotification.objects.filter(user=self.outsider).exists())
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=False, NOTIFICATIONS_TAG_BROADCAST=False)
+    def test_create_notification_pushes_to_each_subscriber_without_broadcast(self):
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(f'notifications_{self.users[0].id}', channel_name)
+
+        self.client.force_authenticate(self.users[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('notification:notification-list'),
+                {'tag': self.tag.id, 'message': 'Realtime'}
+            )
+
+        message = async_to_sync(channel_layer.receive)(channel_name)
+        self.assertEqual(message['type'], 'notification_message')
+        self.assertEqual(
+            message['id'],
+            UserNotification.objects.get(user=self.users[0], notification_id=response.data['id']).id
+        )
+
+
+class NotificationOutboxTest(APITestCase):
+
+    def setUp(self):
+        self.tag = Tag.objects.create(name='Outbox Tag')
+        self.users = [
+            User.objects.create_user(username=f'subscriber{index}', password='testpass')
+            for index in range(5)
+        ]
+        for user in self.users:
+            NotificationSubscription.objects.create(user=user, tag=self.tag)
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=True)
+    def test_create_notification_enqueues_fanout(self):
+        self.client.force_authenticate(self.users[0])
+        response = self.client.post(
+            reverse('notification:notification-list'),
+            {'tag': self.tag.id, 'message': 'Queued'}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        outbox = NotificationOutbox.objects.get(notification_id=response.data['id'])
+        self.assertEqual(outbox.status, NotificationOutbox.PENDING)
+        self.assertFalse(UserNotification.objects.exists())
+
+    @override_settings(NOTIFICATIONS_TAG_BROADCAST=True)
+    def test_worker_drains_outbox(self):
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(f'tag_{self.tag.id}', channel_name)
+        notification = Notification.objects.create(tag=self.tag, message='Queued')
+        enqueue_fanout(notification)
+
+        call_command('run_fanout_worker', '--once', '--chunk-size', '2', stdout=StringIO())
+
+        outbox = NotificationOutbox.objects.get(notification=notification)
+        self.assertEqual(outbox.status, NotificationOutbox.DONE)
+        self.assertEqual(outbox.last_user_id, self.users[-1].id)
+        self.assertEqual(UserNotification.objects.filter(notification=notification).count(), 5)
+        # One broadcast per chunk, with the map of its users.
+        messages = [async_to_sync(channel_layer.receive)(channel_name) for _ in range(3)]
+        self.assertEqual(
+            [list(unpack_ids(message['user_ids'])) for message in messages],
+            [
+                [self.users[0].id, self.users[1].id],
+                [self.users[2].id, self.users[3].id],
+                [self.users[4].id]
+            ]
+        )
+        self.assertEqual(json.loads('{%s}' % messages[0]['encoded'])['message'], 'Queued')
+
+    def test_failed_fanout_resumes_from_checkpoint(self):
+        notification = Notification.objects.create(tag=self.tag, message='Queued')
+        enqueue_fanout(notification)
+
+        with mock.patch(
+            'notification.services.fanout.broadcast_real_time_notification',
+            side_effect=[None, ConnectionError('channel layer down')]
+        ):
+            process_outbox(chunk_size=2)
+
+        outbox = NotificationOutbox.objects.get(notification=notification)
+        self.assertEqual(outbox.status, NotificationOutbox.PENDING)
+        self.assertEqual(outbox.attempts, 1)
+        self.assertEqual(outbox.last_user_id, self.users[1].id)
+        self.assertIn('channel layer down', outbox.last_error)
+
+        NotificationOutbox.objects.filter(id=outbox.id).update(available_at=outbox.created_at)
+        with mock.patch('notification.services.fanout.broadcast_real_time_notification') as send:
+            process_outbox(chunk_size=2)
+
+        outbox.refresh_from_db()
+        self.assertEqual(outbox.status, NotificationOutbox.DONE)
+        self.assertEqual(outbox.attempts, 2)
+        # The interrupted chunk is delivered again, then the remaining one.
+        self.assertEqual(
+            [[user_id for _, user_id in call.args[1]] for call in send.call_args_list],
+            [[self.users[2].id, self.users[3].id], [self.users[4].id]]
+        )
+        self.assertEqual(UserNotification.objects.filter(notification=notification).count(), 5)
+
+
+class DeliverySchedulerTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tag = Tag.objects.create(name='Lane Tag')
+        self.users = [
+            User.objects.create_user(username=f'lane{index}', password='testpass')
+            for index in range(4)
+        ]
+        for user in self.users:
+            NotificationSubscription.objects.create(user=user, tag=self.tag)
+
+    def enqueue(self, message, priority):
+        notification = Notification.objects.create(tag=self.tag, message=message, priority=priority)
+        enqueue_fanout(notification)
+        return notification
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=True)
+    def test_priority_is_set_through_the_api_and_copied_to_the_outbox(self):
+        self.client.force_authenticate(self.users[0])
+        response = self.client.post(
+            reverse('notification:notification-list'),
+            {'tag': self.tag.id, 'message': 'Security alert', 'priority': Notification.HIGH},
+            format='json'
+        )
+
+        self.assertEqual(response.data['priority'], Notification.HIGH)
+        outbox = NotificationOutbox.objects.get(notification_id=response.data['id'])
+        self.assertEqual(outbox.priority, Notification.HIGH)
+
+    def test_high_priority_preempts_a_low_fan_out_between_chunks(self):
+        blast = self.enqueue('Marketing', Notification.LOW)
+        scheduler = DeliveryScheduler(chunk_size=1, refill_interval=0)
+        with mock.patch('notification.services.fanout.broadcast_real_time_notification') as send:
+            # The first chunk of the blast is created and pushed.
+            scheduler.step()
+            scheduler.step()
+            alert = self.enqueue('Security alert', Notification.HIGH)
+            while scheduler.step():
+                pass
+
+        delivered = [call.args[0].id for call in send.call_args_list]
+        self.assertEqual(delivered[0], blast.id)
+        self.assertEqual(delivered[1:5], [alert.id] * 4)
+        self.assertEqual(delivered.count(blast.id), 4)
+        self.assertEqual(
+            set(NotificationOutbox.objects.values_list('status', flat=True)), {NotificationOutbox.DONE}
+        )
+        self.assertEqual(UserNotification.objects.count(), 8)
+
+    def test_lanes_share_the_steps_by_weight(self):
+        scheduler = DeliveryScheduler(weights={Notification.HIGH: 2, Notification.NORMAL: 1, Notification.LOW: 0})
+        for lane in scheduler.lanes:
+            lane.fanout.append((None, 0))
+
+        picks = [scheduler.next_lane().priority for _ in range(6)]
+        self.assertEqual(picks.count(Notification.HIGH), 4)
+        self.assertEqual(picks.count(Notification.NORMAL), 2)
+        # A lane with weight 0 only runs when the others are idle.
+        scheduler.lanes[0].fanout.clear()
+        scheduler.lanes[1].fanout.clear()
+        self.assertEqual(scheduler.next_lane().priority, Notification.LOW)
+
+    def test_queue_wait_is_observed_per_lane(self):
+        self.enqueue('Alert', Notification.HIGH)
+        scheduler = DeliveryScheduler(chunk_size=10)
+        with mock.patch('notification.services.fanout.broadcast_real_time_notification'), \
+                mock.patch.object(metrics.lane_wait, 'observe') as observe:
+            while scheduler.step():
+                pass
+
+        self.assertEqual(
+            [call.kwargs for call in observe.call_args_list],
+            [
+                {'lane': 'high', 'queue': 'fanout'},
+                {'lane': 'high', 'queue': 'push'},
+                {'lane': 'high', 'queue': 'fanout'},
+            ]
+        )
+        self.assertEqual(scheduler.claimed, 1)
+
+
+class ScheduledDispatcherTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tag = Tag.objects.create(name='Scheduled Tag')
+        self.users = [
+            User.objects.create_user(username=f'scheduled{index}', password='testpass')
+            for index in range(3)
+        ]
+        for user in self.users:
+            NotificationSubscription.objects.create(user=user, tag=self.tag)
+        self.now = timezone.now()
+
+    def schedule(self, count, seconds):
+        return Notification.objects.bulk_create([
+            Notification(tag=self.tag, message=f'Scheduled {index}', deliver_at=self.now + timedelta(seconds=seconds))
+            for index in range(count)
+        ])
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=True)
+    def test_future_deliver_at_is_left_to_the_dispatcher(self):
+        self.client.force_authenticate(self.users[0])
+        url = reverse('notification:notification-list')
+        deliver_at = self.now + timedelta(hours=1)
+        response = self.client.post(
+            url, {'tag': self.tag.id, 'message': 'Later', 'deliver_at': deliver_at.isoformat()}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIsNotNone(response.data['deliver_at'])
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+        # A time in the past means right away.
+        response = self.client.post(
+            url, {'tag': self.tag.id, 'message': 'Now', 'deliver_at': self.now.isoformat()}, format='json'
+        )
+        self.assertIsNone(response.data['deliver_at'])
+        self.assertEqual(NotificationOutbox.objects.get().notification_id, response.data['id'])
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=True)
+    def test_due_notifications_are_released_in_batches_with_a_few_queries(self):
+        def release(count):
+            self.schedule(count, 30)
+            dispatcher = ScheduledDispatcher(batch_size=1000)
+            with CaptureQueriesContext(connection) as queries:
+                released = dispatcher.run_once(self.now + timedelta(seconds=31))
+            self.assertEqual(released, count)
+            return len(queries)
+
+        self.assertEqual(release(5), release(100))
+        released = Notification.objects.filter(dispatched_at__isnull=False)
+        self.assertEqual(released.count(), 105)
+        self.assertEqual(NotificationOutbox.objects.count(), 105)
+        # Sorted in the inbox by when they were released.
+        self.assertEqual(set(released.values_list('timestamp', flat=True)), {self.now + timedelta(seconds=31)})
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=False)
+    def test_release_fans_out_through_the_subscriber_path(self):
+        [notification] = self.schedule(1, 10)
+        dispatcher = ScheduledDispatcher()
+        self.assertEqual(dispatcher.run_once(self.now), 0)
+        self.assertEqual(len(dispatcher), 1)
+
+        with mock.patch('notification.services.fanout.broadcast_real_time_notification') as send, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(dispatcher.run_once(self.now + timedelta(seconds=10)), 1)
+
+        self.assertEqual(UserNotification.objects.filter(notification=notification).count(), 3)
+        send.assert_called_once()
+        # Released only once.
+        self.assertEqual(dispatcher.run_once(self.now + timedelta(seconds=120)), 0)
+
+    def test_incremental_loads_pick_up_new_notifications(self):
+        dispatcher = ScheduledDispatcher(window=60, poll_interval=5)
+        self.schedule(2, 120)
+        dispatcher.run_once(self.now)
+        # Beyond the window.
+        self.assertEqual(len(dispatcher), 0)
+
+        self.schedule(1, 20)
+        with CaptureQueriesContext(connection) as queries:
+            dispatcher.run_once(self.now + timedelta(seconds=5))
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(dispatcher), 1)
+
+        # The whole window is read again, and the first one is due.
+        self.assertEqual(dispatcher.run_once(self.now + timedelta(seconds=65)), 1)
+        self.assertEqual(len(dispatcher), 2)
+        self.assertEqual(dispatcher.run_once(self.now + timedelta(seconds=130)), 2)
+
+    def test_jitter_spreads_the_notifications_due_together(self):
+        notifications = self.schedule(100, 0)
+        times = [
+            release_time(notification.id, notification.deliver_at, 10) - notification.deliver_at.timestamp()
+            for notification in notifications
+        ]
+        self.assertTrue(all(0 <= offset < 10 for offset in times))
+        self.assertGreater(len({int(offset) for offset in times}), 5)
+
+        dispatcher = ScheduledDispatcher(jitter=10, batch_size=1000)
+        released = dispatcher.run_once(self.now + timedelta(seconds=5))
+        self.assertTrue(0 < released < 100)
+
+    def test_pending_scheduled_notifications_are_not_purged_as_orphans(self):
+        Notification.objects.bulk_create([
+            Notification(tag=self.tag, message='Next year', deliver_at=self.now + timedelta(days=365)),
+        ])
+        Notification.objects.update(timestamp=self.now - timedelta(days=30))
+
+        call_command('purge_notifications', stdout=StringIO())
+        self.assertEqual(Notification.objects.count(), 1)
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=True)
+    def test_command_releases_the_due_notifications(self):
+        self.schedule(3, -1)
+        out = StringIO()
+        call_command('run_notification_dispatcher', '--once', stdout=out)
+
+        self.assertIn('Released 3 scheduled notifications.', out.getvalue())
+        self.assertEqual(NotificationOutbox.objects.count(), 3)
+
+
+@override_settings(NOTIFICATIONS_FANOUT_ASYNC=False)
+class DigestTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tag = Tag.objects.create(name='Digest Tag', digest_window=60)
+        self.users = [
+            User.objects.create_user(username=f'digest{index}', password='testpass')
+            for index in range(3)
+        ]
+        for user in self.users:
+            NotificationSubscription.objects.create(user=user, tag=self.tag)
+        self.client.force_authenticate(self.users[0])
+        self.url = reverse('notification:notification-list')
+
+    def post(self, message):
+        with mock.patch('notification.services.digest.send_real_time_patch') as patch, \
+                mock.patch('notification.services.fanout.broadcast_real_time_notification') as send, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'tag': self.tag.id, 'message': message}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return patch, send
+
+    def test_burst_is_collapsed_into_one_digest(self):
+        _, send = self.post('First')
+        send.assert_called_once()
+        for index in range(9):
+            patch, send = self.post(f'Update {index}')
+            send.assert_not_called()
+            patch.assert_called_once()
+
+        digest = Notification.objects.get(digest_until__isnull=False)
+        self.assertEqual((digest.message, digest.digest_count), ('Update 8', 10))
+        self.assertEqual(digest.merged.count(), 9)
+        # The rows of a single notification for the whole burst.
+        self.assertEqual(UserNotification.objects.count(), 3)
+
+        digest_, recipients, broadcast = patch.call_args.args
+        self.assertEqual(digest_.digest_count, 10)
+        self.assertEqual(
+            sorted(recipients),
+            sorted(UserNotification.objects.values_list('id', 'user_id'))
+        )
+
+    def test_read_digest_becomes_unread_on_merge(self):
+        self.post('First')
+        user_notification = UserNotification.objects.get(user=self.users[0])
+        mark_notification_as_read(user_notification.id, self.users[0].id)
+        self.assertEqual(get_unread_count(self.users[0].id), 0)
+
+        self.post('Second')
+        user_notification.refresh_from_db()
+        self.assertFalse(user_notification.is_read)
+        self.assertEqual(get_unread_count(self.users[0].id), 1)
+        self.assertEqual(get_unread_count(self.users[1].id), 1)
+
+    def test_new_digest_is_opened_when_the_window_ends(self):
+        self.post('First')
+        Notification.objects.update(digest_until=timezone.now())
+        _, send = self.post('Next window')
+        send.assert_called_once()
+        self.assertEqual(Notification.objects.filter(digest_until__isnull=False).count(), 2)
+        self.assertEqual(UserNotification.objects.count(), 6)
+
+    def test_bulk_burst_opens_a_single_digest(self):
+        other_tag = Tag.objects.create(name='Plain Tag')
+        items = [{'tag': self.tag.id, 'message': f'Bulk {index}'} for index in range(5)]
+        items.append({'tag': other_tag.id, 'message': 'Plain'})
+        with mock.patch('notification.services.digest.send_real_time_patch') as patch, \
+                mock.patch('notification.services.fanout.broadcast_real_time_notification'), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('notification:notification-bulk'), items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        digest = Notification.objects.get(digest_until__isnull=False)
+        self.assertEqual((digest.message, digest.digest_count), ('Bulk 4', 5))
+        self.assertEqual(UserNotification.objects.filter(notification=digest).count(), 3)
+        # Opened in the same batch, so the recipients get it as a new notification.
+        patch.assert_not_called()
+
+    def test_tag_without_window_is_not_collapsed(self):
+        self.tag.digest_window = 0
+        self.tag.save()
+        self.post('First')
+        self.post('Second')
+        self.assertEqual(UserNotification.objects.count(), 6)
+        self.assertFalse(Notification.objects.filter(digest_until__isnull=False).exists())
+
+    def test_merged_notifications_are_not_purged_as_orphans(self):
+        for message in ['First', 'Second', 'Third']:
+            self.post(message)
+        Notification.objects.update(timestamp=timezone.now() - timedelta(days=40))
+
+        call_command('purge_notifications', '--chunk-size', '1', stdout=StringIO())
+        digest = Notification.objects.get(digest_until__isnull=False)
+        self.assertEqual(digest.merged.count(), 2)
+
+    def test_digest_is_purged_with_its_merged_notifications(self):
+        for message in ['First', 'Second', 'Third']:
+            self.post(message)
+        Notification.objects.update(timestamp=timezone.now() - timedelta(days=40), digest_until=timezone.now())
+        UserNotification.objects.all().delete()
+
+        # A single chunk: the digest, whose merged notifications have higher ids.
+        deleted, _ = purge_orphan_notifications_chunk(get_orphan_notifications(0, 365, 30), 0, 1)
+        connection.check_constraints()
+        self.assertEqual(deleted, 3)
+        self.assertFalse(Notification.objects.exists())
+
+
+class NotificationBulkCreateTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tag = Tag.objects.create(name='Bulk Tag')
+        self.other_tag = Tag.objects.create(name='Other Bulk Tag')
+        self.users = [
+            User.objects.create_user(username=f'subscriber{index}', password='testpass')
+            for index in range(3)
+        ]
+        for user in self.users:
+            NotificationSubscription.objects.create(user=user, tag=self.tag)
+        NotificationSubscription.objects.create(user=self.users[0], tag=self.other_tag)
+        self.url = reverse('notification:notification-bulk')
+        self.client.force_authenticate(self.users[0])
+
+    def items(self, count):
+        return [
+            {'tag': (self.tag if index % 2 == 0 else self.other_tag).id, 'message': f'Bulk {index}'}
+            for index in range(count)
+        ]
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=False)
+    def test_bulk_create_fans_out_every_notification(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, self.items(3), format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['created'], response.data['failed']), (3, 0))
+        ids = [result['data']['id'] for result in response.data['results']]
+        self.assertEqual(
+            [Notification.objects.get(id=notification_id).message for notification_id in ids],
+            ['Bulk 0', 'Bulk 1', 'Bulk 2']
+        )
+        self.assertEqual(UserNotification.objects.filter(notification_id=ids[0]).count(), 3)
+        self.assertEqual(
+            list(UserNotification.objects.filter(notification_id=ids[1]).values_list('user_id', flat=True)),
+            [self.users[0].id]
+        )
+        [entry] = LogEntry.objects.get_for_model(UserNotification)
+        self.assertEqual(entry.additional_data['count'], 7)
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=False)
+    def test_bulk_create_queries_do_not_grow_with_the_batch(self):
+        def count_queries(items):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.post(self.url, items, format='json')
+            return len(queries)
+
+        self.assertEqual(count_queries(self.items(2)), count_queries(self.items(20)))
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=True)
+    def test_partial_failures_are_reported_per_item(self):
+        items = [
+            {'tag': self.tag.id, 'message': 'Valid'},
+            {'tag': 999999, 'message': 'Unknown tag'},
+            {'tag': self.tag.id},
+        ]
+        response = self.client.post(self.url, items, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual((response.data['created'], response.data['failed']), (1, 2))
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            [status.HTTP_201_CREATED, status.HTTP_400_BAD_REQUEST, status.HTTP_400_BAD_REQUEST]
+        )
+        self.assertIn('tag', response.data['results'][1]['errors'])
+        self.assertIn('message', response.data['results'][2]['errors'])
+        self.assertEqual(list(Notification.objects.values_list('message', flat=True)), ['Valid'])
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+    def test_invalid_batches_are_rejected(self):
+        response = self.client.post(self.url, [{'tag': 999999, 'message': 'Unknown tag'}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['created'], 0)
+
+        response = self.client.post(self.url, {'tag': self.tag.id, 'message': 'Not a list'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with override_settings(NOTIFICATIONS_BULK_CREATE_MAX_SIZE=2):
+            response = self.client.post(self.url, self.items(3), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Notification.objects.exists())
+
+    def test_unread_counters_are_incremented_once_per_user(self):
+        get_unread_count(self.users[0].id)
+        notifications = [
+            Notification.objects.create(tag=self.tag, message='First'),
+            Notification.objects.create(tag=self.other_tag, message='Second'),
+        ]
+        with mock.patch('notification.services.fanout.broadcast_real_time_notification') as send:
+            deliver_notifications(notifications, fan_out_notifications(notifications))
+
+        self.assertEqual(cache.get(unread_count_key(self.users[0].id)), 2)
+        self.assertEqual(send.call_count, 2)
+
+
+class IdempotencyKeyTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tag = Tag.objects.create(name='Idempotent Tag')
+        self.users = [
+            User.objects.create_user(username=f'idempotent{index}', password='testpass')
+            for index in range(2)
+        ]
+        for user in self.users:
+            NotificationSubscription.objects.create(user=user, tag=self.tag)
+        self.url = reverse('notification:notification-list')
+        self.client.force_authenticate(self.users[0])
+        self.body = {'tag': self.tag.id, 'message': 'Only once'}
+
+    def post(self, body=None, key='retry-1', url=None):
+        return self.client.post(url or self.url, body or self.body, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=False)
+    def test_retry_returns_the_original_response_without_a_second_fan_out(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.post()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            retry = self.post()
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(callbacks, [])
+        self.assertEqual(Notification.objects.count(), 1)
+        self.assertEqual(UserNotification.objects.count(), 2)
+
+        # Another key, or no key, creates a new notification.
+        self.post(key='retry-2')
+        self.client.post(self.url, self.body, format='json')
+        self.assertEqual(Notification.objects.count(), 3)
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=True)
+    def test_retry_is_answered_from_the_database_when_the_cache_is_lost(self):
+        first = self.post()
+        cache.clear()
+        retry = self.post()
+
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Notification.objects.count(), 1)
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+    def test_key_reused_with_a_different_request_is_rejected(self):
+        self.post()
+        response = self.post({'tag': self.tag.id, 'message': 'Something else'})
+
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Notification.objects.count(), 1)
+
+    def test_failed_requests_can_be_retried_with_the_same_key(self):
+        self.assertEqual(self.post({'tag': self.tag.id}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post({'tag': self.tag.id}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post().status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.post(key='').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_keys_are_scoped_per_user(self):
+        self.post()
+        self.client.force_authenticate(self.users[1])
+        self.post()
+
+        self.assertEqual(Notification.objects.count(), 2)
+
+    def test_bulk_create_is_idempotent(self):
+        url = reverse('notification:notification-bulk')
+        items = [{'tag': self.tag.id, 'message': f'Bulk {index}'} for index in range(3)]
+        first = self.post(items, url=url)
+        retry = self.post(items, url=url)
+
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Notification.objects.count(), 3)
+
+    def test_duplicate_in_progress_waits_for_the_first_request(self):
+        first = self.post()
+        cache_key = idempotency.idempotency_cache_key(self.users[0].id, 'retry-1')
+        stored = cache.get(cache_key)
+        # The first request is still in progress: it holds the lock and has not stored its response.
+        cache.delete(cache_key)
+        cache.add(idempotency.idempotency_lock_key(self.users[0].id, 'retry-1'), True)
+
+        def finish(seconds):
+            cache.set(cache_key, stored)
+
+        with mock.patch('notification.services.idempotency.time.sleep', side_effect=finish) as sleep:
+            retry = self.post()
+
+        sleep.assert_called_once()
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Notification.objects.count(), 1)
+
+    @override_settings(NOTIFICATIONS_IDEMPOTENCY_WAIT_TIMEOUT=0)
+    def test_duplicate_gets_a_conflict_when_the_first_request_does_not_finish(self):
+        cache.add(idempotency.idempotency_lock_key(self.users[0].id, 'retry-1'), True)
+        response = self.post()
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn('Retry-After', response)
+        self.assertFalse(Notification.objects.exists())
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=True)
+    def test_unique_constraint_rolls_back_a_concurrent_duplicate(self):
+        first = self.post()
+        cache.clear()
+        # Another process holds the key but its response is not visible yet, e.g. its lock expired.
+        real = idempotency.get_stored_response
+        with mock.patch(
+            'notification.services.idempotency.get_stored_response', side_effect=[None, real(self.users[0].id, 'retry-1')]
+        ):
+            retry = self.post()
+
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Notification.objects.count(), 1)
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+    @override_settings(NOTIFICATIONS_IDEMPOTENCY_TTL=0)
+    def test_expired_keys_are_processed_again_and_purged(self):
+        self.post()
+        self.post()
+        self.assertEqual(Notification.objects.count(), 2)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+        self.assertEqual(idempotency.purge_expired_idempotency_keys(), 1)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class InboxEndpointTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.tag = Tag.objects.create(name='Inbox Tag')
+        NotificationSubscription.objects.create(user=self.user, tag=self.tag)
+        self.user_notifications = [
+            UserNotification.objects.create(
+                user=self.user,
+                notification=Notification.objects.create(tag=self.tag, message=f'Notification {index}')
+            )
+            for index in range(3)
+        ]
+        self.url = reverse('notification:notification-inbox')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def test_inbox_is_paginated_by_cursor(self):
+        response = self.client.get(self.url, {'page_size': 2})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [row['message'] for row in response.data['data']], ['Notification 2', 'Notification 1']
+        )
+        self.assertTrue(response.data['has_more'])
+        self.assertIn('private', response['Cache-Control'])
+
+        next_page = self.client.get(self.url, {'page_size': 2, 'cursor': response.data['next_cursor']})
+        self.assertEqual([row['message'] for row in next_page.data['data']], ['Notification 0'])
+        self.assertNotEqual(next_page['ETag'], response['ETag'])
+
+        invalid = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(invalid.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_unchanged_inbox_is_not_modified_without_queries(self):
+        etag = self.client.get(self.url)['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_read_delete_and_fan_out_change_the_etag(self):
+        etags = [self.client.get(self.url)['ETag']]
+
+        mark_notification_as_read(self.user_notifications[0].id, self.user.id)
+        etags.append(self.client.get(self.url)['ETag'])
+        mark_notification_as_deleted(self.user_notifications[1].id, self.user.id)
+        etags.append(self.client.get(self.url)['ETag'])
+        notification = Notification.objects.create(tag=self.tag, message='New')
+        with mock.patch('notification.services.fanout.broadcast_real_time_notification'):
+            deliver_notification(notification, fan_out_notification(notification))
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etags[-1])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['data'][0]['message'], 'New')
+        etags.append(response['ETag'])
+        self.assertEqual(len(set(etags)), 4)
+
+
+class NotificationPaginationTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.tag = Tag.objects.create(name='Test Tag')
+        self.user_notifications = []
+        for index in range(7):
+            notification = Notification.objects.create(tag=self.tag, message=f'Notification {index}')
+            self.user_notifications.append(
+                UserNotification.objects.create(user=self.user, notification=notification)
+            )
+        # Two notifications sharing the same timestamp are ordered by id.
+        UserNotification.objects.filter(id=self.user_notifications[4].id).update(
+            timestamp=self.user_notifications[3].timestamp
+        )
+        UserNotification.objects.filter(id=self.user_notifications[5].id).update(is_deleted=True)
+
+    def test_cursor_pagination_walks_the_inbox(self):
+        ids, cursor, pages = [], None, 0
+        while True:
+            data, cursor, has_more = get_cursor_paginated_notifications(self.user.id, cursor, page_size=2)
+            ids.extend(item['id'] for item in data)
+            pages += 1
+            self.assertEqual(has_more, cursor is not None)
+            if not has_more:
+                break
+
+        expected = [
+            user_notification.id for user_notification in reversed(self.user_notifications)
+            if user_notification.id != self.user_notifications[5].id
+        ]
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, 3)
+
+    def test_cursor_pagination_fetches_one_page(self):
+        with self.assertNumQueries(1):
+            data, _, has_more = get_cursor_paginated_notifications(self.user.id, page_size=2)
+        self.assertEqual(len(data), 2)
+        self.assertTrue(has_more)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            get_cursor_paginated_notifications(self.user.id, 'not-a-cursor')
+
+    def test_offset_pagination_excludes_deleted(self):
+        data, total_pages = get_paginated_notifications(self.user.id, 1, page_size=10)
+        self.assertEqual(total_pages, 1)
+        self.assertEqual(len(data), 6)
+        self.assertNotIn(self.user_notifications[5].id, [item['id'] for item in data])
+
+
+    def test_count_free_pagination_reports_has_more(self):
+        with self.assertNumQueries(1):
+            data, has_more, total = get_notifications_page(self.user.id, 3, page_size=2)
+        self.assertEqual(len(data), 2)
+        self.assertFalse(has_more)
+        self.assertIsNone(total)
+
+        _, has_more, _ = get_notifications_page(self.user.id, 2, page_size=2)
+        self.assertTrue(has_more)
+
+    def test_approximate_total_is_cached_and_exact_on_demand(self):
+        cache.delete(inbox_count_key(self.user.id))
+        self.assertEqual(get_notifications_page(self.user.id, 1, total='approximate')[2], 6)
+        with self.assertNumQueries(1):
+            get_notifications_page(self.user.id, 1, total='approximate')
+
+        mark_notification_as_deleted(self.user_notifications[0].id, self.user.id)
+        self.assertEqual(cache.get(inbox_count_key(self.user.id)), 5)
+
+        cache.set(inbox_count_key(self.user.id), 100)
+        self.assertEqual(get_notifications_page(self.user.id, 1, total='approximate')[2], 100)
+        self.assertEqual(get_notifications_page(self.user.id, 1, total='exact')[2], 5)
+        self.assertEqual(cache.get(inbox_count_key(self.user.id)), 5)
+
+        with self.assertRaises(ValueError):
+            get_notifications_page(self.user.id, 1, total='sometimes')
+
+class UserNotificationBackfillTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.tag = Tag.objects.create(name='Test Tag')
+        self.notifications = [
+            Notification.objects.create(tag=self.tag, message=f'Notification {index}')
+            for index in range(5)
+        ]
+        for notification in self.notifications:
+            UserNotification.objects.create(user=self.user, notification=notification)
+        UserNotification.objects.update(timestamp=None, tag=None)
+
+    def test_backfill_copies_timestamp_and_tag(self):
+        call_command('backfill_user_notifications', '--chunk-size', '2', stdout=StringIO())
+
+        for user_notification in UserNotification.objects.select_related('notification'):
+            self.assertEqual(user_notification.timestamp, user_notification.notification.timestamp)
+            self.assertEqual(user_notification.tag_id, self.tag.id)
+
+    def test_backfill_resumes_from_start_id(self):
+        first, *rest = UserNotification.objects.order_by('id')
+        call_command('backfill_user_notifications', '--start-id', str(rest[0].id), stdout=StringIO())
+
+        first.refresh_from_db()
+        self.assertIsNone(first.timestamp)
+        self.assertFalse(UserNotification.objects.filter(id__in=[item.id for item in rest], timestamp=None).exists())
+
+    def test_migration_backfills_before_the_inbox_reads_the_copy(self):
+        backfill = importlib.import_module(
+            'notification.migrations.0009_backfill_usernotification_timestamp'
+        ).backfill_timestamp_and_tag
+        backfill(django_apps, None)
+
+        self.assertFalse(UserNotification.objects.filter(timestamp=None).exists())
+        data, next_cursor, has_more = get_cursor_paginated_notifications(self.user.id, None, 2)
+        self.assertEqual(len(data), 2)
+        self.assertTrue(has_more)
+        self.assertIsNotNone(next_cursor)
+
+
+class UnreadCountTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.tag = Tag.objects.create(name='Test Tag')
+        NotificationSubscription.objects.create(user=self.user, tag=self.tag)
+        self.user_notifications = [
+            UserNotification.objects.create(
+                user=self.user,
+                notification=Notification.objects.create(tag=self.tag, message=f'Notification {index}')
+            )
+            for index in range(3)
+        ]
+
+    def test_counter_is_rebuilt_once(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_unread_count(self.user.id), 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_unread_count(self.user.id), 3)
+
+    def test_fan_out_increments_cached_counter(self):
+        get_unread_count(self.user.id)
+        notification = Notification.objects.create(tag=self.tag, message='New')
+        deliver_notification(notification, fan_out_notification(notification))
+
+        self.assertEqual(cache.get(unread_count_key(self.user.id)), 4)
+
+    def test_read_and_delete_decrement_counter_once(self):
+        get_unread_count(self.user.id)
+        mark_notification_as_read(self.user_notifications[0].id, self.user.id)
+        mark_notification_as_read(self.user_notifications[0].id, self.user.id)
+        mark_notification_as_deleted(self.user_notifications[0].id, self.user.id)
+        mark_notification_as_deleted(self.user_notifications[1].id, self.user.id)
+
+        self.assertEqual(cache.get(unread_count_key(self.user.id)), 1)
+        cache.clear()
+        self.assertEqual(get_unread_count(self.user.id), 1)
+
+
+class BulkUpdateTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.other_user = User.objects.create_user(username='otheruser', password='testpass')
+        self.tag = Tag.objects.create(name='Test Tag')
+        self.user_notifications = [
+            UserNotification.objects.create(
+                user=self.user,
+                notification=Notification.objects.create(tag=self.tag, message=f'Notification {index}')
+            )
+            for index in range(4)
+        ]
+        self.foreign = UserNotification.objects.create(
+            user=self.other_user, notification=self.user_notifications[0].notification
+        )
+
+    def test_read_many_is_scoped_to_the_user(self):
+        ids = [self.user_notifications[0].id, self.user_notifications[1].id, self.foreign.id]
+        # The SELECT, the UPDATE and the batch audit entry.
+        with self.assertNumQueries(3):
+            affected = mark_notifications_as_read(self.user.id, ids)
+
+        self.assertEqual(sorted(affected), ids[:2])
+        self.assertFalse(UserNotification.objects.get(id=self.foreign.id).is_read)
+        self.assertEqual(mark_notifications_as_read(self.user.id, ids), [])
+
+    def test_read_all(self):
+        get_unread_count(self.user.id)
+        affected = mark_notifications_as_read(self.user.id)
+
+        self.assertEqual(sorted(affected), [item.id for item in self.user_notifications])
+        self.assertEqual(get_unread_count(self.user.id), 0)
+        self.assertEqual(get_unread_count(self.other_user.id), 1)
+
+    def test_delete_many(self):
+        get_unread_count(self.user.id)
+        mark_notifications_as_read(self.user.id, [self.user_notifications[0].id])
+        affected = mark_notifications_as_deleted(
+            self.user.id, [self.user_notifications[0].id, self.user_notifications[1].id, self.foreign.id]
+        )
+
+        self.assertEqual(sorted(affected), [self.user_notifications[0].id, self.user_notifications[1].id])
+        self.assertEqual(get_unread_count(self.user.id), 2)
+        self.assertFalse(UserNotification.objects.get(id=self.foreign.id).is_deleted)
+
+
+class AuditPolicyTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.tag = Tag.objects.create(name='Audit Tag')
+        self.users = [
+            User.objects.create_user(username=f'subscriber{index}', password='testpass')
+            for index in range(3)
+        ]
+        for user in self.users:
+            NotificationSubscription.objects.create(user=user, tag=self.tag)
+        self.notification = Notification.objects.create(tag=self.tag, message='Audited')
+
+    def user_notification_entries(self):
+        return LogEntry.objects.get_for_model(UserNotification)
+
+    def test_fan_out_writes_one_batch_entry(self):
+        recipients = fan_out_notification(self.notification)
+
+        [entry] = self.user_notification_entries()
+        ids = sorted(user_notification_id for user_notification_id, _ in recipients)
+        self.assertEqual(entry.action, LogEntry.Action.CREATE)
+        self.assertEqual(entry.object_pk, f'{ids[0]}-{ids[-1]}')
+        self.assertEqual(entry.additional_data['count'], 3)
+        self.assertEqual(entry.additional_data['notification_id'], self.notification.id)
+
+    def test_bulk_read_writes_one_batch_entry_with_actor(self):
+        fan_out_notification(self.notification)
+        user = self.users[0]
+        mark_notifications_as_read(user.id)
+
+        entry = self.user_notification_entries().filter(action=LogEntry.Action.UPDATE).get()
+        self.assertEqual(entry.actor_id, user.id)
+        self.assertEqual(entry.changes, {'is_read': ['False', 'True']})
+        self.assertEqual(entry.additional_data['count'], 1)
+
+    @override_settings(NOTIFICATIONS_AUDIT_POLICY={'notification.UserNotification': 'row'})
+    def test_row_policy_writes_one_entry_per_row(self):
+        recipients = fan_out_notification(self.notification)
+
+        self.assertEqual(
+            sorted(int(pk) for pk in self.user_notification_entries().values_list('object_pk', flat=True)),
+            sorted(user_notification_id for user_notification_id, _ in recipients)
+        )
+
+    @override_settings(NOTIFICATIONS_AUDIT_POLICY={'notification.UserNotification': 'off'})
+    def test_off_policy_writes_nothing(self):
+        fan_out_notification(self.notification)
+        self.assertFalse(self.user_notification_entries().exists())
+
+    def test_tags_and_subscriptions_are_audited_per_row(self):
+        self.assertEqual(LogEntry.objects.get_for_model(Tag).count(), 1)
+        self.assertEqual(LogEntry.objects.get_for_model(NotificationSubscription).count(), 3)
+
+
+class PurgeNotificationsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.tag = Tag.objects.create(name='Purge Tag')
+        now = timezone.now()
+        self.old = self.create_user_notification('Old', now - timedelta(days=400))
+        self.deleted = self.create_user_notification('Deleted', now - timedelta(days=40), is_deleted=True)
+        self.recent_deleted = self.create_user_notification('Recent', now - timedelta(days=1), is_deleted=True)
+        self.kept = self.create_user_notification('Kept', now - timedelta(days=40))
+        self.orphan = Notification.objects.create(tag=self.tag, message='Orphan')
+        self.queued = Notification.objects.create(tag=self.tag, message='Queued')
+        enqueue_fanout(self.queued)
+        Notification.objects.filter(id__in=[self.orphan.id, self.queued.id]).update(
+            timestamp=now - timedelta(days=40)
+        )
+
+    def create_user_notification(self, message, timestamp, is_deleted=False):
+        notification = Notification.objects.create(tag=self.tag, message=message)
+        Notification.objects.filter(id=notification.id).update(timestamp=timestamp)
+        notification.refresh_from_db()
+        return UserNotification.objects.create(user=self.user, notification=notification, is_deleted=is_deleted)
+
+    def test_purges_expired_rows_and_orphans(self):
+        self.assertEqual(get_unread_count(self.user.id), 2)
+        call_command('purge_notifications', '--chunk-size', '1', stdout=StringIO())
+
+        self.assertEqual(
+            set(UserNotification.objects.values_list('id', flat=True)),
+            {self.recent_deleted.id, self.kept.id}
+        )
+        self.assertEqual(
+            set(Notification.objects.values_list('id', flat=True)),
+            {self.recent_deleted.notification_id, self.kept.notification_id, self.queued.id}
+        )
+        self.assertEqual(get_unread_count(self.user.id), 1)
+        self.assertIsNone(cache.get('purge_notifications_user_notification_checkpoint'))
+
+    def test_notifications_fanned_out_to_no_one_are_kept_as_long_as_their_rows(self):
+        unaddressed = Notification.objects.create(tag=self.tag, message='No subscribers')
+        Notification.objects.filter(id=unaddressed.id).update(timestamp=timezone.now() - timedelta(days=2))
+
+        call_command('purge_notifications', stdout=StringIO())
+        self.assertTrue(Notification.objects.filter(id=unaddressed.id).exists())
+        self.assertFalse(Notification.objects.filter(id=self.orphan.id).exists())
+
+        # Without retention no row is purged, so nothing is an orphan.
+        self.assertFalse(get_orphan_notifications(0, 0, None).exists())
+
+    def test_resumes_from_checkpoint(self):
+        cache.set('purge_notifications_user_notification_checkpoint', self.old.id)
+        call_command('purge_notifications', stdout=StringIO())
+
+        self.assertTrue(UserNotification.objects.filter(id=self.old.id).exists())
+        self.assertFalse(UserNotification.objects.filter(id=self.deleted.id).exists())
+
+
+class SubscriberIndexTest(TestCase):
+
+    def setUp(self):
+        self.tag = Tag.objects.create(name='Index Tag')
+        self.other_tag = Tag.objects.create(name='Other Index Tag')
+        self.users = [
+            User.objects.create_user(username=f'subscriber{index}', password='testpass')
+            for index in range(4)
+        ]
+        for user in self.users[:3]:
+            NotificationSubscription.objects.create(user=user, tag=self.tag)
+
+    def index_version(self, tag):
+        get_subscriber_ids(tag.id)
+        return cache.get(subscriber_index_key(tag.id))[0]
+
+    def test_warm_index_fans_out_without_subscription_query(self):
+        notification = Notification.objects.create(tag=self.tag, message='Hot tag')
+        get_subscriber_ids(self.tag.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            recipients, last_user_id = fanout.fan_out_notification_chunk(notification, 0, 2)
+
+        self.assertEqual([user_id for _, user_id in recipients], [user.id for user in self.users[:2]])
+        self.assertEqual(last_user_id, self.users[1].id)
+        self.assertFalse(
+            any(NotificationSubscription._meta.db_table in query['sql'] for query in queries.captured_queries)
+        )
+
+    def test_subscription_changes_patch_the_index(self):
+        version = self.index_version(self.tag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            subscription = NotificationSubscription.objects.create(user=self.users[3], tag=self.tag)
+        with self.captureOnCommitCallbacks(execute=True):
+            NotificationSubscription.objects.get(user=self.users[0], tag=self.tag).delete()
+
+        # Patched in place, not rebuilt.
+        with self.assertNumQueries(0):
+            self.assertEqual(list(get_subscriber_ids(self.tag.id)), [user.id for user in self.users[1:]])
+        self.assertEqual(cache.get(subscriber_index_key(self.tag.id))[0], version + 2)
+
+        get_subscriber_ids(self.other_tag.id)
+        subscription.tag = self.other_tag
+        with self.captureOnCommitCallbacks(execute=True):
+            subscription.save()
+
+        self.assertEqual(list(get_subscriber_ids(self.tag.id)), [user.id for user in self.users[1:3]])
+        self.assertEqual(list(get_subscriber_ids(self.other_tag.id)), [self.users[3].id])
+
+    def test_stale_index_is_rebuilt(self):
+        get_subscriber_ids(self.tag.id)
+        NotificationSubscription.objects.bulk_create([NotificationSubscription(user=self.users[3], tag=self.tag)])
+        invalidate_subscriber_index(self.tag.id)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(list(get_subscriber_ids(self.tag.id)), [user.id for user in self.users])
+        with self.assertNumQueries(0):
+            get_subscriber_ids(self.tag.id)
+
+
+class NotificationConsumerTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        get_token_cache().clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.tag = Tag.objects.create(name='Test Tag')
+        self.user_notification = UserNotification.objects.create(
+            user=self.user,
+            notification=Notification.objects.create(tag=self.tag, message='Test Notification')
+        )
+
+    def connect(self, token=None):
+        """
+        Opens a connection to NotificationConsumer and returns whether it was accepted.
+        """
+        async def run():
+            communicator = WebsocketCommunicator(
+                NotificationConsumer.as_asgi(),
+                f'/ws/notifications/?token={token or AccessToken.for_user(self.user)}'
+            )
+            connected, _ = await communicator.connect()
+            if connected:
+                await communicator.disconnect()
+            return connected
+
+        return async_to_sync(run)()
+
+    def communicate(self, *messages):
+        """
+        Connects to NotificationConsumer, sends the messages and returns the replies.
+        """
+        async def run():
+            communicator = WebsocketCommunicator(
+                NotificationConsumer.as_asgi(),
+                f'/ws/notifications/?token={AccessToken.for_user(self.user)}'
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            replies = []
+            for message in messages:
+                await communicator.send_json_to(message)
+                replies.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return replies
+
+        return async_to_sync(run)()
+
+    def test_unread_count(self):
+        replies = self.communicate({'type': 'unread_count'}, {'type': 'read', 'id': self.user_notification.id})
+        self.assertEqual(replies[0], {'type': 'unread_count', 'count': 1})
+        self.assertEqual(get_unread_count(self.user.id), 0)
+
+    def test_cursor_notifications_list(self):
+        [reply] = self.communicate({'type': 'notifications_list', 'cursor': None})
+        self.assertEqual(reply['type'], 'notifications_list')
+        self.assertEqual([item['id'] for item in reply['data']], [self.user_notification.id])
+        self.assertIsNone(reply['next_cursor'])
+        self.assertFalse(reply['has_more'])
+
+    def test_page_size_is_validated(self):
+        replies = self.communicate(
+            {'type': 'notifications_list', 'cursor': None, 'page_size': '20'},
+            {'type': 'notifications_list', 'cursor': None, 'page_size': None},
+            {'type': 'notifications_list', 'cursor': None, 'page_size': 'abc'},
+            {'type': 'notifications_list', 'page': 1, 'total': 'none', 'page_size': [20]}
+        )
+        self.assertEqual([item['id'] for item in replies[0]['data']], [self.user_notification.id])
+        self.assertEqual([item['id'] for item in replies[1]['data']], [self.user_notification.id])
+        self.assertEqual(replies[2], {'type': 'error', 'message': 'Invalid page size.'})
+        self.assertEqual(replies[3], {'type': 'error', 'message': 'Invalid page size.'})
+
+    def test_count_free_notifications_list(self):
+        [reply] = self.communicate({'type': 'notifications_list', 'page': 1, 'total': 'approximate'})
+        self.assertEqual([item['id'] for item in reply['data']], [self.user_notification.id])
+        self.assertFalse(reply['has_more'])
+        self.assertEqual(reply['total'], 1)
+        self.assertNotIn('total_pages', reply)
+
+    def test_read_all_sends_a_single_event(self):
+        other = UserNotification.objects.create(
+            user=self.user,
+            notification=Notification.objects.create(tag=self.tag, message='Other Notification')
+        )
+        [reply] = self.communicate({'type': 'read_all'})
+        self.assertEqual(reply['type'], 'read')
+        self.assertEqual(sorted(reply['ids']), [self.user_notification.id, other.id])
+
+    def test_noop_bulk_update_is_not_broadcast(self):
+        mark_notifications_as_read(self.user.id)
+        with mock.patch('channels.layers.InMemoryChannelLayer.group_send') as group_send, \
+                mock.patch('notification.queryset.bump_inbox_versions') as bump:
+            replies = self.communicate(
+                {'type': 'read_all'},
+                {'type': 'read', 'id': self.user_notification.id},
+                {'type': 'delete_many', 'ids': []}
+            )
+        self.assertEqual(replies, [
+            {'type': 'read', 'ids': []},
+            {'type': 'read', 'id': self.user_notification.id},
+            {'type': 'delete', 'ids': []}
+        ])
+        group_send.assert_not_called()
+        bump.assert_not_called()
+
+    def test_read_many_rejects_invalid_ids(self):
+        [reply] = self.communicate({'type': 'read_many', 'ids': 'all'})
+        self.assertEqual(reply['type'], 'error')
+
+    # The queries of the pool threads run on their own connections, which assertNumQueries does not see.
+    @override_settings(NOTIFICATIONS_WS_DB_POOL_SIZE=0)
+    def test_handshake_is_cached_by_token(self):
+        token = str(AccessToken.for_user(self.user))
+        # The user fetch, then the subscribed tags, which are not cached.
+        with self.assertNumQueries(2):
+            self.assertTrue(self.connect(token))
+        with self.assertNumQueries(1):
+            self.assertTrue(self.connect(token))
+        # Without tag broadcast, the tag groups are not joined.
+        with override_settings(NOTIFICATIONS_TAG_BROADCAST=False), self.assertNumQueries(0):
+            self.assertTrue(self.connect(token))
+
+    @override_settings(NOTIFICATIONS_WS_TRUST_TOKEN_CLAIMS=True, NOTIFICATIONS_WS_DB_POOL_SIZE=0)
+    def test_handshake_trusting_claims_skips_user_fetch(self):
+        # Only the subscribed tags.
+        with self.assertNumQueries(1):
+            self.assertTrue(self.connect())
+
+    def test_database_work_runs_concurrently_on_the_pool(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def query(_):
+            # Blocks until the other call runs on another thread at the same time.
+            barrier.wait()
+            return threading.current_thread().name, UserNotification.objects.filter(user=self.user).count()
+
+        async def run():
+            return await asyncio.gather(run_in_db_pool(query, 1), run_in_db_pool(query, 2))
+
+        with override_settings(NOTIFICATIONS_WS_DB_POOL_SIZE=2):
+            results = async_to_sync(run)()
+        self.assertEqual(len({name for name, _ in results}), 2)
+        self.assertTrue(all(name.startswith('notifications-db') for name, _ in results))
+        self.assertEqual([count for _, count in results], [1, 1])
+
+    @override_settings(
+        NOTIFICATIONS_WS_RATE_LIMITS={'notifications_list': (0.001, 5)},
+        NOTIFICATIONS_WS_USER_RATE_LIMITS={}
+    )
+    def test_rate_limit_protects_the_database_from_a_tight_loop(self):
+        async def count_queries(func, *args):
+            queries.append(func)
+            return await run_in_db_pool(func, *args)
+
+        queries = []
+        with mock.patch(
+            'notification.services.websocket.consumers.run_in_db_pool', side_effect=count_queries
+        ):
+            replies = self.communicate(*[{'type': 'notifications_list', 'cursor': None}] * 50)
+
+        self.assertEqual([reply['type'] for reply in replies[:5]], ['notifications_list'] * 5)
+        throttled = replies[5:]
+        self.assertEqual({reply['type'] for reply in throttled}, {'throttled'})
+        self.assertEqual(throttled[0]['message_type'], 'notifications_list')
+        self.assertGreater(throttled[0]['retry_after'], 0)
+        # The subscribed tags of the handshake, then only the messages within the burst
+        # reached the database, with two calls each (the optional total and the page).
+        self.assertEqual(len(queries), 1 + 5 * 2)
+        # Other message types have their own limits.
+        [reply] = self.communicate({'type': 'unread_count'})
+        self.assertEqual(reply['type'], 'unread_count')
+        self.assertEqual(user_buckets._buckets, {})
+
+    @override_settings(
+        NOTIFICATIONS_WS_RATE_LIMITS={'read': (0.001, 5)},
+        NOTIFICATIONS_WS_USER_RATE_LIMITS={'read': (0.001, 3)}
+    )
+    def test_rate_limit_per_user_is_shared_by_its_connections(self):
+        # A different notification each time, so every allowed read changes one and is echoed.
+        user_notification_ids = [self.user_notification.id] + [
+            UserNotification.objects.create(
+                user=self.user,
+                notification=Notification.objects.create(tag=self.tag, message=f'Notification {index}')
+            ).id
+            for index in range(3)
+        ]
+
+        async def run():
+            communicators = []
+            for _ in range(2):
+                communicator = WebsocketCommunicator(
+                    NotificationConsumer.as_asgi(),
+                    f'/ws/notifications/?token={AccessToken.for_user(self.user)}'
+                )
+                await communicator.connect()
+                communicators.append(communicator)
+            replies = []
+            for index in range(4):
+                communicator = communicators[index % 2]
+                await communicator.send_json_to({'type': 'read', 'id': user_notification_ids[index]})
+                reply = await communicator.receive_json_from()
+                if reply['type'] != 'throttled':
+                    # Both tabs receive the read event.
+                    await communicators[1 - index % 2].receive_json_from()
+                replies.append(reply['type'])
+            for communicator in communicators:
+                await communicator.disconnect()
+            return replies
+
+        self.assertEqual(async_to_sync(run)(), ['read', 'read', 'read', 'throttled'])
+
+    def test_handshake_rejects_inactive_user(self):
+        User.objects.filter(id=self.user.id).update(is_active=False)
+        self.assertFalse(self.connect())
+
+    def create_notifications(self, count):
+        return [
+            UserNotification.objects.create(
+                user=self.user,
+                notification=Notification.objects.create(tag=self.tag, message=f'Missed {index}')
+            )
+            for index in range(count)
+        ]
+
+    def test_replay_on_connect_streams_missed_notifications(self):
+        missed = self.create_notifications(3)
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                NotificationConsumer.as_asgi(),
+                f'/ws/notifications/?token={AccessToken.for_user(self.user)}&since={self.user_notification.id}'
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            replies = [await communicator.receive_json_from()]
+            while not replies[-1]['done']:
+                replies.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return replies
+
+        with mock.patch('notification.services.websocket.consumers.REPLAY_CHUNK_SIZE', 2):
+            replies = async_to_sync(run)()
+        self.assertEqual(
+            [[item['id'] for item in reply['data']] for reply in replies],
+            [[missed[0].id, missed[1].id], [missed[2].id]]
+        )
+        self.assertFalse(replies[-1]['truncated'])
+
+    def test_replay_includes_rows_fanned_out_after_newer_ones(self):
+        older = Notification.objects.create(tag=self.tag, message='Low priority')
+        newer = Notification.objects.create(tag=self.tag, message='High priority')
+        # The high priority lane fans out first, the client sees its row and disconnects.
+        seen = UserNotification.objects.create(user=self.user, notification=newer)
+        late = UserNotification.objects.create(user=self.user, notification=older)
+        self.assertLess(late.timestamp, seen.timestamp)
+
+        [reply] = self.communicate({'type': 'replay', 'since': seen.id})
+        self.assertEqual([item['id'] for item in reply['data']], [late.id])
+        self.assertEqual(reply['cursor'], late.id)
+
+        [reply] = self.communicate({'type': 'replay', 'since': reply['cursor']})
+        self.assertEqual(reply['data'], [])
+        self.assertTrue(reply['done'])
+
+    def test_replay_drops_live_duplicates(self):
+        [missed] = self.create_notifications(1)
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                NotificationConsumer.as_asgi(),
+                f'/ws/notifications/?token={AccessToken.for_user(self.user)}'
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({'type': 'replay', 'since': self.user_notification.id})
+            replay = await communicator.receive_json_from()
+            # The push of the replayed notification, then one of a new notification.
+            await sync_to_async(send_real_time_notifications)(missed.notification, [(missed.id, self.user.id)])
+            await sync_to_async(send_real_time_notifications)(missed.notification, [(999, self.user.id)])
+            live = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return replay, live
+
+        NotificationSubscription.objects.create(user=self.user, tag=self.tag)
+        replay, live = async_to_sync(run)()
+        self.assertEqual([item['id'] for item in replay['data']], [missed.id])
+        self.assertTrue(replay['done'])
+        self.assertEqual(live['id'], 999)
+
+    @override_settings(NOTIFICATIONS_WS_COALESCE_WINDOW=0.05)
+    def test_burst_is_sent_in_one_batch_frame(self):
+        NotificationSubscription.objects.create(user=self.user, tag=self.tag)
+        notification = Notification.objects.create(tag=self.tag, message='Burst')
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                NotificationConsumer.as_asgi(),
+                f'/ws/notifications/?token={AccessToken.for_user(self.user)}'
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            for notification_id in (1, 2, 3):
+                await sync_to_async(send_real_time_notifications)(
+                    notification, [(notification_id, self.user.id)]
+                )
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        frame = async_to_sync(run)()
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual([item['id'] for item in frame['data']], [1, 2, 3])
+
+    def test_replay_rejects_unknown_notification(self):
+        [reply] = self.communicate({'type': 'replay', 'since': 999})
+        self.assertEqual(reply['type'], 'error')
+
+    @override_settings(NOTIFICATIONS_TAG_BROADCAST=True)
+    def test_tag_broadcast_reaches_recipients_only(self):
+        other_user = User.objects.create_user(username='otheruser', password='testpass')
+        for user in (self.user, other_user):
+            NotificationSubscription.objects.create(user=user, tag=self.tag)
+        notification = Notification.objects.create(tag=self.tag, message='Broadcast')
+        user_notification = UserNotification.objects.create(user=self.user, notification=notification)
+
+        async def run():
+            communicators = []
+            for user in (self.user, other_user):
+                communicator = WebsocketCommunicator(
+                    NotificationConsumer.as_asgi(),
+                    f'/ws/notifications/?token={AccessToken.for_user(user)}'
+                )
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                communicators.append(communicator)
+
+            # The other user is in the tag group but not in the map, e.g. subscribed after the fan-out.
+            await sync_to_async(broadcast_real_time_notification)(
+                notification, [(user_notification.id, self.user.id)]
+            )
+            reply = await communicators[0].receive_json_from()
+            self.assertTrue(await communicators[1].receive_nothing())
+            for communicator in communicators:
+                await communicator.disconnect()
+            return reply
+
+        reply = async_to_sync(run)()
+        self.assertEqual((reply['id'], reply['message']), (user_notification.id, 'Broadcast'))
+
+    @override_settings(NOTIFICATIONS_TAG_BROADCAST=True)
+    def test_digest_patch_updates_the_existing_item(self):
+        NotificationSubscription.objects.create(user=self.user, tag=self.tag)
+        digest = self.user_notification.notification
+        digest.message, digest.digest_count = 'Latest', 4
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                NotificationConsumer.as_asgi(),
+                f'/ws/notifications/?token={AccessToken.for_user(self.user)}'
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await sync_to_async(send_real_time_patch)(
+                digest, [(self.user_notification.id, self.user.id)], broadcast=True
+            )
+            reply = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return reply
+
+        reply = async_to_sync(run)()
+        self.assertEqual(reply, {
+            'type': 'patch', 'id': self.user_notification.id, 'is_read': False, 'message': 'Latest', 'count': 4
+        })
+
+    @override_settings(NOTIFICATIONS_TAG_BROADCAST=True)
+    def test_subscription_changes_update_tag_groups(self):
+        other_tag = Tag.objects.create(name='Other Tag')
+        notification = Notification.objects.create(tag=other_tag, message='Subscribed')
+        user_notification = UserNotification.objects.create(user=self.user, notification=notification)
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                NotificationConsumer.as_asgi(),
+                f'/ws/notifications/?token={AccessToken.for_user(self.user)}'
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            subscription = await sync_to_async(NotificationSubscription.objects.create)(
+                user=self.user, tag=other_tag
+            )
+            # Wait until the consumer handled the subscription event.
+            await communicator.send_json_to({'type': 'unread_count'})
+            await communicator.receive_json_from()
+            await sync_to_async(broadcast_real_time_notification)(notification, [(user_notification.id, self.user.id)])
+            reply = await communicator.receive_json_from()
+
+            await sync_to_async(subscription.delete)()
+            await communicator.send_json_to({'type': 'unread_count'})
+            await communicator.receive_json_from()
+            await sync_to_async(broadcast_real_time_notification)(notification, [(user_notification.id, self.user.id)])
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+            return reply
+
+        self.assertEqual(async_to_sync(run)()['id'], user_notification.id)
+
+
+class BenchmarkRealtimeTest(TransactionTestCase):
+
+    def test_every_connection_receives_every_notification(self):
+        stdout = StringIO()
+        call_command(
+            'benchmark_realtime', '--connections', '3', '--subscribers', '5',
+            '--notifications', '2', stdout=stdout
+        )
+        rows = stdout.getvalue().splitlines()[1:]
+        self.assertEqual([row.split()[-10] for row in rows], ['6', '6'])
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Tag.objects.exists())
+
+
+class TokenCacheTest(TestCase):
+
+    def test_entries_expire(self):
+        token_cache = TokenCache(max_size=10, ttl=60)
+        token_cache.set('token', True, ttl=-1)
+        token_cache.set('other', True)
+
+        self.assertIsNone(token_cache.get('token'))
+        self.assertTrue(token_cache.get('other'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        token_cache = TokenCache(max_size=2, ttl=60)
+        token_cache.set('first', True)
+        token_cache.set('second', True)
+        token_cache.get('first')
+        token_cache.set('third', True)
+
+        self.assertEqual(len(token_cache), 2)
+        self.assertIsNone(token_cache.get('second'))
+        self.assertTrue(token_cache.get('first'))
+
+
+class RateLimiterTest(TestCase):
+
+    def test_bucket_allows_a_burst_and_then_the_rate(self):
+        bucket = TokenBucket(rate=2, capacity=3, now=0.0)
+        for _ in range(3):
+            self.assertEqual(bucket.wait_time(0.0), 0)
+            bucket.take()
+        self.assertAlmostEqual(bucket.wait_time(0.0), 0.5)
+        self.assertEqual(bucket.wait_time(0.5), 0)
+        # Refills up to the burst only.
+        self.assertEqual(bucket.wait_time(100.0), 0)
+        self.assertEqual(bucket.tokens, 3)
+
+    def test_throttled_messages_do_not_use_up_the_limit(self):
+        registry = UserBuckets()
+        limiter = RateLimiter(1, {'read': (1, 2)}, {'read': (1, 1)}, registry)
+        self.assertEqual(limiter.check('read', now=0.0), 0)
+        self.assertAlmostEqual(limiter.check('read', now=0.0), 1.0)
+        # The connection bucket kept the token the user bucket refused.
+        self.assertEqual(limiter.check('read', now=1.0), 0)
+        self.assertEqual(limiter.check('unread_count', now=1.0), 0)
+
+        other = RateLimiter(1, {}, {'read': (1, 1)}, registry)
+        self.assertGreater(other.check('read', now=1.0), 0)
+        limiter.close()
+        other.close()
+        self.assertEqual(registry._buckets, {})
+
+    def test_check_is_cheap(self):
+        limiter = RateLimiter(1, {'read': (1e9, 1e9)}, {'read': (1e9, 1e9)}, UserBuckets())
+        start = time.perf_counter()
+        for _ in range(10000):
+            limiter.check('read')
+        # A few microseconds per frame, with a generous margin for slow machines.
+        self.assertLess((time.perf_counter() - start) / 10000, 50e-6)
+
+
+class OutboundBufferTest(TestCase):
+
+    def run_buffer(self, payloads, window=0.01, max_depth=10, overflow_policy=DROP_OLDEST):
+        """
+        Pushes the payloads at once into an OutboundBuffer and returns the sent frames
+        and the close codes.
+        """
+        frames, closes = [], []
+
+        async def send(payload):
+            frames.append(payload)
+
+        async def close(code):
+            closes.append(code)
+
+        async def run():
+            buffer = OutboundBuffer(send, close, window, max_depth, overflow_policy)
+            for payload in payloads:
+                await buffer.push(payload)
+            await asyncio.sleep(window * 5)
+
+        async_to_sync(run)()
+        return frames, closes
+
+    def test_coalesces_events_into_one_batch_frame(self):
+        frames, _ = self.run_buffer(['{"id":1}', '{"id":2}', '{"id":3}'])
+        self.assertEqual(frames, ['{"type":"batch","data":[{"id":1},{"id":2},{"id":3}]}'])
+
+    def test_single_event_is_sent_as_is(self):
+        self.assertEqual(self.run_buffer(['{"id":1}'])[0], ['{"id":1}'])
+
+    def test_without_window_sends_right_away(self):
+        frames, _ = self.run_buffer(['{"id":1}', '{"id":2}'], window=0)
+        self.assertEqual(frames, ['{"id":1}', '{"id":2}'])
+
+    def run_slow_client(self, payloads, overflow_policy):
+        """
+        Pushes the payloads without a window while the first frame waits for a slow
+        client, and returns the sent frames, the close codes and the dropped count.
+        """
+        frames, closes = [], []
+
+        async def run():
+            released = asyncio.Event()
+
+            async def send(payload):
+                frames.append(payload)
+                await released.wait()
+
+            async def close(code):
+                closes.append(code)
+
+            buffer = OutboundBuffer(send, close, 0, 2, overflow_policy)
+            for payload in payloads:
+                await buffer.push(payload)
+                # Lets the sender task start on the first frame.
+                await asyncio.sleep(0)
+            released.set()
+            await asyncio.sleep(0.01)
+            return buffer.dropped
+
+        dropped = async_to_sync(run)()
+        return frames, closes, dropped
+
+    def test_without_window_slow_client_drops_oldest_unsent_events(self):
+        frames, _, dropped = self.run_slow_client(
+            ['{"id":1}', '{"id":2}', '{"id":3}', '{"id":4}', '{"id":5}'], DROP_OLDEST
+        )
+        self.assertEqual(frames, ['{"id":1}', '{"id":4}', '{"id":5}'])
+        self.assertEqual(dropped, 2)
+
+    def test_without_window_slow_client_is_disconnected(self):
+        frames, closes, _ = self.run_slow_client(['{"id":1}', '{"id":2}', '{"id":3}', '{"id":4}'], DISCONNECT)
+        self.assertEqual((frames, closes), (['{"id":1}'], [OVERFLOW_CLOSE_CODE]))
+
+    def test_keyed_events_replace_the_queued_one(self):
+        frames, closes = [], []
+
+        async def send(payload):
+            frames.append(payload)
+
+        async def close(code):
+            closes.append(code)
+
+        async def run():
+            buffer = OutboundBuffer(send, close, 0.01, 10, DROP_OLDEST)
+            await buffer.push('{"id":1,"count":2}', key=1)
+            await buffer.push('{"id":2}')
+            await buffer.push('{"id":1,"count":3}', key=1)
+            await asyncio.sleep(0.05)
+
+        async_to_sync(run)()
+        self.assertEqual(frames, ['{"type":"batch","data":[{"id":1,"count":3},{"id":2}]}'])
+
+    def test_drop_oldest(self):
+        frames, _ = self.run_buffer(['{"id":1}', '{"id":2}', '{"id":3}'], max_depth=2)
+        self.assertEqual(json.loads(frames[0])['data'], [{'id': 2}, {'id': 3}])
+
+    def test_resync(self):
+        frames, _ = self.run_buffer(['{"id":1}', '{"id":2}', '{"id":3}'], max_depth=2, overflow_policy=RESYNC)
+        self.assertEqual(frames, [RESYNC_FRAME])
+
+    def test_disconnect(self):
+        frames, closes = self.run_buffer(
+            ['{"id":1}', '{"id":2}', '{"id":3}'], max_depth=2, overflow_policy=DISCONNECT
+        )
+        self.assertEqual((frames, closes), ([], [OVERFLOW_CLOSE_CODE]))
+
+
+@override_settings(NOTIFICATIONS_METRICS_ENABLED=True, NOTIFICATIONS_METRICS_TOKEN='secret')
+class MetricsTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        get_token_cache().clear()
+        metrics.registry.flush()
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.tag = Tag.objects.create(name='Metrics Tag')
+        NotificationSubscription.objects.create(user=self.user, tag=self.tag)
+
+    def scrape(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.content.decode()
+
+    @override_settings(NOTIFICATIONS_FANOUT_ASYNC=False)
+    def test_records_fan_out_and_websocket_metrics(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(
+            reverse('notification:notification-list'), {'tag': self.tag.id, 'message': 'Measured'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        async def run():
+            rejected = WebsocketCommunicator(NotificationConsumer.as_asgi(), '/ws/notifications/')
+            await rejected.connect()
+            communicator = WebsocketCommunicator(
+                NotificationConsumer.as_asgi(),
+                f'/ws/notifications/?token={AccessToken.for_user(self.user)}'
+            )
+            await communicator.connect()
+            await communicator.send_json_to({'type': 'notifications_list', 'cursor': None})
+            await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+        body = self.scrape()
+        self.assertIn('notifications_fanout_recipients_count{path="request"} 1', body)
+        self.assertIn('notifications_fanout_recipients_sum{path="request"} 1.0', body)
+        self.assertIn('notifications_group_send_duration_seconds_count{target="tag"} 1', body)
+        self.assertIn('notifications_ws_handshake_failures_total{reason="missing_token"} 1', body)
+        self.assertIn('notifications_ws_message_queries_total{type="notifications_list"} 1', body)
+        self.assertIn('notifications_ws_messages_total{type="notifications_list"} 1', body)
+        # Connected and disconnected.
+        self.assertIn('notifications_ws_connections 0', body)
+        self.assertIn('notifications_ws_groups 0', body)
+
+    @override_settings(NOTIFICATIONS_METRICS_ENABLED=False)
+    def test_disabled_metrics_record_nothing(self):
+        metrics.ws_messages.inc(type='read')
+        with metrics.fanout_duration.time(path='request'):
+            pass
+        metrics.registry.flush()
+        self.assertIsNone(cache.get(metrics.SERIES_KEY))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_requires_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(NOTIFICATIONS_METRICS_TOKEN=None)
+    def test_without_token_is_never_served(self):
+        # DEBUG as the raw string of DJANGO_DEBUG=False used to be read, which is truthy.
+        for debug in (True, False, 'False'):
+            with self.subTest(debug=debug), override_settings(DEBUG=debug):
+                self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_debug_setting_is_parsed_strictly(self):
+        for value, debug in (('False', False), ('false', False), ('0', False), ('True', True)):
+            with self.subTest(value=value), mock.patch.dict('os.environ', {'DJANGO_DEBUG': value}):
+                base = importlib.reload(importlib.import_module('notifications_system.settings.base'))
+                self.assertIs(base.DEBUG, debug)
+
+
+class EncodingTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.tag = Tag.objects.create(name='Test Tag')
+        self.user_notification = UserNotification.objects.create(
+            user=self.user,
+            notification=Notification.objects.create(tag=self.tag, message='Ünïcode "quoted"')
+        )
+
+    def test_row_to_dict_matches_serializer(self):
+        row = {
+            'id': self.user_notification.id,
+            'timestamp': self.user_notification.timestamp,
+            'is_read': False,
+            'message': self.user_notification.notification.message
+        }
+        self.assertEqual(user_notification_to_dict(row), UserNotificationSerializer(row).data)
+
+    def test_spliced_payload_is_valid_json(self):
+        for backend in ('json', 'auto', 'orjson') if encoding.orjson else ('json', 'auto'):
+            with self.subTest(backend=backend), override_settings(NOTIFICATIONS_JSON_BACKEND=backend):
+                fragment = encode_fragment({'message': 'Ünïcode "quoted"', 'timestamp': 'now'})
+                self.assertEqual(
+                    json.loads(encode_notification(7, True, fragment)),
+                    {'id': 7, 'is_read': True, 'message': 'Ünïcode "quoted"', 'timestamp': 'now'}
+                )
+                self.assertEqual(json.loads(dumps({'ids': [1, 2]})), {'ids': [1, 2]})
+
+    def test_packed_ids_round_trip(self):
+        ids = [1, 42, 2 ** 40]
+        packed = pack_ids(ids)
+        self.assertEqual(packed, b''.join(value.to_bytes(8, 'little') for value in ids))
+        self.assertEqual(list(unpack_ids(packed)), ids)
@@ -1,12 +1,42 @@
-from rest_framework import viewsets
+import hmac
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
-from .models import Tag, Notification, NotificationSubscription, UserNotification
+from rest_framework.response import Response
+from .authentication import CachedJWTAuthentication
+from .models import Tag, Notification, NotificationSubscription
+from .queryset import clamp_page_size, get_cursor_paginated_notifications, get_inbox_total
 from .serializers import (
     TagSerializer,
     NotificationSerializer,
     NotificationSubscriptionSerializer,
 )
-from .services.websocket.notifications import send_real_time_notification
+from .services import metrics
+from .services.counters import get_inbox_version
+from .services.digest import collapse_into_digests
+from .services.dispatcher import is_scheduled
+from .services.idempotency import idempotent
+from .services.fanout import (
+    deliver_notification,
+    deliver_notifications,
+    fan_out_notification,
+    fan_out_notifications,
+)
+from .services.outbox import enqueue_fanout, enqueue_fanouts, fanout_is_async
+
+
+def get_bulk_create_max_size():
+    """
+    Returns the maximum number of notifications accepted by a single bulk create request.
+    """
+    return getattr(settings, 'NOTIFICATIONS_BULK_CREATE_MAX_SIZE', 500)
 
 
 class TagViewSet(viewsets.ModelViewSet):
@@ -38,32 +68,187 @@ class NotificationViewSet(viewsets.ModelViewSet):
     queryset = Notification.objects.all()
     serializer_class = NotificationSerializer
 
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        """
+        Creates a notification, once per Idempotency-Key header, see `run_idempotent`.
+
+        A producer that retries a request that timed out with the same key gets the
+        original response, without a second notification or fan-out.
+        """
+        return super().create(request, *args, **kwargs)
+
     def perform_create(self, serializer):
         """
-        This method retrieves the tag associated with the notification, creates UserNotification
-        instances for users subscribed to that tag, and sends real-time notifications to those users.
+        This method saves the notification and delivers it to the users subscribed to its tag.
+
+        When NOTIFICATIONS_FANOUT_ASYNC is enabled, an outbox row is written in the same
+        transaction and the `run_fanout_worker` command does the fan-out, so the response
+        does not depend on the number of subscribers. Otherwise the UserNotification
+        instances are created in a single set-based step and the unread counters and
+        real-time notifications are updated once the transaction is committed.
+
+        A notification with a `deliver_at` in the future is only saved; the
+        `run_notification_dispatcher` command fans it out when it is due. A notification
+        merged into the open digest of its tag is not fanned out, see `collapse_into_digests`.
 
         Args:
             serializer (NotificationSerializer): The serializer instance used to save the notification.
         """
-        tag_id = self.request.data.get('tag', None)
-        tag = Tag.objects.get(id=tag_id)
-        notification = serializer.save()
-
-        user_ids = NotificationSubscription.objects.filter(
-            tag=tag
-        ).values_list(
-            'user_id', flat=True
+        with transaction.atomic():
+            notification = serializer.save()
+            if is_scheduled(notification):
+                return
+            if not collapse_into_digests([notification]):
+                return
+            if fanout_is_async():
+                enqueue_fanout(notification)
+                return
+            with metrics.fanout_duration.time(path='request'):
+                recipients = fan_out_notification(notification)
+            metrics.fanout_size.observe(len(recipients), path='request')
+            transaction.on_commit(
+                lambda: deliver_notification(notification, recipients)
+            )
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    @idempotent
+    def bulk(self, request):
+        """
+        Creates a list of notifications, each one a `{tag, message}` object, in one request.
+
+        The items are validated one by one and the valid ones are created together,
+        even if others fail: the notifications are inserted in a single transaction
+        and fanned out at once, see `perform_bulk_create`. The response has one result
+        per item, in order, with the created notification or the validation errors.
+        Its status is 201 when every item was created, 207 when only some of them
+        were, and 400 when none was or the body is not a list of at most
+        NOTIFICATIONS_BULK_CREATE_MAX_SIZE items.
+        Like `create`, it honours the Idempotency-Key header.
+
+        Returns:
+            Response: `{"created": n, "failed": n, "results": [{"index", "status", "data" or "errors"}]}`.
+        """
+        serializer = self.get_serializer(data=request.data, many=True, max_length=get_bulk_create_max_size())
+        if serializer.is_valid():
+            errors = [{}] * len(serializer.validated_data)
+        elif isinstance(serializer.errors, list):
+            errors = serializer.errors
+        else:
+            # The body itself is invalid, e.g. not a list.
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        notifications = self.perform_bulk_create(serializer) if serializer.valid_items else []
+        created = iter(self.get_serializer(notifications, many=True).data)
+        results = [
+            {'index': index, 'status': status.HTTP_400_BAD_REQUEST, 'errors': error}
+            if error else
+            {'index': index, 'status': status.HTTP_201_CREATED, 'data': next(created)}
+            for index, error in enumerate(errors)
+        ]
+
+        if not notifications:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif len(notifications) < len(results):
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_201_CREATED
+        return Response(
+            {'created': len(notifications), 'failed': len(results) - len(notifications), 'results': results},
+            status=response_status
         )
 
-        user_notifications = []
-        for user_id in user_ids:
-            user_notification = UserNotification.objects.create(
-                user_id=user_id,
-                notification=notification
+    def perform_bulk_create(self, serializer):
+        """
+        Saves the valid items of a bulk request and delivers them, like `perform_create`
+        but with one statement per step for the whole batch.
+
+        When NOTIFICATIONS_FANOUT_ASYNC is enabled, the outbox rows are written with a
+        single INSERT. Otherwise the UserNotification rows of every notification are
+        created together by `fan_out_notifications`, and the unread counters are
+        incremented once per recipient once the transaction is committed.
+        The scheduled notifications are left to the dispatcher and the ones merged into
+        a digest are not fanned out, as in `perform_create`.
+
+        Args:
+            serializer (NotificationListSerializer): The validated list serializer.
+
+        Returns:
+            list: The created Notification instances.
+        """
+        with transaction.atomic():
+            notifications = serializer.create(serializer.valid_items)
+            due = collapse_into_digests(
+                [notification for notification in notifications if not is_scheduled(notification)]
+            )
+            if not due:
+                return notifications
+            if fanout_is_async():
+                enqueue_fanouts(due)
+                return notifications
+            with metrics.fanout_duration.time(path='request'):
+                recipients = fan_out_notifications(due)
+            metrics.fanout_size.observe(sum(len(rows) for rows in recipients.values()), path='request')
+            transaction.on_commit(
+                lambda: deliver_notifications(due, recipients)
             )
-            user_notifications.append(user_notification)
-            send_real_time_notification(user_notification=user_notification)
+        return notifications
+
+    @action(detail=False, methods=['get'], authentication_classes=[CachedJWTAuthentication])
+    def inbox(self, request):
+        """
+        Lists the notifications of the authenticated user, newest first, by cursor.
+
+        It runs the same query as the WebSocket `notifications_list` message with a
+        `cursor`: the `cursor` parameter is the `next_cursor` of the previous page
+        and `page_size` is capped at MAX_PAGE_SIZE. The response carries an ETag made
+        of the inbox version of the user, which is bumped by fan-out, reads and
+        deletes, so a request whose If-None-Match matches it is answered 304 from
+        the cache without touching the database. A `total` parameter of 'approximate'
+        or 'exact' adds the number of notifications of the user, see `get_inbox_total`.
+
+        Returns:
+            Response: `{"data": [...], "next_cursor": str|null, "has_more": bool, "total": int}`, or 304.
+        """
+        cursor = request.query_params.get('cursor') or None
+        total_mode = request.query_params.get('total', 'none')
+        try:
+            page_size = clamp_page_size(request.query_params.get('page_size'))
+        except ValueError as error:
+            return Response({'detail': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        version = get_inbox_version(request.user.id)
+        etag = None
+        if version is not None:
+            page = zlib.crc32(f'{cursor}|{page_size}|{total_mode}'.encode())
+            etag = f'"{request.user.id}-{version}-{page:08x}"'
+            if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+            if etag in if_none_match or '*' in if_none_match:
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+                return self.add_inbox_cache_headers(response, etag)
+
+        try:
+            total = get_inbox_total(request.user.id, total_mode)
+            data, next_cursor, has_more = get_cursor_paginated_notifications(request.user.id, cursor, page_size)
+        except ValueError as error:
+            # An InvalidCursor, or an invalid total.
+            return Response({'detail': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        body = {'data': data, 'next_cursor': next_cursor, 'has_more': has_more}
+        if total is not None:
+            body['total'] = total
+        response = Response(body)
+        return self.add_inbox_cache_headers(response, etag)
+
+    @staticmethod
+    def add_inbox_cache_headers(response, etag):
+        """
+        Makes clients revalidate the inbox on every use, and keeps shared caches from storing it.
+        """
+        if etag:
+            response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization'])
+        return response
 
 
 class NotificationSubscriptionViewSet(viewsets.ModelViewSet):
@@ -71,6 +256,8 @@ class NotificationSubscriptionViewSet(viewsets.ModelViewSet):
     ViewSet for managing NotificationSubscription objects.
 
     Provides CRUD operations for NotificationSubscription instances. Accessible only by authenticated users.
+    Every write goes through `save()`/`delete()`, so the signals keep the cached subscriber
+    index of the tags up to date, see `notification.services.subscribers`.
 
     Permissions:
         - IsAuthenticated: Only authenticated users can access this view.
@@ -88,3 +275,31 @@ class NotificationSubscriptionViewSet(viewsets.ModelViewSet):
             serializer (NotificationSubscriptionSerializer): The serializer instance used to save the subscription.
         """
         serializer.save(user=self.request.user)
+
+
+def metrics_view(request):
+    """
+    Exposes the metrics of every process in the Prometheus text format.
+
+    Returns 404 when NOTIFICATIONS_METRICS_ENABLED is off. The scraper must send
+    NOTIFICATIONS_METRICS_TOKEN as `Authorization: Bearer <token>`, and 403 is
+    returned otherwise, also when no token is configured, whatever DEBUG says.
+
+    Args:
+        request (HttpRequest): The scrape request.
+
+    Returns:
+        HttpResponse: The metrics, see `Registry.render`.
+    """
+    if not metrics.ENABLED:
+        raise Http404
+    token = getattr(settings, 'NOTIFICATIONS_METRICS_TOKEN', None)
+    authorization = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        return HttpResponseForbidden()
+    # Publishes the deltas of this process, the other ones flush periodically.
+    metrics.registry.flush()
+    return HttpResponse(
+        metrics.registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
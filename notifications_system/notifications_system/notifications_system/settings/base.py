@@ -25,7 +25,8 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = os.environ.get("SECRET_KEY")
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = os.environ.get('DJANGO_DEBUG', True)
+# Parsed strictly: any value other than 'true' (e.g. 'False') turns it off.
+DEBUG = os.environ.get('DJANGO_DEBUG', 'True').lower() == 'true'
 
 ALLOWED_HOSTS = list(os.environ.get('DJANGO_ALLOWED_HOSTS', []))
 CORS_ALLOWED_ORIGINS = ast.literal_eval(os.environ.get('CORS_ALLOWED_ORIGINS', []))
@@ -101,6 +102,108 @@ SIMPLE_JWT = {
 
 # -----------------------------------------------------------
 
+# ------------------------ NOTIFICATIONS --------------------
+
+# Number of UserNotification rows written per statement when fanning out
+NOTIFICATIONS_FANOUT_CHUNK_SIZE = 1000
+# Maximum number of notifications accepted by a POST to /notifications/bulk/
+NOTIFICATIONS_BULK_CREATE_MAX_SIZE = 500
+
+# Fan out notifications in the `run_fanout_worker` process instead of the request. Off by default:
+# once on, notifications reach no one until a worker drains the outbox, and its real-time pushes
+# only reach the consumers of other processes through a shared channel layer (Redis)
+NOTIFICATIONS_FANOUT_ASYNC = os.environ.get('FANOUT_ASYNC', 'false').lower() == 'true'
+# Attempts of a fan-out before it is marked as failed
+NOTIFICATIONS_OUTBOX_MAX_ATTEMPTS = 5
+# Seconds a worker owns a fan-out without reporting progress before another one takes it over
+NOTIFICATIONS_OUTBOX_LEASE_SECONDS = 60
+# Share of the outbox worker steps (one chunk or one real-time push each) given to each priority
+# lane while several lanes have work, 0 runs a lane only when the others are idle, and seconds
+# between two claims of new fan-outs by a busy worker
+NOTIFICATIONS_LANE_WEIGHTS = {'high': 8, 'normal': 3, 'low': 1}
+NOTIFICATIONS_SCHEDULER_REFILL_SECONDS = 0.5
+# Scheduled notifications (`deliver_at`), see `run_notification_dispatcher`: seconds ahead kept in
+# memory, seconds between two loads of the new ones, notifications released per transaction, and
+# seconds over which the notifications due at the same time are spread (0 releases them on time)
+NOTIFICATIONS_DISPATCH_WINDOW_SECONDS = 60
+NOTIFICATIONS_DISPATCH_POLL_SECONDS = 5
+NOTIFICATIONS_DISPATCH_BATCH_SIZE = 500
+NOTIFICATIONS_DISPATCH_JITTER_SECONDS = 0
+# Send each real-time notification once per chunk of recipients to the group of its tag instead of
+# once per recipient; every connection finds its row in the packed map of the chunk
+NOTIFICATIONS_TAG_BROADCAST = True
+# Audit policy per model: 'row' (one LogEntry per row), 'batch' (one LogEntry per bulk
+# operation, per row for single saves) or 'off'. Unlisted models use 'row'.
+NOTIFICATIONS_AUDIT_POLICY = {
+    'notification.Tag': 'row',
+    'notification.Notification': 'row',
+    'notification.NotificationSubscription': 'row',
+    'notification.UserNotification': 'batch',
+}
+
+# Seconds the response of a request with an Idempotency-Key header is kept, and seconds a
+# duplicate waits for the first request to finish (also the lifetime of its lock)
+NOTIFICATIONS_IDEMPOTENCY_TTL = 60 * 60 * 24
+NOTIFICATIONS_IDEMPOTENCY_WAIT_TIMEOUT = 30
+
+# Seconds the sorted subscriber ids of each tag are kept in the cache for the chunked fan-out
+NOTIFICATIONS_SUBSCRIBER_INDEX_TIMEOUT = 60 * 60
+
+# Days a UserNotification is kept (0 keeps them forever), see `purge_notifications`
+NOTIFICATIONS_RETENTION_DAYS = 365
+# Days a soft-deleted UserNotification is kept
+NOTIFICATIONS_DELETED_RETENTION_DAYS = 30
+# Minimum hours a Notification without UserNotification rows is kept; it is also kept until it is
+# older than the shortest retention period above, the earliest its rows may have been purged
+NOTIFICATIONS_ORPHAN_GRACE_HOURS = 24
+
+# Seconds the per-user unread counters are kept in the cache
+NOTIFICATIONS_UNREAD_COUNT_TIMEOUT = 60 * 60 * 24
+
+# Validated WebSocket tokens cached per process (0 disables the cache) and for how many seconds,
+# also how long the inbox endpoint remembers that the user of a token is active
+NOTIFICATIONS_WS_TOKEN_CACHE_SIZE = 10000
+NOTIFICATIONS_WS_TOKEN_CACHE_TTL = 300
+# Accept WebSocket connections from the token claims alone, without fetching the user
+NOTIFICATIONS_WS_TRUST_TOKEN_CLAIMS = False
+# Threads (each with its own database connection) that run the database work of the WebSocket
+# consumers concurrently, 0 runs it on the single thread shared by every `sync_to_async` call
+NOTIFICATIONS_WS_DB_POOL_SIZE = 8
+# Seconds WebSocket events are held to be sent in a single batch frame (0 sends them as they come, one
+# frame per event; opt in only with clients that understand `batch` frames), maximum events waiting to be
+# sent per connection, e.g. to a slow client, and what happens beyond it: 'drop_oldest', 'resync' or 'disconnect'
+NOTIFICATIONS_WS_COALESCE_WINDOW = 0
+NOTIFICATIONS_WS_MAX_QUEUE_DEPTH = 1000
+NOTIFICATIONS_WS_OVERFLOW_POLICY = 'drop_oldest'
+
+# (rate per second, burst) of the WebSocket messages of each type, per connection and per user in each
+# process, checked before any database work; unlisted types are not limited
+NOTIFICATIONS_WS_RATE_LIMITS = {
+    'notifications_list': (5, 10),
+    'replay': (1, 3),
+    'unread_count': (5, 10),
+    'read': (20, 40),
+    'deleted': (20, 40),
+    'read_many': (2, 5),
+    'read_all': (1, 3),
+    'delete_many': (2, 5),
+}
+NOTIFICATIONS_WS_USER_RATE_LIMITS = {
+    message_type: (rate * 2, burst * 2) for message_type, (rate, burst) in NOTIFICATIONS_WS_RATE_LIMITS.items()
+}
+
+# JSON backend of the WebSocket payloads: 'orjson', 'json' or 'auto' (orjson if installed)
+NOTIFICATIONS_JSON_BACKEND = 'auto'
+
+# Metrics exposed at /metrics in the Prometheus format (False disables them at no cost), seconds
+# between the flushes of each process to the cache, and bearer token of the scraper, without
+# which /metrics answers 403
+NOTIFICATIONS_METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+NOTIFICATIONS_METRICS_FLUSH_SECONDS = 5
+NOTIFICATIONS_METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# -----------------------------------------------------------
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -24,7 +24,10 @@ DATABASES = {
         "USER": os.environ.get("POSTGRES_USER", ""),
         "PASSWORD": os.environ.get("POSTGRES_PASSWORD", ""),
         "HOST": os.environ.get("POSTGRES_HOST", "127.0.0.1"),
-        "PORT": os.environ.get("POSTGRES_PORT", 5432)
+        "PORT": os.environ.get("POSTGRES_PORT", 5432),
+        # Keeps the connections of the WebSocket database pool threads open between messages.
+        "CONN_MAX_AGE": 60,
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
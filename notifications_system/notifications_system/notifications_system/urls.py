@@ -4,6 +4,7 @@ URL Configuration
 
 from django.contrib import admin
 from django.urls import path, include
+from notification.views import metrics_view
 from rest_framework_simplejwt.views import (
     TokenObtainPairView, TokenRefreshView, TokenVerifyView
 )
@@ -14,4 +15,5 @@ urlpatterns = [
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/token/verify/', TokenVerifyView.as_view(), name='token_verify'),
     path('api/', include(("notification.urls", "notification"), namespace="notification")),
+    path('metrics', metrics_view, name='metrics'),
 ]